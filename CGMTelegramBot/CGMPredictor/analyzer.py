@@ -1,36 +1,204 @@
-from typing import Optional
+import time
+import sqlite3
+import threading
+from typing import Callable, Optional
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
 
-from .connection import Connection
+from CGMTelegramBot import settings
+from CGMTelegramBot.logger import get_logger
+from CGMTelegramBot.metrics import POLL_FAILURES, RULE_SECONDS
+
+from .mongo_connection import connection_for
 from .analyzer_data import AnalyzerData, Measure
-from .rules import apply_rules
+from .history import ReadingStore
+from .statistics import DAY_IN_MILLISECONDS, RollingStatistics
+from .rules import RuleResult, first_matching_rule
+
+
+LOGGER = get_logger("predictor")
 
 
 class Analyzer:
 
 
-    def __init__(self, url, secret):
-        self.connection = Connection(url, secret)
+    def __init__(self, url, secret, window_size: int = settings.MEASURES_WINDOW,
+                 deadline: float = settings.NIGHTSCOUT_FETCH_DEADLINE,
+                 executor: Optional[Executor] = None,
+                 history: Optional[ReadingStore] = None, history_key: str = ""):
+        # Many analyzers can share one executor for their requests, and one
+        # history store, where their readings are kept under history_key.
+        self.connection = connection_for(url, secret)
+        self.window_size = window_size
+        self.deadline = deadline
+        self.executor = executor or ThreadPoolExecutor(max_workers=2, thread_name_prefix="Analyzer")
+        self.history = history
+        self.history_key = history_key
+        self.statistics = RollingStatistics()
+        self.statistics_loaded = False
+        self.statistics_future: Optional[Future] = None
         self.data = None
+        self.lock = threading.Lock()  # Serializes the merges of fetched and pushed data.
 
 
     def get_new_data(self):
-        try:
-            measures = self.connection.get_measures(16)
-            treatments = self.connection.get_treatments(16)
+        # Entries and treatments are fetched concurrently under a single deadline.
+        # The first sync fetches a full window, after that only entries newer
+        # than the ones already held are requested and merged into the window.
+        # If only the treatments fail, the last known treatments are kept.
+        # After a restart the window is loaded from the history store, if any,
+        # so only what is newer than the stored readings is fetched.
+        # The statistics readings are pulled in the background, outside the
+        # deadline, and added by the first tick that finds them done.
+        if self.data is None and self.history is not None:
+            self.data = self.__stored_window()
+
+        full_sync = self.data is None or self.data.newest_measure_date is None
 
+        if full_sync:
+            measures_future = self.executor.submit(self.connection.get_measure_columns, self.window_size)
+        else:
+            measures_future = self.executor.submit(
+                self.connection.get_measure_columns_since, self.data.newest_measure_date, self.window_size
+            )
+        treatments_future = self.executor.submit(self.__get_new_treatments)
+        if not self.statistics_loaded and self.statistics_future is None:
+            self.statistics_future = self.executor.submit(self.__load_statistics)
+
+        wait((measures_future, treatments_future), timeout=self.deadline)
+        self.__add_loaded_statistics()
+
+        try:
+            columns = measures_future.result(timeout=0)
         except Exception as e:
-            print(f"Analyzer get_new_data exception: {e}")
+            treatments_future.cancel()
+            POLL_FAILURES.inc()
+            LOGGER.warning("Analyzer get_new_data exception: %r", e)
             return False
 
-        self.data = AnalyzerData(measures, treatments)
+        try:
+            treatments = treatments_future.result(timeout=0)
+        except Exception as e:
+            LOGGER.warning("Analyzer get_new_data treatments exception, keeping previous treatments: %r", e)
+            treatments = []
+
+        # Readings pushed while fetching are already held, merging skips them.
+        with self.lock:
+            self.__merge(columns, treatments, full_sync)
         return True
 
 
+    def add_pushed(self, columns, treatments) -> bool:
+        # Entries and treatments pushed by the Nightscout socket (see push.py),
+        # merged as a fetch would. False before the first sync, which only a
+        # fetch does, or when nothing new was pushed.
+        with self.lock:
+            if self.data is None or self.data.newest_measure_date is None:
+                return False
+            newest_date = self.data.newest_measure_date
+            # Reconnects re-deliver the recent treatments, those are not new.
+            known = {(t.date, t.carbs, t.insulin) for t in self.data.treatments}
+            new_treatments = [t for t in treatments if (t.date, t.carbs, t.insulin) not in known]
+            self.__merge(columns, new_treatments, full_sync=False)
+            return self.data.newest_measure_date != newest_date or bool(new_treatments)
+
+
+    def __merge(self, columns, treatments, full_sync: bool) -> None:
+        if full_sync:
+            previous_treatments = self.data.treatments if self.data else []
+            self.data = AnalyzerData.from_columns(*columns, previous_treatments + treatments).trimmed(self.window_size)
+        else:
+            self.data = self.data.merged_columns(*columns, treatments, self.window_size)
+
+        self.statistics.add_columns(columns[0], columns[1])
+        if self.history is not None:
+            self.__store(columns, treatments)
+
+
+    def __add_loaded_statistics(self) -> None:
+        # A failed load is submitted again by the next tick. Readings merged
+        # meanwhile are kept, add_columns takes the older ones as late uploads.
+        if self.statistics_future is None or not self.statistics_future.done():
+            return
+        future, self.statistics_future = self.statistics_future, None
+        try:
+            dates, sgvs = future.result()
+        except Exception as e:
+            LOGGER.warning("Analyzer could not load the statistics, retrying on the next tick: %r", e)
+            return
+        self.statistics.add_columns(dates, sgvs)
+        self.statistics_loaded = True
+
+
+    def __load_statistics(self):
+        # From the history store, or pulled in bulk from Nightscout when it has
+        # nothing (or there is no store). Until they are added the statistics
+        # only cover the readings polled since the start.
+        now = int(time.time() * 1000)
+        start = now - int(self.statistics.longest_days * DAY_IN_MILLISECONDS)
+        end = now + DAY_IN_MILLISECONDS
+        dates = sgvs = None
+
+        if self.history is not None:
+            dates, sgvs, _ = self.history.readings_between(self.history_key, start, end)
+
+        if not dates:
+            columns = self.connection.get_measure_columns_between(start, end)
+            treatments = self.connection.get_treatments_between(start, end, settings.NIGHTSCOUT_PAGE_SIZE)
+            dates, sgvs, _ = columns
+            if self.history is not None:
+                self.__store(columns, treatments)
+
+        return dates, sgvs
+
+
+    def __stored_window(self) -> Optional[AnalyzerData]:
+        try:
+            data = self.history.latest_window(self.history_key, self.window_size)
+        except sqlite3.Error as e:
+            LOGGER.warning("Analyzer could not load the history: %r", e)
+            return None
+        return data if len(data) > 0 else None
+
+
+    def __store(self, columns, treatments) -> None:
+        # The history is best effort, polling goes on without it.
+        try:
+            self.history.append(self.history_key, *columns, treatments)
+        except sqlite3.Error as e:
+            LOGGER.warning("Analyzer could not store the new data: %r", e)
+
+
+    def history_window(self, start: int, end: int) -> Optional[AnalyzerData]:
+        # Readings and treatments with start <= date < end (in milliseconds),
+        # of any length, for the rules or reports. None without a history store.
+        if self.history is None:
+            return None
+        return self.history.window(self.history_key, start, end)
+
+
+    def __get_new_treatments(self):
+        newest_date = self.data.newest_treatment_date if self.data else None
+        if newest_date is None:
+            return self.connection.get_treatments(self.window_size)
+        return self.connection.get_treatments_since(newest_date, self.window_size)
+
+
     def latest_measure(self) -> Optional[Measure]:
-        if self.data and len(self.data.measures) > 0:
-            return self.data.measures[-1]
+        if self.data:
+            return self.data.latest_measure()
         return None
 
 
-    def rules_message(self) -> str:
-        return apply_rules(self.data)
+    def matching_rule(self) -> Optional[tuple[Callable, RuleResult]]:
+        if self.data is None or len(self.data) == 0:
+            return None
+        return first_matching_rule(self.data, observe_rule)
+
+
+    def rules_message(self) -> Optional[str]:
+        match = self.matching_rule()
+        return match[1].message if match else None
+
+
+def observe_rule(rule: Callable, seconds: float) -> None:
+    RULE_SECONDS.observe(seconds, rule=rule.__name__)
@@ -1,38 +1,299 @@
-from .data import Measure, Treatment, apply_seconds_elapsed, apply_calculate_deltas
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, compress
+
+from .data import (
+    Measure, Treatment, direction_code, direction_name, columns_seconds_elapsed, columns_deltas,
+    sorted_unique_columns
+)
 
 from typing import Optional
 
 
+def unique_by_date(entries: list) -> list:
+    # Entries must be sorted. Keeps the first entry of every date,
+    # duplicated uploads would otherwise produce a zero seconds elapsed.
+    unique = []
+    for entry in entries:
+        if not unique or unique[-1].date != entry.date:
+            unique.append(entry)
+    return unique
+
+
+def unique_treatments(treatments: [Treatment]) -> [Treatment]:
+    # Removes exact duplicates only, keeping the order. Re-fetched or re-pushed
+    # treatments may sort away from their copy next to another treatment of
+    # the same date, so duplicates are not only adjacent ones.
+    seen = set()
+    unique = []
+    for treatment in treatments:
+        key = (treatment.date, treatment.carbs, treatment.insulin)
+        if key not in seen:
+            seen.add(key)
+            unique.append(treatment)
+    return unique
+
+
+class TreatmentIndex:
+
+    # Treatments of a single type sorted by date, with a prefix sum of their
+    # amounts. Newest is O(1), lookups by time O(log n) and range sums O(log n).
+
+    def __init__(self, treatments: [Treatment], amount_of):
+        self.treatments = treatments
+        self.dates = array("q", [t.date for t in treatments])
+        self.amount_sums = array("d", accumulate((float(amount_of(t)) for t in treatments), initial=0))
+
+
+    def __len__(self) -> int:
+        return len(self.treatments)
+
+
+    @property
+    def newest(self) -> Optional[Treatment]:
+        return self.treatments[-1] if len(self.treatments) > 0 else None
+
+
+    @property
+    def newest_date(self) -> Optional[int]:
+        return self.dates[-1] if len(self.dates) > 0 else None
+
+
+    def last_before(self, date: int) -> Optional[Treatment]:
+        # Newest treatment with date strictly before `date`.
+        index = bisect_left(self.dates, date)
+        return self.treatments[index - 1] if index > 0 else None
+
+
+    def total_between(self, start: int, end: int) -> float:
+        # Sum of the amounts with start <= date <= end.
+        first = bisect_left(self.dates, start)
+        last = bisect_right(self.dates, end)
+        if last <= first:
+            return 0.0
+        return self.amount_sums[last] - self.amount_sums[first]
+
+
+
 class AnalyzerData:
 
+    # Measures are kept as parallel typed columns (date, sgv and direction code),
+    # sorted by date. Measure objects are only built when `measures` is accessed.
+
     def __init__(self, measures: [Measure], treatments: [Treatment]):
-        self.measures = sorted(measures)
-        self.measures_seconds_elapsed = apply_seconds_elapsed(self.measures)
-        self.measures_deltas = apply_calculate_deltas(self.measures)
-        self.treatments = sorted(treatments)
+        measures = unique_by_date(sorted(measures))
+
+        self.dates = array("q", [m.date for m in measures])
+        self.sgvs = array("l", [m.sgv for m in measures])
+        self.directions = array("H", [direction_code(m.direction) for m in measures])
+        self.measures_seconds_elapsed = columns_seconds_elapsed(self.dates)
+        self.measures_deltas = columns_deltas(self.measures_seconds_elapsed, self.sgvs)
+        self.set_treatments(unique_treatments(sorted(treatments)))
+        self._measures = measures
+
+
+    @classmethod
+    def from_columns(cls, dates: array, sgvs: array, directions: array, treatments: [Treatment]) -> "AnalyzerData":
+        # Columns must be sorted by date without repeated dates, see data.columns_from_json.
+        seconds_elapsed = columns_seconds_elapsed(dates)
+        deltas = columns_deltas(seconds_elapsed, sgvs)
+        return cls._from_parts(dates, sgvs, directions, seconds_elapsed, deltas, unique_treatments(sorted(treatments)))
+
+
+    @classmethod
+    def _from_parts(cls, dates, sgvs, directions, seconds_elapsed, deltas, treatments,
+                    source: Optional["AnalyzerData"] = None) -> "AnalyzerData":
+        # When `source` is given its treatments and indexes are shared.
+        data = cls.__new__(cls)
+        data.dates = dates
+        data.sgvs = sgvs
+        data.directions = directions
+        data.measures_seconds_elapsed = seconds_elapsed
+        data.measures_deltas = deltas
+        if source is not None:
+            data.treatments = source.treatments
+            data.insulin_index = source.insulin_index
+            data.carbs_index = source.carbs_index
+        else:
+            data.set_treatments(treatments)
+        data._measures = None
+        return data
+
+
+    def set_treatments(self, treatments: [Treatment]) -> None:
+        # Treatments must be sorted, the typed indexes are built once here.
+        self.treatments = treatments
+        self.insulin_index = TreatmentIndex([t for t in treatments if t.is_insulin], lambda t: t.insulin)
+        self.carbs_index = TreatmentIndex([t for t in treatments if t.is_carbs], lambda t: t.carbs)
+
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+
+    def measure_at(self, index: int) -> Measure:
+        return Measure(self.dates[index], self.sgvs[index], direction_name(self.directions[index]))
+
+
+    @property
+    def measures(self) -> [Measure]:
+        if self._measures is None:
+            self._measures = [
+                Measure(date, sgv, direction_name(code))
+                for date, sgv, code in zip(self.dates, self.sgvs, self.directions)
+            ]
+        return self._measures
+
+
+    def latest_measure(self) -> Optional[Measure]:
+        return self.measure_at(-1) if len(self.dates) > 0 else None
+
+
+    @property
+    def newest_measure_date(self) -> Optional[int]:
+        return self.dates[-1] if len(self.dates) > 0 else None
+
+
+    @property
+    def newest_treatment_date(self) -> Optional[int]:
+        return self.treatments[-1].date if len(self.treatments) > 0 else None
+
+
+    @property
+    def min_sgv(self) -> int:
+        return min(self.sgvs)
+
+
+    @property
+    def max_sgv(self) -> int:
+        return max(self.sgvs)
+
+
+    def count_at_least(self, threshold: int, start: int = 0) -> int:
+        # Amount of sgv >= threshold, from the measure at index start.
+        return sum(map(threshold.__le__, self.sgvs[start:]))
+
+
+    def count_above(self, threshold: int, start: int = 0) -> int:
+        return sum(map(threshold.__lt__, self.sgvs[start:]))
+
+
+    def count_at_most(self, threshold: int, start: int = 0) -> int:
+        return sum(map(threshold.__ge__, self.sgvs[start:]))
 
 
     @property
     def insulin(self):
-        return [t for t in self.treatments if t.is_insulin]
+        return self.insulin_index.treatments
 
 
     @property
     def carbs(self):
-        return [t for t in self.treatments if t.is_carbs]
+        return self.carbs_index.treatments
 
 
     @property
     def newest_insulin(self) -> Optional[Treatment]:
-        insulin = self.insulin
-        return insulin[-1] if len(insulin) > 0 else None
+        return self.insulin_index.newest
 
 
     @property
     def newest_carb(self) -> Optional[Treatment]:
-        carbs = self.carbs
-        return carbs[-1] if len(carbs) > 0 else None
+        return self.carbs_index.newest
+
+
+    def insulin_between(self, start: int, end: int) -> float:
+        return self.insulin_index.total_between(start, end)
+
+
+    def carbs_between(self, start: int, end: int) -> float:
+        return self.carbs_index.total_between(start, end)
 
 
     def latest(self, n):
-        return AnalyzerData(self.measures[-n:], self.treatments[-n:])
+        # Zero copy view of the newest n measures. The columns are memoryview
+        # slices over this instance, which is safe since AnalyzerData is never
+        # mutated after being built (merged and trimmed return new instances).
+        # Treatments and their indexes are shared with this instance.
+        start = max(0, len(self.dates) - n)
+        return AnalyzerData._from_parts(
+            memoryview(self.dates)[start:],
+            memoryview(self.sgvs)[start:],
+            memoryview(self.directions)[start:],
+            memoryview(self.measures_seconds_elapsed)[start:],
+            memoryview(self.measures_deltas)[start:],
+            self.treatments,
+            source=self,
+        )
+
+
+    def merged(self, measures: [Measure], treatments: [Treatment], size: int) -> "AnalyzerData":
+        incoming = unique_by_date(sorted(measures))
+        return self.merged_columns(
+            array("q", [m.date for m in incoming]),
+            array("l", [m.sgv for m in incoming]),
+            array("H", [direction_code(m.direction) for m in incoming]),
+            treatments,
+            size,
+        )
+
+
+    def merged_columns(self, new_dates: array, new_sgvs: array, new_directions: array,
+                       treatments: [Treatment], size: int) -> "AnalyzerData":
+        # Returns a new AnalyzerData with the new entries appended and only the
+        # newest `size` of each kept. Derived columns are computed only for the new
+        # measures, the instance itself is never mutated so readers are safe.
+        # New columns must be sorted by date without repeated dates.
+        newest_date = self.newest_measure_date
+        known_dates = set(self.dates)
+        if not known_dates.isdisjoint(new_dates):
+            keep = [date not in known_dates for date in new_dates]
+            new_dates = array("q", compress(new_dates, keep))
+            new_sgvs = array("l", compress(new_sgvs, keep))
+            new_directions = array("H", compress(new_directions, keep))
+
+        if newest_date is not None and new_dates and new_dates[0] < newest_date:
+            # Out of order entry (e.g. a late upload), rebuild everything.
+            merged = AnalyzerData.from_columns(
+                *sorted_unique_columns(self.dates + new_dates, self.sgvs + new_sgvs, self.directions + new_directions),
+                self.treatments,
+            )
+        else:
+            # Pair the newest held measure with the new ones.
+            tail = 1 if len(self.dates) > 0 else 0
+            new_elapsed = columns_seconds_elapsed(self.dates[len(self.dates) - tail:] + new_dates)
+            new_deltas = columns_deltas(new_elapsed, self.sgvs[len(self.sgvs) - tail:] + new_sgvs)
+
+            merged = AnalyzerData._from_parts(
+                self.dates + new_dates,
+                self.sgvs + new_sgvs,
+                self.directions + new_directions,
+                self.measures_seconds_elapsed + new_elapsed,
+                self.measures_deltas + new_deltas,
+                self.treatments,
+                source=self,
+            )
+
+        if treatments:
+            merged.set_treatments(unique_treatments(sorted(self.treatments + treatments)))
+
+        return merged.trimmed(size)
+
+
+    def trimmed(self, size: int) -> "AnalyzerData":
+        drop_measures = max(0, len(self.dates) - size)
+        drop_treatments = max(0, len(self.treatments) - size)
+
+        if drop_measures == 0 and drop_treatments == 0:
+            return self
+
+        # Dropping the k oldest measures drops the k oldest pairs as well.
+        return AnalyzerData._from_parts(
+            self.dates[drop_measures:],
+            self.sgvs[drop_measures:],
+            self.directions[drop_measures:],
+            self.measures_seconds_elapsed[drop_measures:],
+            self.measures_deltas[drop_measures:],
+            self.treatments[drop_treatments:],
+            source=self if drop_treatments == 0 else None,
+        )
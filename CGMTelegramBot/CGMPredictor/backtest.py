@@ -0,0 +1,250 @@
+# Replays a Nightscout export through the RULES, faster than real time.
+#
+#   python -m CGMTelegramBot.CGMPredictor.backtest entries.json treatments.json
+#
+# The export files are JSON arrays as returned by /api/v1/entries and
+# /api/v1/treatments (or mongoexport --jsonArray). Every reading is evaluated
+# with the clock frozen at its date, as if the bot had polled right after it.
+# While no reading arrives, the rules are evaluated every CHECK_DELAY as well.
+
+import re
+import sys
+import json
+import argparse
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from dataclasses import dataclass, asdict
+from multiprocessing import Pool
+from typing import Iterator, Optional, TextIO
+
+from CGMTelegramBot import settings
+
+from .analyzer_data import AnalyzerData
+from .data import DIRECTIONS, Measure, Treatment, direction_code, local_time_str
+from .rules import RULES_MIN_READINGS, first_matching_rule
+from .utils import frozen_time
+
+
+DAY_IN_MILLISECONDS = 24 * 60 * 60 * 1000
+
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+@dataclass
+class BacktestAlert:
+    date: int
+    rule: str
+    message: str
+
+    def local_time_str(self) -> str:
+        return local_time_str(self.date)
+
+
+@dataclass
+class ReplayChunk:
+    # Columns of the readings to replay, preceded by `warmup` readings that only
+    # fill the window. Treatments include the ones needed by the first window.
+    # Polls go on until end_date, the date of the first reading of the next chunk.
+    dates: array
+    sgvs: array
+    directions: array
+    treatments: list
+    warmup: int
+    window_size: int
+    poll_interval: int
+    end_date: int
+    # Direction codes may have been added while loading, workers need the table.
+    direction_names: list
+
+
+def iter_json_array(file: TextIO, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    # Yields the items of a top level JSON array without reading the whole file.
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if not buffer.startswith("["):
+        raise ValueError("Expected a JSON array")
+    position = 1
+
+    while True:
+        position = _SEPARATORS.match(buffer, position).end()
+        if buffer.startswith("]", position):
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield item
+        position = end
+
+
+def treatment_from_export(data: dict) -> Treatment:
+    # Exports straight from the database have no `mills`, only `created_at`.
+    if "mills" in data:
+        date = data["mills"]
+    else:
+        created_at = datetime.fromisoformat(data["created_at"].replace("Z", "+00:00"))
+        date = int(created_at.timestamp() * 1000)
+    return Treatment(date, data.get("carbs"), data.get("insulin"))
+
+
+def load_entries(file: TextIO) -> tuple[array, array, array]:
+    readings = {}
+    for entry in iter_json_array(file):
+        # Calibrations and meter readings have no sgv.
+        if entry.get("sgv") is None or entry.get("date") is None:
+            continue
+        readings.setdefault(entry["date"], (entry["sgv"], direction_code(entry.get("direction"))))
+
+    dates = array("q", sorted(readings))
+    sgvs = array("l", (readings[date][0] for date in dates))
+    directions = array("H", (readings[date][1] for date in dates))
+    return dates, sgvs, directions
+
+
+def load_treatments(file: TextIO) -> list[Treatment]:
+    treatments = (treatment_from_export(t) for t in iter_json_array(file))
+    return sorted(t for t in treatments if t.is_carbs or t.is_insulin)
+
+
+def replay_chunk(chunk: ReplayChunk) -> list[BacktestAlert]:
+    # Rule matches for every reading after the warmup, without mute handling.
+    alerts = []
+    data = AnalyzerData([], [])
+    treatments = chunk.treatments
+    next_treatment = 0
+    poll_interval = chunk.poll_interval * 1000
+
+    for i in range(len(chunk.dates)):
+        date = chunk.dates[i]
+        measure = Measure(date, chunk.sgvs[i], chunk.direction_names[chunk.directions[i]])
+
+        first_treatment = next_treatment
+        while next_treatment < len(treatments) and treatments[next_treatment].date <= date:
+            next_treatment += 1
+
+        data = data.merged([measure], treatments[first_treatment:next_treatment], chunk.window_size)
+        if i < chunk.warmup:
+            continue
+
+        # Polls after this reading and before the next one see the same data.
+        next_date = chunk.dates[i + 1] if i + 1 < len(chunk.dates) else chunk.end_date
+        for now in range(date, next_date, poll_interval):
+            with frozen_time(now):
+                match = first_matching_rule(data)
+
+            if match:
+                rule, result = match
+                alerts.append(BacktestAlert(now, rule.__name__, result.message))
+
+    return alerts
+
+
+def split_in_chunks(dates: array, sgvs: array, directions: array, treatments: list[Treatment],
+                    chunk_days: int, window_size: int, poll_interval: int) -> list[ReplayChunk]:
+    chunks = []
+    treatment_dates = array("q", (t.date for t in treatments))
+    chunk_length = chunk_days * DAY_IN_MILLISECONDS
+    start = 0
+
+    while start < len(dates):
+        chunk_end_date = dates[start] - dates[start] % DAY_IN_MILLISECONDS + chunk_length
+        end = bisect_left(dates, chunk_end_date, start)
+
+        warmup_start = max(0, start - window_size)
+        # The first chunk has nothing before it, its first readings are the warmup.
+        warmup = start - warmup_start if start > 0 else RULES_MIN_READINGS - 1
+        first_treatment = bisect_left(treatment_dates, dates[warmup_start])
+        last_treatment = bisect_left(treatment_dates, chunk_end_date)
+
+        chunks.append(ReplayChunk(
+            dates[warmup_start:end],
+            sgvs[warmup_start:end],
+            directions[warmup_start:end],
+            treatments[max(0, first_treatment - window_size):last_treatment],
+            warmup,
+            window_size,
+            poll_interval,
+            dates[end] if end < len(dates) else dates[-1] + 1,
+            list(DIRECTIONS),
+        ))
+        start = end
+
+    return chunks
+
+
+def apply_rule_mute(alerts: list[BacktestAlert], mute_seconds: int) -> list[BacktestAlert]:
+    # Same as CGMBot.check_rules, after a rule alert others are muted for a while.
+    sent = []
+    mute_until = 0
+    for alert in alerts:
+        if mute_until < alert.date:
+            sent.append(alert)
+            mute_until = alert.date + mute_seconds * 1000
+    return sent
+
+
+def run_backtest(entries_file: TextIO, treatments_file: Optional[TextIO] = None,
+                 processes: Optional[int] = None, chunk_days: int = 1,
+                 window_size: int = settings.MEASURES_WINDOW,
+                 poll_interval: int = settings.CHECK_DELAY,
+                 mute_seconds: Optional[int] = settings.MUTE_RULE_DURATION) -> list[BacktestAlert]:
+    dates, sgvs, directions = load_entries(entries_file)
+    treatments = load_treatments(treatments_file) if treatments_file else []
+
+    chunks = split_in_chunks(dates, sgvs, directions, treatments, chunk_days, window_size, poll_interval)
+
+    if processes == 1 or len(chunks) <= 1:
+        results = [replay_chunk(chunk) for chunk in chunks]
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(replay_chunk, chunks)
+
+    alerts = [alert for chunk_alerts in results for alert in chunk_alerts]
+    if mute_seconds:
+        alerts = apply_rule_mute(alerts, mute_seconds)
+    return alerts
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Replays a Nightscout export through the rules.")
+    parser.add_argument("entries", help="JSON array of entries.")
+    parser.add_argument("treatments", nargs="?", help="JSON array of treatments.")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes, defaults to the CPU count.")
+    parser.add_argument("--chunk-days", type=int, default=1, help="Days replayed by each worker task.")
+    parser.add_argument("--no-mute", action="store_true", help="Report every match, ignoring MUTE_RULE_DURATION.")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per alert.")
+    args = parser.parse_args(argv)
+
+    with open(args.entries, "r") as entries_file:
+        treatments_file = open(args.treatments, "r") if args.treatments else None
+        try:
+            alerts = run_backtest(
+                entries_file,
+                treatments_file,
+                processes=args.processes,
+                chunk_days=args.chunk_days,
+                mute_seconds=None if args.no_mute else settings.MUTE_RULE_DURATION,
+            )
+        finally:
+            if treatments_file:
+                treatments_file.close()
+
+    for alert in alerts:
+        if args.json:
+            print(json.dumps(asdict(alert), ensure_ascii=False))
+        else:
+            print(f"{alert.local_time_str()}  {alert.rule}  {alert.message}")
+
+    print(f"{len(alerts)} alerts.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import zlib
+import struct
+from typing import Sequence
+
+
+# Glucose chart rendered straight to an indexed PNG with zlib, no plotting
+# library needed. Readings are dots (colored by range) joined by lines, over
+# the target band. Carbs are marked at the top and insulin at the bottom.
+# The time axis is labelled in hours before `end`, so no timezone is needed.
+
+
+WHITE, GRID, BAND, IN_RANGE, LOW, HIGH, INSULIN, CARBS, AXIS = range(9)
+
+PALETTE = (
+    (255, 255, 255),
+    (225, 225, 225),
+    (214, 240, 214),
+    (40, 40, 40),
+    (214, 39, 40),
+    (255, 127, 14),
+    (31, 119, 180),
+    (188, 128, 45),
+    (110, 110, 110),
+)
+
+# 3x5 bitmap font, for the axis labels.
+GLYPHS = {
+    "0": ("###", "#.#", "#.#", "#.#", "###"),
+    "1": (".#.", "##.", ".#.", ".#.", "###"),
+    "2": ("###", "..#", "###", "#..", "###"),
+    "3": ("###", "..#", "###", "..#", "###"),
+    "4": ("#.#", "#.#", "###", "..#", "..#"),
+    "5": ("###", "#..", "###", "..#", "###"),
+    "6": ("###", "#..", "###", "#.#", "###"),
+    "7": ("###", "..#", "..#", "..#", "..#"),
+    "8": ("###", "#.#", "###", "#.#", "###"),
+    "9": ("###", "#.#", "###", "..#", "###"),
+    "-": ("...", "...", "###", "...", "..."),
+    "h": ("#..", "#..", "###", "#.#", "#.#"),
+}
+
+MARGIN_LEFT = 34
+MARGIN_RIGHT = 10
+MARGIN_TOP = 14
+MARGIN_BOTTOM = 22
+MAX_GAP = 15 * 60 * 1000  # Readings further apart than this are not joined, in milliseconds.
+
+
+class Canvas:
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(width * height)
+
+
+    def fill_rect(self, x0: int, y0: int, x1: int, y1: int, color: int) -> None:
+        # Fills x0 <= x < x1 and y0 <= y < y1, clipped to the canvas.
+        x0, x1 = max(0, x0), min(self.width, x1)
+        y0, y1 = max(0, y0), min(self.height, y1)
+        if x1 <= x0:
+            return
+        row = bytes((color,)) * (x1 - x0)
+        for y in range(y0, y1):
+            start = y * self.width + x0
+            self.pixels[start:start + x1 - x0] = row
+
+
+    def line(self, x0: int, y0: int, x1: int, y1: int, color: int) -> None:
+        # Bresenham, clipped per pixel.
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        error = dx + dy
+        width, height, pixels = self.width, self.height, self.pixels
+        while True:
+            if 0 <= x0 < width and 0 <= y0 < height:
+                pixels[y0 * width + x0] = color
+            if x0 == x1 and y0 == y1:
+                return
+            double_error = 2 * error
+            if double_error >= dy:
+                error += dy
+                x0 += sx
+            if double_error <= dx:
+                error += dx
+                y0 += sy
+
+
+    def text(self, x: int, y: int, text: str, color: int, scale: int = 2) -> None:
+        for char in text:
+            glyph = GLYPHS.get(char)
+            if glyph:
+                for row, line in enumerate(glyph):
+                    for column, bit in enumerate(line):
+                        if bit == "#":
+                            self.fill_rect(x + column * scale, y + row * scale,
+                                           x + (column + 1) * scale, y + (row + 1) * scale, color)
+            x += 4 * scale
+
+
+    def png(self) -> bytes:
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+        width = self.width
+        # Filter type 0 (none) on every row.
+        raw = b"".join(
+            b"\x00" + self.pixels[y * width:(y + 1) * width] for y in range(self.height)
+        )
+        header = struct.pack(">IIBBBBB", width, self.height, 8, 3, 0, 0, 0)
+        palette = b"".join(bytes(color) for color in PALETTE)
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", header)
+            + chunk(b"PLTE", palette)
+            + chunk(b"IDAT", zlib.compress(raw, 6))
+            + chunk(b"IEND", b"")
+        )
+
+
+def render_chart(dates: Sequence[int], sgvs: Sequence[int], carbs_dates: Sequence[int],
+                 insulin_dates: Sequence[int], start: int, end: int, low: int, high: int,
+                 width: int = 720, height: int = 360) -> bytes:
+    # Readings sorted by date, dates in milliseconds. Returns the PNG bytes.
+    canvas = Canvas(width, height)
+    plot_left, plot_right = MARGIN_LEFT, width - MARGIN_RIGHT
+    plot_top, plot_bottom = MARGIN_TOP, height - MARGIN_BOTTOM
+
+    sgv_min = 40
+    sgv_max = max(300, max(sgvs, default=0) + 20)
+
+    def x_of(date: int) -> int:
+        return plot_left + (date - start) * (plot_right - plot_left) // max(1, end - start)
+
+    def y_of(sgv: int) -> int:
+        sgv = min(max(sgv, sgv_min), sgv_max)
+        return plot_bottom - (sgv - sgv_min) * (plot_bottom - plot_top) // (sgv_max - sgv_min)
+
+    canvas.fill_rect(plot_left, y_of(high), plot_right, y_of(low) + 1, BAND)
+
+    for sgv in range(50, sgv_max, 50):
+        y = y_of(sgv)
+        canvas.fill_rect(plot_left, y, plot_right, y + 1, GRID)
+        canvas.text(2, y - 5, str(sgv), AXIS)
+
+    # One tick per hour, counted back from end.
+    hours = max(1, (end - start) // (60 * 60 * 1000))
+    step = max(1, hours // 12)
+    for hour in range(0, hours + 1, step):
+        x = x_of(end - hour * 60 * 60 * 1000)
+        canvas.fill_rect(x, plot_top, x + 1, plot_bottom, GRID)
+        label = f"-{hour}h" if hour else "0h"
+        canvas.text(max(plot_left, min(x - len(label) * 4, plot_right - len(label) * 8)), plot_bottom + 6, label, AXIS)
+
+    canvas.fill_rect(plot_left, plot_top, plot_left + 1, plot_bottom + 1, AXIS)
+    canvas.fill_rect(plot_left, plot_bottom, plot_right, plot_bottom + 1, AXIS)
+
+    for i in range(1, len(dates)):
+        if dates[i] - dates[i - 1] <= MAX_GAP:
+            canvas.line(x_of(dates[i - 1]), y_of(sgvs[i - 1]), x_of(dates[i]), y_of(sgvs[i]), AXIS)
+
+    for date, sgv in zip(dates, sgvs):
+        color = LOW if sgv <= low else HIGH if sgv >= high else IN_RANGE
+        x, y = x_of(date), y_of(sgv)
+        canvas.fill_rect(x - 2, y - 2, x + 3, y + 3, color)
+
+    for date in carbs_dates:
+        x = x_of(date)
+        canvas.fill_rect(x - 3, plot_top - 10, x + 4, plot_top - 3, CARBS)
+    for date in insulin_dates:
+        x = x_of(date)
+        canvas.fill_rect(x - 3, plot_bottom - 8, x + 4, plot_bottom - 1, INSULIN)
+
+    return canvas.png()
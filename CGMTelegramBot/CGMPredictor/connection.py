@@ -1,12 +1,87 @@
-import json
+import time
+import random
+import threading
 import requests
-from .data import Measure, Treatment
+from requests.adapters import HTTPAdapter
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from CGMTelegramBot import settings
+from CGMTelegramBot.metrics import FETCH_SECONDS, UPSTREAM_ERRORS
+
+from .data import Measure, Treatment, columns_from_json, sorted_unique_columns
+
+try:
+    # Optional, several times faster than json on large responses.
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Only the fields used are requested, servers without projection ignore it.
+ENTRY_QUERY = "find[type]=sgv&fields=date,sgv,direction"
+TREATMENT_QUERY = "fields=mills,created_at,carbs,insulin"
+
+
+def iso_created_at(date: int) -> str:
+    # Treatments are indexed by created_at, an ISO 8601 string.
+    created_at = datetime.fromtimestamp(date / 1000, tz=timezone.utc)
+    return created_at.strftime("%Y-%m-%dT%H:%M:%S.") + f"{date % 1000:03d}Z"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+
+
+    def allow(self) -> bool:
+        # After the cooldown a trial request goes through (half open), a new
+        # failure opens the circuit again since failures is still over the threshold.
+        return time.monotonic() >= self.open_until
+
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.open_until = 0
+
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+
+@dataclass
+class ConnectionStats:
+    requests: int = 0
+    handshakes: int = 0
+    reuses: int = 0
+    retries: int = 0
+    failures: int = 0
+    short_circuits: int = 0
 
 
 
 class Connection:
 
-    def __init__(self, url, secret):
+    def __init__(self, url, secret,
+                 connect_timeout: float = settings.NIGHTSCOUT_CONNECT_TIMEOUT,
+                 read_timeout: float = settings.NIGHTSCOUT_READ_TIMEOUT,
+                 retries: int = settings.NIGHTSCOUT_RETRIES,
+                 backoff: float = settings.NIGHTSCOUT_BACKOFF,
+                 deadline: float = settings.NIGHTSCOUT_FETCH_DEADLINE):
 
         if url[-1] == "/" or url[-1] == "\\":
             url = url[:-1]
@@ -14,31 +89,189 @@ class Connection:
         self.url = url
         self.secret = secret
 
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = max(1, retries)
+        self.backoff = backoff
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(settings.NIGHTSCOUT_BREAKER_THRESHOLD, settings.NIGHTSCOUT_BREAKER_COOLDOWN)
+        self.stats = ConnectionStats()
+        self.lock = threading.Lock()
 
-    def __perform_get(self, extra_url):
-        url = self.url + extra_url
-
-        headers = {
+        # A single keep-alive session, so polls reuse the TCP/TLS connections.
+        # The pool holds more than one connection so requests can run concurrently.
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.session.headers.update({
             "api-secret": self.secret,
             "Content-Type": "application/json",
             "Accept": "application/json",
-        }
+        })
+
+
+    def __count(self, **increments) -> None:
+        with self.lock:
+            for name, amount in increments.items():
+                setattr(self.stats, name, getattr(self.stats, name) + amount)
+
+
+    def __opened_connections(self) -> int:
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+
+    def __perform_get(self, extra_url):
+        url = self.url + extra_url
+        endpoint = extra_url.split("?")[0].rsplit("/", 1)[-1]
+
+        with self.lock:
+            allowed = self.breaker.allow()
+        if not allowed:
+            self.__count(short_circuits=1)
+            UPSTREAM_ERRORS.inc(upstream="nightscout", reason="circuit_open")
+            raise CircuitOpenError(f"Nightscout circuit open, skipping {extra_url}")
+
+        # The retries, their backoff and the timeouts fit in the deadline, so a
+        # request abandoned by the analyzer does not hold an executor worker
+        # for long after it. The read timeout bounds each read of the
+        # response, not the whole of it, so a trickling server can go over.
+        connect_timeout, read_timeout = self.timeout
+        give_up_at = time.monotonic() + self.deadline
+        for attempt in range(self.retries):
+            if attempt > 0:
+                # Full jitter exponential backoff, a retry needs at least the
+                # connect timeout left after it.
+                delay = random.uniform(0, self.backoff * (2 ** attempt))
+                if give_up_at - time.monotonic() - delay < connect_timeout:
+                    break
+                self.__count(retries=1)
+                time.sleep(delay)
+
+            left = give_up_at - time.monotonic()
+            timeout = (min(connect_timeout, left), min(read_timeout, left))
+
+            # With concurrent requests the handshakes are attributed approximately.
+            opened_before = self.__opened_connections()
+            self.__count(requests=1)
+            started = time.perf_counter()
+
+            try:
+                req = self.session.get(url, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.__count(failures=1)
+                reason = "timeout" if isinstance(e, requests.Timeout) else "connection"
+                UPSTREAM_ERRORS.inc(upstream="nightscout", reason=reason)
+                error = e
+                continue
+            finally:
+                FETCH_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+                handshakes = self.__opened_connections() - opened_before
+                self.__count(handshakes=handshakes)
+
+            if handshakes == 0:
+                self.__count(reuses=1)
+
+            if req.status_code in TRANSIENT_STATUS_CODES:
+                self.__count(failures=1)
+                UPSTREAM_ERRORS.inc(upstream="nightscout", reason=str(req.status_code))
+                error = requests.HTTPError(f"Nightscout returned {req.status_code} for {extra_url}", response=req)
+                continue
+
+            try:
+                req.raise_for_status()
+            except requests.HTTPError:
+                # Client errors say nothing about the server health, server errors do.
+                self.__count(failures=1)
+                UPSTREAM_ERRORS.inc(upstream="nightscout", reason=str(req.status_code))
+                if req.status_code >= 500:
+                    with self.lock:
+                        self.breaker.record_failure()
+                raise
+
+            with self.lock:
+                self.breaker.record_success()
+            return loads(req.content)
+
+        with self.lock:
+            self.breaker.record_failure()
+        raise error
+
+
+    def close(self) -> None:
+        self.session.close()
 
-        req = requests.get(url, headers=headers)
-        data = json.loads(req.content)
-        return data
+
+    def __get_entries(self, amount: int, after: Optional[int] = None, before: Optional[int] = None) -> list:
+        # Entries with after < date < before (in milliseconds), newest first.
+        query = ENTRY_QUERY
+        if after is not None:
+            query += f"&find[date][$gt]={after}"
+        if before is not None:
+            query += f"&find[date][$lt]={before}"
+        return self.__perform_get(f"/api/v1/entries?{query}&count={amount}")
+
+
+    def __get_treatments(self, amount: int, after: Optional[int] = None, before: Optional[int] = None) -> [Treatment]:
+        query = TREATMENT_QUERY
+        if after is not None:
+            query += f"&find[created_at][$gt]={iso_created_at(after)}"
+        if before is not None:
+            query += f"&find[created_at][$lt]={iso_created_at(before)}"
+        data = self.__perform_get(f"/api/v1/treatments?{query}&count={amount}")
+        return [Treatment.from_json(d) for d in data]
 
 
     def get_measures(self, amount: int) -> [Measure]:
-        data = self.__perform_get(f"/api/v1/entries?count={amount}")
-        measures = [Measure.from_json(d) for d in data]
-        return measures
+        return [Measure.from_json(d) for d in self.__get_entries(amount) if d.get("sgv") is not None]
+
+
+    def get_measure_columns(self, amount: int) -> tuple[array, array, array]:
+        # Date, sgv and direction code columns of the newest entries, see data.columns_from_json.
+        return columns_from_json(self.__get_entries(amount))
+
+
+    def get_measure_columns_since(self, date: int, amount: int) -> tuple[array, array, array]:
+        # Only entries strictly newer than `date` (in milliseconds).
+        return columns_from_json(self.__get_entries(amount, after=date))
+
+
+    def get_measure_columns_between(self, start: int, end: int,
+                                    page_size: int = settings.NIGHTSCOUT_PAGE_SIZE) -> tuple[array, array, array]:
+        # Entries with start <= date < end, for bulk history pulls. Fetched in
+        # pages from the newest backwards, so every response stays small, each
+        # page is decoded into columns right away.
+        pages = []
+        before = end
+        while True:
+            data = self.__get_entries(page_size, after=start - 1, before=before)
+            if not data:
+                break
+            pages.append(columns_from_json(data))
+            # Continue from the oldest date received, entries without sgv included.
+            before = min(d["date"] for d in data if d.get("date") is not None)
+            if len(data) < page_size:
+                break
+
+        pages.reverse()
+        return sorted_unique_columns(
+            array("q", b"".join(page[0].tobytes() for page in pages)),
+            array("l", b"".join(page[1].tobytes() for page in pages)),
+            array("H", b"".join(page[2].tobytes() for page in pages)),
+        )
+
+
+    def get_treatments(self, amount: int) -> [Treatment]:
+        return self.__get_treatments(amount)
+
+
+    def get_treatments_since(self, date: int, amount: int) -> [Treatment]:
+        return self.__get_treatments(amount, after=date)
 
 
-    def get_treatments(self, amount: int) -> [Measure]:
-        data = self.__perform_get(f"/api/v1/treatments?count={amount}")
-        treatments = [Treatment.from_json(d) for d in data]
-        return treatments
+    def get_treatments_between(self, start: int, end: int, amount: int) -> [Treatment]:
+        # Treatments with start <= date < end, newest first, at most `amount`.
+        return self.__get_treatments(amount, after=start - 1, before=end)
 
 
     def latest_measure(self) -> Measure:
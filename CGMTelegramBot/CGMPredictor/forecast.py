@@ -0,0 +1,200 @@
+# Short horizon glucose forecast, 15, 30 and 45 minutes after the newest reading.
+#
+# Every horizon is a linear model over the same features: the last LAGS deltas
+# (per 5 minutes, newest first) and the insulin and carbs expected to be
+# absorbed within the horizon. The prediction is the newest sgv plus the dot
+# product of the features with that horizon's coefficients.
+#
+# The deltas already carry the current insulin and carbs activity, so the
+# treatment features are only what absorption adds over (or lacks from) the
+# current rate during the horizon, e.g. a bolus that is still ramping up.
+# Absorption curves are tabulated per minute at import, so a forecast is a few
+# table lookups and dot products, microseconds per patient.
+#
+# Default coefficients are a damped trend plus the insulin sensitivity and
+# carb ratio of the settings. forecast_fit.py fits them to a Nightscout
+# export, settings.FORECAST_COEFFICIENTS points at its output.
+
+import json
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from itertools import repeat
+from operator import mul
+from typing import Optional, Sequence
+
+from CGMTelegramBot import settings
+
+from .analyzer_data import AnalyzerData, TreatmentIndex
+
+
+HORIZONS = (15, 30, 45)  # in minutes
+LAGS = 6  # Deltas used, the last 30 minutes.
+LAG_WEIGHTS = (0.4, 0.25, 0.15, 0.1, 0.06, 0.04)  # Of the default trend, newest first.
+TREND_DAMPING = 0.85  # Per 5 minutes, of the default trend.
+MAX_SECONDS_ELAPSED = 7.5 * 60  # Between the readings of the lags, larger gaps have no forecast.
+MATCH_TOLERANCE = 150 * 1000  # Readings within this of a horizon are its actual value, in milliseconds.
+
+
+def insulin_curve(duration: int, peak: int) -> array:
+    # Fraction of a bolus still on board per minute, exponential insulin curve
+    # (as in oref0 and Loop). Zero from `duration` on.
+    tau = peak * (1 - peak / duration) / (1 - 2 * peak / duration)
+    a = 2 * tau / duration
+    s = 1 / (1 - a + (1 + a) * math.exp(-duration / tau))
+    curve = array("d", repeat(0.0, duration + max(HORIZONS) + 2))
+    for t in range(duration):
+        curve[t] = 1 - s * (1 - a) * ((t * t / (tau * duration * (1 - a)) - t / tau - 1) * math.exp(-t / tau) + 1)
+    return curve
+
+
+def carbs_curve(duration: int) -> array:
+    # Fraction of the carbs still on board per minute, triangular absorption
+    # peaking at half the duration. Zero from `duration` on.
+    curve = array("d", repeat(0.0, duration + max(HORIZONS) + 2))
+    for t in range(duration):
+        if t < duration / 2:
+            curve[t] = 1 - 2 * t * t / (duration * duration)
+        else:
+            curve[t] = 2 * (duration - t) ** 2 / (duration * duration)
+    return curve
+
+
+INSULIN_ON_BOARD = insulin_curve(settings.FORECAST_INSULIN_DURATION, settings.FORECAST_INSULIN_PEAK)
+CARBS_ON_BOARD = carbs_curve(settings.FORECAST_CARBS_DURATION)
+
+
+def default_coefficients(horizons: Sequence[int] = HORIZONS) -> dict[int, array]:
+    # Trend of the weighted deltas, damped per step, plus ISF per unit and
+    # ISF / carb ratio per gram.
+    coefficients = {}
+    for horizon in horizons:
+        gain = sum(TREND_DAMPING ** step for step in range(1, horizon // 5 + 1))
+        coefficients[horizon] = array("d", [gain * w for w in LAG_WEIGHTS] + [
+            -settings.FORECAST_ISF, settings.FORECAST_ISF / settings.FORECAST_CARB_RATIO
+        ])
+    return coefficients
+
+
+@dataclass
+class Forecast:
+    date: int  # of the newest reading, the horizons count from it
+    sgv: int  # of the newest reading
+    horizons: tuple  # in minutes
+    sgvs: tuple  # predicted, per horizon
+    insulin_on_board: float  # in units
+    carbs_on_board: float  # in grams
+
+    def at(self, minutes: int) -> float:
+        return self.sgvs[self.horizons.index(minutes)]
+
+    def first_below(self, limit: float, within: Optional[int] = None) -> Optional[tuple[int, float]]:
+        # (horizon, predicted sgv) of the first horizon under `limit`, up to `within` minutes.
+        for horizon, sgv in zip(self.horizons, self.sgvs):
+            if within is not None and horizon > within:
+                break
+            if sgv < limit:
+                return horizon, sgv
+        return None
+
+
+def on_board(index: TreatmentIndex, curve: array, date: int, horizons: Sequence[int]) -> tuple[float, list]:
+    # Amount on board at `date` and, per horizon, the absorption in excess of
+    # the current rate. Treatments after `date` are not known yet.
+    duration = len(curve) - max(horizons) - 2
+    last = bisect_right(index.dates, date)
+    first = bisect_left(index.dates, date - duration * 60 * 1000, 0, last)
+
+    total = 0.0
+    excess = [0.0] * len(horizons)
+    sums = index.amount_sums
+    for i in range(first, last):
+        amount = sums[i + 1] - sums[i]
+        age = (date - index.dates[i]) // (60 * 1000)
+        now = curve[age]
+        rate = now - curve[age + 1]
+        total += amount * now
+        for h, horizon in enumerate(horizons):
+            excess[h] += amount * (now - curve[age + horizon] - rate * horizon)
+    return total, excess
+
+
+class Forecaster:
+
+    def __init__(self, coefficients: Optional[dict[int, Sequence[float]]] = None,
+                 horizons: Sequence[int] = HORIZONS):
+        coefficients = coefficients or default_coefficients(horizons)
+        self.horizons = tuple(horizons)
+        self.coefficients = [array("d", coefficients[horizon]) for horizon in self.horizons]
+
+
+    @classmethod
+    def from_file(cls, file_name: str) -> "Forecaster":
+        with open(file_name) as file:
+            content = json.load(file)
+        return cls({int(h): c for h, c in content["coefficients"].items()}, content["horizons"])
+
+
+    def features(self, dates, sgvs, seconds_elapsed, deltas, index: int,
+                 insulin: TreatmentIndex, carbs: TreatmentIndex) -> Optional[tuple]:
+        # Features of the reading at `index` of the columns (as in AnalyzerData),
+        # one row per horizon. None without LAGS close enough readings before it.
+        if index < LAGS or max(seconds_elapsed[index - LAGS:index]) > MAX_SECONDS_ELAPSED:
+            return None
+
+        date = dates[index]
+        lags = list(deltas[index - 1:index - LAGS - 1:-1] if index > LAGS else deltas[index - 1::-1])
+        insulin_on_board, insulin_excess = on_board(insulin, INSULIN_ON_BOARD, date, self.horizons)
+        carbs_on_board, carbs_excess = on_board(carbs, CARBS_ON_BOARD, date, self.horizons)
+        rows = [lags + [insulin_excess[h], carbs_excess[h]] for h in range(len(self.horizons))]
+        return date, sgvs[index], rows, insulin_on_board, carbs_on_board
+
+
+    def predict(self, features: tuple) -> Forecast:
+        date, sgv, rows, insulin_on_board, carbs_on_board = features
+        sgvs = tuple(
+            sgv + sum(map(mul, row, coefficients)) for row, coefficients in zip(rows, self.coefficients)
+        )
+        return Forecast(date, sgv, self.horizons, sgvs, insulin_on_board, carbs_on_board)
+
+
+    def forecast(self, data: AnalyzerData) -> Optional[Forecast]:
+        # From the newest reading of the data.
+        features = self.features(
+            data.dates, data.sgvs, data.measures_seconds_elapsed, data.measures_deltas, len(data) - 1,
+            data.insulin_index, data.carbs_index
+        )
+        return self.predict(features) if features else None
+
+
+    def forecast_many(self, datas: Sequence[AnalyzerData]) -> list[Optional[Forecast]]:
+        # Of many patients at once: features are gathered first, then every
+        # horizon is evaluated over all the rows with its coefficients.
+        features = [
+            self.features(d.dates, d.sgvs, d.measures_seconds_elapsed, d.measures_deltas, len(d) - 1,
+                          d.insulin_index, d.carbs_index) if d is not None else None
+            for d in datas
+        ]
+        present = [f for f in features if f]
+        per_horizon = [
+            [f[1] + sum(map(mul, f[2][h], coefficients)) for f in present]
+            for h, coefficients in enumerate(self.coefficients)
+        ]
+
+        forecasts = []
+        position = 0
+        for f in features:
+            if f is None:
+                forecasts.append(None)
+                continue
+            sgvs = tuple(predicted[position] for predicted in per_horizon)
+            forecasts.append(Forecast(f[0], f[1], self.horizons, sgvs, f[3], f[4]))
+            position += 1
+        return forecasts
+
+
+
+FORECASTER = (
+    Forecaster.from_file(settings.FORECAST_COEFFICIENTS) if settings.FORECAST_COEFFICIENTS else Forecaster()
+)
@@ -0,0 +1,127 @@
+# Fits the forecast coefficients to a Nightscout export by least squares.
+#
+#   python -m CGMTelegramBot.CGMPredictor.forecast_fit entries.json treatments.json -o coefficients.json
+#
+# Export files as in backtest.py. Every reading with LAGS close readings
+# before it and a reading at each horizon is a sample. Prints the mean
+# absolute error of the default and the fitted coefficients, per horizon.
+
+import json
+import argparse
+from bisect import bisect_left
+from operator import mul
+from typing import Sequence
+
+from .analyzer_data import AnalyzerData
+from .backtest import load_entries, load_treatments
+from .forecast import HORIZONS, LAGS, MATCH_TOLERANCE, Forecaster
+
+
+def training_rows(data: AnalyzerData, forecaster: Forecaster) -> list[tuple[list, list]]:
+    # (features per horizon, actual minus newest sgv per horizon) of every
+    # reading with features and a reading at each horizon.
+    samples = []
+    dates = data.dates
+    for index in range(LAGS, len(dates)):
+        features = forecaster.features(
+            dates, data.sgvs, data.measures_seconds_elapsed, data.measures_deltas, index,
+            data.insulin_index, data.carbs_index
+        )
+        if not features:
+            continue
+
+        targets = []
+        for horizon in forecaster.horizons:
+            target = dates[index] + horizon * 60 * 1000
+            found = bisect_left(dates, target - MATCH_TOLERANCE, index + 1)
+            if found >= len(dates) or dates[found] > target + MATCH_TOLERANCE:
+                break
+            targets.append(data.sgvs[found] - data.sgvs[index])
+
+        if len(targets) == len(forecaster.horizons):
+            samples.append((features[2], targets))
+    return samples
+
+
+def least_squares(rows: list[list], targets: list[float], ridge: float = 1e-6) -> list[float]:
+    # Normal equations, solved by Gaussian elimination with partial pivoting.
+    size = len(rows[0])
+    matrix = [[0.0] * size for _ in range(size)]
+    vector = [0.0] * size
+    for row, target in zip(rows, targets):
+        for i in range(size):
+            vector[i] += row[i] * target
+            matrix_i = matrix[i]
+            for j in range(i, size):
+                matrix_i[j] += row[i] * row[j]
+    for i in range(size):
+        matrix[i][i] += ridge
+        for j in range(i):
+            matrix[i][j] = matrix[j][i]
+
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda r: abs(matrix[r][column]))
+        matrix[column], matrix[pivot] = matrix[pivot], matrix[column]
+        vector[column], vector[pivot] = vector[pivot], vector[column]
+        for r in range(column + 1, size):
+            factor = matrix[r][column] / matrix[column][column]
+            for c in range(column, size):
+                matrix[r][c] -= factor * matrix[column][c]
+            vector[r] -= factor * vector[column]
+
+    solution = [0.0] * size
+    for r in range(size - 1, -1, -1):
+        solution[r] = (vector[r] - sum(matrix[r][c] * solution[c] for c in range(r + 1, size))) / matrix[r][r]
+    return solution
+
+
+def fit(samples: list[tuple[list, list]], horizons: Sequence[int] = HORIZONS) -> dict[int, list[float]]:
+    return {
+        horizon: least_squares([rows[h] for rows, _ in samples], [targets[h] for _, targets in samples])
+        for h, horizon in enumerate(horizons)
+    }
+
+
+def mean_absolute_errors(samples: list[tuple[list, list]], forecaster: Forecaster) -> dict[int, float]:
+    return {
+        horizon: sum(
+            abs(sum(map(mul, rows[h], forecaster.coefficients[h])) - targets[h]) for rows, targets in samples
+        ) / len(samples)
+        for h, horizon in enumerate(forecaster.horizons)
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Fits the forecast coefficients to a Nightscout export.")
+    parser.add_argument("entries", type=argparse.FileType("r"))
+    parser.add_argument("treatments", type=argparse.FileType("r"), nargs="?")
+    parser.add_argument("-o", "--output", help="File for the coefficients, see settings.FORECAST_COEFFICIENTS.")
+    args = parser.parse_args(argv)
+
+    columns = load_entries(args.entries)
+    treatments = load_treatments(args.treatments) if args.treatments else []
+    data = AnalyzerData.from_columns(*columns, treatments)
+
+    default = Forecaster()
+    samples = training_rows(data, default)
+    if not samples:
+        parser.error("no reading has the lags and the horizons needed")
+
+    fitted = Forecaster(fit(samples))
+    report = {
+        "samples": len(samples),
+        "default_mae": mean_absolute_errors(samples, default),
+        "fitted_mae": mean_absolute_errors(samples, fitted),
+    }
+    print(json.dumps(report, indent=4))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "horizons": list(fitted.horizons),
+                "coefficients": {str(h): list(c) for h, c in zip(fitted.horizons, fitted.coefficients)},
+            }, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import time
+import sqlite3
+import threading
+from array import array
+from operator import itemgetter
+from typing import Optional
+
+from CGMTelegramBot import settings
+
+from .analyzer_data import AnalyzerData
+from .data import Treatment, direction_codes, direction_name
+
+
+DAY_IN_MILLISECONDS = 24 * 60 * 60 * 1000
+
+
+class ReadingStore:
+
+    # Every reading and treatment fetched, of all patients, in SQLite (WAL).
+    #
+    # Readings live in a WITHOUT ROWID table clustered by (patient, date): new
+    # readings are appended at the end of their patient's range, duplicated
+    # dates are ignored on insert, and range queries read contiguous pages.
+    # Treatments are deduplicated by an index over all their columns.
+    # Readings older than the retention are deleted every retention_interval
+    # and the freed pages are returned to the file system (incremental vacuum).
+
+    def __init__(self, database_file: str,
+                 retention_days: Optional[float] = settings.HISTORY_RETENTION_DAYS,
+                 retention_interval: float = settings.HISTORY_RETENTION_INTERVAL):
+        self.database_file = database_file
+        self.retention_days = retention_days
+        self.retention_interval = retention_interval
+        self.next_retention = 0
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(database_file, check_same_thread=False, isolation_level=None)
+        # auto_vacuum only applies to new databases, it must come before any table.
+        self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA mmap_size=268435456")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS readings ("
+            "patient TEXT NOT NULL, date INTEGER NOT NULL, sgv INTEGER NOT NULL, direction TEXT, "
+            "PRIMARY KEY (patient, date)) WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS treatments ("
+            "patient TEXT NOT NULL, date INTEGER NOT NULL, carbs REAL, insulin REAL)"
+        )
+        self.connection.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS treatments_unique "
+            "ON treatments (patient, date, ifnull(carbs, -1), ifnull(insulin, -1))"
+        )
+
+
+    def append(self, patient: str, dates: array, sgvs: array, directions: array,
+               treatments: [Treatment]) -> None:
+        # Columns as in AnalyzerData, in a single transaction.
+        readings = zip(
+            [patient] * len(dates), dates, sgvs, map(direction_name, directions)
+        )
+        treatment_rows = [(patient, t.date, t.carbs, t.insulin) for t in treatments]
+
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO readings (patient, date, sgv, direction) VALUES (?, ?, ?, ?)", readings
+                )
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO treatments (patient, date, carbs, insulin) VALUES (?, ?, ?, ?)",
+                    treatment_rows
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+        if time.monotonic() >= self.next_retention:
+            self.apply_retention()
+
+
+    def __fetch_all(self, query: str, parameters: tuple) -> list:
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+
+    @staticmethod
+    def __columns(rows: list) -> tuple[array, array, array]:
+        return (
+            array("q", map(itemgetter(0), rows)),
+            array("l", map(itemgetter(1), rows)),
+            direction_codes(map(itemgetter(2), rows)),
+        )
+
+
+    @staticmethod
+    def __treatments(rows: list) -> [Treatment]:
+        return [Treatment(date, carbs, insulin) for date, carbs, insulin in rows]
+
+
+    def newest_date(self, patient: str) -> Optional[int]:
+        rows = self.__fetch_all("SELECT max(date) FROM readings WHERE patient = ?", (patient,))
+        return rows[0][0]
+
+
+    def readings_between(self, patient: str, start: int, end: int) -> tuple[array, array, array]:
+        # Columns of the readings with start <= date < end, oldest first.
+        return self.__columns(self.__fetch_all(
+            "SELECT date, sgv, direction FROM readings WHERE patient = ? AND date >= ? AND date < ? ORDER BY date",
+            (patient, start, end)
+        ))
+
+
+    def latest_readings(self, patient: str, amount: int) -> tuple[array, array, array]:
+        rows = self.__fetch_all(
+            "SELECT date, sgv, direction FROM readings WHERE patient = ? ORDER BY date DESC LIMIT ?",
+            (patient, amount)
+        )
+        rows.reverse()
+        return self.__columns(rows)
+
+
+    def treatments_between(self, patient: str, start: int, end: int) -> [Treatment]:
+        return self.__treatments(self.__fetch_all(
+            "SELECT date, carbs, insulin FROM treatments WHERE patient = ? AND date >= ? AND date < ? ORDER BY date",
+            (patient, start, end)
+        ))
+
+
+    def latest_treatments(self, patient: str, amount: int) -> [Treatment]:
+        rows = self.__fetch_all(
+            "SELECT date, carbs, insulin FROM treatments WHERE patient = ? ORDER BY date DESC LIMIT ?",
+            (patient, amount)
+        )
+        rows.reverse()
+        return self.__treatments(rows)
+
+
+    def window(self, patient: str, start: int, end: int) -> AnalyzerData:
+        # Readings and treatments with start <= date < end, of any length.
+        return AnalyzerData.from_columns(
+            *self.readings_between(patient, start, end), self.treatments_between(patient, start, end)
+        )
+
+
+    def latest_window(self, patient: str, amount: int) -> AnalyzerData:
+        # Newest `amount` readings and treatments, as the Analyzer holds them.
+        return AnalyzerData.from_columns(
+            *self.latest_readings(patient, amount), self.latest_treatments(patient, amount)
+        )
+
+
+    def apply_retention(self) -> None:
+        self.next_retention = time.monotonic() + self.retention_interval
+        if self.retention_days is None:
+            return
+
+        oldest = int(time.time() * 1000 - self.retention_days * DAY_IN_MILLISECONDS)
+        with self.lock:
+            # By patient, so the deletes are range scans of the (patient, date) keys.
+            patients = self.connection.execute("SELECT DISTINCT patient FROM readings").fetchall()
+            for (patient,) in patients:
+                self.connection.execute("DELETE FROM readings WHERE patient = ? AND date < ?", (patient, oldest))
+                self.connection.execute("DELETE FROM treatments WHERE patient = ? AND date < ?", (patient, oldest))
+            self.connection.execute("PRAGMA incremental_vacuum")
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
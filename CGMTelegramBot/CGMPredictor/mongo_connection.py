@@ -0,0 +1,324 @@
+import time
+import random
+import threading
+from array import array
+from typing import Callable, Optional
+
+from CGMTelegramBot import settings
+from CGMTelegramBot.logger import get_logger
+from CGMTelegramBot.metrics import FETCH_SECONDS, UPSTREAM_ERRORS
+
+from .backtest import treatment_from_export
+from .connection import Connection, iso_created_at
+from .data import Measure, Treatment, columns_from_json
+
+try:
+    # Only needed by mongodb:// sources.
+    import pymongo
+    from pymongo.errors import OperationFailure, PyMongoError
+except ImportError:
+    pymongo = None
+    OperationFailure = PyMongoError = Exception
+
+
+LOGGER = get_logger("poll")
+
+MONGO_SCHEMES = ("mongodb://", "mongodb+srv://")
+
+# Only the fields used are read, as the REST ENTRY_QUERY and TREATMENT_QUERY.
+ENTRY_FILTER = {"type": "sgv"}
+ENTRY_PROJECTION = {"_id": 0, "date": 1, "sgv": 1, "direction": 1}
+TREATMENT_PROJECTION = {"_id": 0, "created_at": 1, "carbs": 1, "insulin": 1}
+
+
+def is_mongo_url(url: str) -> bool:
+    return url.startswith(MONGO_SCHEMES)
+
+
+def connection_for(url: str, secret: str):
+    # A MongoConnection for mongodb:// urls (the secret is then unused, the
+    # credentials go in the url), the REST Connection otherwise.
+    if is_mongo_url(url):
+        return MongoConnection(url)
+    return Connection(url, secret)
+
+
+def treatments_from_documents(documents) -> [Treatment]:
+    # Nightscout stores no mills, only the created_at ISO string.
+    return [
+        treatment_from_export(d) for d in documents
+        if d.get("created_at") and (d.get("carbs") is not None or d.get("insulin") is not None)
+    ]
+
+
+class MongoConnection:
+
+    # Reads the entries and treatments collections of a Nightscout database
+    # directly, with the same methods as Connection, so no request goes through
+    # the Nightscout API. The database is the one in the url.
+    #
+    # Every query has a projection and is a range over the indexes Nightscout
+    # creates: entries by (type, date) and treatments by created_at. Bulk
+    # loads stream through one cursor in batches of NIGHTSCOUT_PAGE_SIZE.
+
+    def __init__(self, url: str, entries: str = settings.MONGO_ENTRIES_COLLECTION,
+                 treatments: str = settings.MONGO_TREATMENTS_COLLECTION,
+                 connect_timeout: float = settings.NIGHTSCOUT_CONNECT_TIMEOUT,
+                 read_timeout: float = settings.NIGHTSCOUT_READ_TIMEOUT):
+        if pymongo is None:
+            raise ImportError("pymongo is needed for mongodb:// sources, see requirements.txt")
+
+        self.url = url
+        self.secret = None
+        self.client = pymongo.MongoClient(
+            url,
+            connectTimeoutMS=int(connect_timeout * 1000),
+            serverSelectionTimeoutMS=int(connect_timeout * 1000),
+            socketTimeoutMS=int(read_timeout * 1000),
+            maxPoolSize=4,
+            appname="CGMTelegramBot",
+        )
+        self.database = self.client.get_default_database()
+        self.entries = self.database[entries]
+        self.treatments = self.database[treatments]
+
+
+    def __timed(self, endpoint: str, query: Callable[[], list]) -> list:
+        started = time.perf_counter()
+        try:
+            return query()
+        except PyMongoError as e:
+            UPSTREAM_ERRORS.inc(upstream="mongo", reason=type(e).__name__)
+            raise
+        finally:
+            FETCH_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+
+
+    def __get_entries(self, amount: int, after: Optional[int] = None, before: Optional[int] = None) -> list:
+        # Entries with after < date < before (in milliseconds), newest first.
+        query = dict(ENTRY_FILTER)
+        date = {}
+        if after is not None:
+            date["$gt"] = after
+        if before is not None:
+            date["$lt"] = before
+        if date:
+            query["date"] = date
+
+        return self.__timed("mongo_entries", lambda: list(
+            self.entries.find(query, ENTRY_PROJECTION)
+            .sort("date", pymongo.DESCENDING).limit(amount).batch_size(amount)
+        ))
+
+
+    def __get_treatments(self, amount: int, after: Optional[int] = None, before: Optional[int] = None) -> [Treatment]:
+        query = {}
+        created_at = {}
+        if after is not None:
+            created_at["$gt"] = iso_created_at(after)
+        if before is not None:
+            created_at["$lt"] = iso_created_at(before)
+        if created_at:
+            query["created_at"] = created_at
+
+        documents = self.__timed("mongo_treatments", lambda: list(
+            self.treatments.find(query, TREATMENT_PROJECTION)
+            .sort("created_at", pymongo.DESCENDING).limit(amount).batch_size(amount)
+        ))
+        return treatments_from_documents(documents)
+
+
+    def get_measures(self, amount: int) -> [Measure]:
+        return [Measure.from_json(d) for d in self.__get_entries(amount) if d.get("sgv") is not None]
+
+
+    def get_measure_columns(self, amount: int) -> tuple[array, array, array]:
+        return columns_from_json(self.__get_entries(amount))
+
+
+    def get_measure_columns_since(self, date: int, amount: int) -> tuple[array, array, array]:
+        return columns_from_json(self.__get_entries(amount, after=date))
+
+
+    def get_measure_columns_between(self, start: int, end: int,
+                                    page_size: int = settings.NIGHTSCOUT_PAGE_SIZE) -> tuple[array, array, array]:
+        # Entries with start <= date < end through a single cursor, newest first
+        # as columns_from_json expects.
+        query = dict(ENTRY_FILTER, date={"$gte": start, "$lt": end})
+        return self.__timed("mongo_entries", lambda: columns_from_json(list(
+            self.entries.find(query, ENTRY_PROJECTION).sort("date", pymongo.DESCENDING).batch_size(page_size)
+        )))
+
+
+    def get_treatments(self, amount: int) -> [Treatment]:
+        return self.__get_treatments(amount)
+
+
+    def get_treatments_since(self, date: int, amount: int) -> [Treatment]:
+        return self.__get_treatments(amount, after=date)
+
+
+    def get_treatments_between(self, start: int, end: int, amount: int) -> [Treatment]:
+        return self.__get_treatments(amount, after=start - 1, before=end)
+
+
+    def latest_measure(self) -> Measure:
+        return self.get_measures(1)[0]
+
+
+    def close(self) -> None:
+        self.client.close()
+
+
+
+class MongoWatch:
+
+    # Same role and interface as push.NightscoutPush, for mongodb:// sources:
+    # new entries and treatments are given to on_data as they are inserted.
+    #
+    # A change stream on the database is used when the server has one (replica
+    # sets, including single node ones), resumed from its last token after a
+    # reconnect. Standalone servers have no change streams, there the newest
+    # entry and treatment are tailed through the indexes every
+    # MONGO_TAIL_INTERVAL. on_connect is called on every (re)connect, for the
+    # caller to fill the gap.
+
+    def __init__(self, connection: MongoConnection,
+                 on_data: Callable[[tuple, list], None], on_connect: Callable[[], None],
+                 name: str = "", tail_interval: float = settings.MONGO_TAIL_INTERVAL,
+                 backoff: float = settings.PUSH_RECONNECT_BACKOFF,
+                 max_backoff: float = settings.PUSH_RECONNECT_MAX):
+        self.connection = connection
+        self.on_data = on_data
+        self.on_connect = on_connect
+        self.name = name
+        self.tail_interval = tail_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.connected = False
+        self.connections = 0
+        self.updates = 0
+        self.resume_token = None
+        self.change_streams = True  # Until the server says otherwise.
+        self.stopping = threading.Event()
+        self.thread = None
+
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.__run, name=f"MongoWatch-{self.name}", daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+
+    def __run(self) -> None:
+        attempt = 0
+        while not self.stopping.is_set():
+            try:
+                if self.change_streams:
+                    self.__watch()
+                else:
+                    self.__tail()
+                attempt = 0
+            except OperationFailure as e:
+                if self.change_streams and not self.connected and self.resume_token is not None:
+                    # Resumed past the oplog, a new stream starts (on_connect fills the gap).
+                    self.resume_token = None
+                    continue
+                if self.change_streams and not self.connected:
+                    LOGGER.info("MongoWatch %s has no change streams, tailing instead: %s", self.name, e)
+                    self.change_streams = False
+                    continue
+                attempt = self.__failed(e, attempt)
+            except PyMongoError as e:
+                attempt = self.__failed(e, attempt)
+            finally:
+                self.connected = False
+
+            if attempt:
+                self.stopping.wait(random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt))))
+
+
+    def __failed(self, error: Exception, attempt: int) -> int:
+        LOGGER.warning("MongoWatch %s disconnected: %r", self.name, error)
+        UPSTREAM_ERRORS.inc(upstream="mongo", reason=type(error).__name__)
+        return 0 if self.connected else attempt + 1
+
+
+    def __connected(self) -> None:
+        self.connected = True
+        self.connections += 1
+        LOGGER.info("MongoWatch %s connected.", self.name)
+        self.__callback(self.on_connect)
+
+
+    def __watch(self) -> None:
+        entries = self.connection.entries.name
+        treatments = self.connection.treatments.name
+        pipeline = [{"$match": {"operationType": "insert", "ns.coll": {"$in": [entries, treatments]}}}]
+
+        with self.connection.database.watch(
+            pipeline, resume_after=self.resume_token, max_await_time_ms=1000
+        ) as stream:
+            self.__connected()
+            while not self.stopping.is_set():
+                # Everything already waiting is given as a single update.
+                changes = []
+                change = stream.try_next()
+                while change is not None:
+                    changes.append(change)
+                    change = stream.try_next()
+                self.resume_token = stream.resume_token
+                if changes:
+                    self.__deliver(
+                        [c["fullDocument"] for c in changes if c["ns"]["coll"] == entries],
+                        [c["fullDocument"] for c in changes if c["ns"]["coll"] == treatments],
+                    )
+
+
+    def __tail(self) -> None:
+        entries = self.connection.entries
+        treatments = self.connection.treatments
+
+        def newest(collection, query: dict, field: str):
+            document = collection.find_one(query, {"_id": 0, field: 1}, sort=[(field, pymongo.DESCENDING)])
+            return document[field] if document else None
+
+        newest_date = newest(entries, ENTRY_FILTER, "date") or 0
+        newest_created_at = newest(treatments, {}, "created_at") or ""
+        self.__connected()
+
+        while not self.stopping.wait(self.tail_interval):
+            new_entries = list(
+                entries.find(dict(ENTRY_FILTER, date={"$gt": newest_date}), ENTRY_PROJECTION)
+                .sort("date", pymongo.ASCENDING)
+            )
+            new_treatments = list(
+                treatments.find({"created_at": {"$gt": newest_created_at}}, TREATMENT_PROJECTION)
+                .sort("created_at", pymongo.ASCENDING)
+            )
+            if new_entries:
+                newest_date = new_entries[-1]["date"]
+            if new_treatments:
+                newest_created_at = new_treatments[-1]["created_at"]
+            if new_entries or new_treatments:
+                self.__deliver(new_entries, new_treatments)
+
+
+    def __deliver(self, entries: list, treatments: list) -> None:
+        columns = columns_from_json([e for e in entries if e.get("type", "sgv") == "sgv"])
+        treatments = treatments_from_documents(treatments)
+        if len(columns[0]) or treatments:
+            self.updates += 1
+            self.__callback(self.on_data, columns, treatments)
+
+
+    def __callback(self, function: Callable, *args) -> None:
+        # Failures of the caller do not drop the watch.
+        try:
+            function(*args)
+        except Exception as e:
+            LOGGER.exception("MongoWatch %s callback %s failed: %s", self.name, function.__name__, e)
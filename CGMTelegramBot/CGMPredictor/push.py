@@ -0,0 +1,188 @@
+import json
+import random
+import threading
+from array import array
+from typing import Callable, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from CGMTelegramBot import settings
+from CGMTelegramBot.logger import get_logger
+from CGMTelegramBot.metrics import UPSTREAM_ERRORS
+
+from .data import Treatment, direction_codes, sorted_unique_columns
+from .websocket import WebSocket, WebSocketClosed
+
+
+LOGGER = get_logger("poll")
+
+# Engine.IO 4 packet types (socket.io 3 and 4 servers), and the socket.io
+# packet types carried in its messages.
+ENGINE_OPEN, ENGINE_CLOSE, ENGINE_PING, ENGINE_PONG, ENGINE_MESSAGE = "0", "1", "2", "3", "4"
+SOCKET_CONNECT, SOCKET_DISCONNECT, SOCKET_EVENT, SOCKET_ACK, SOCKET_ERROR = "0", "1", "2", "3", "4"
+
+AUTHORIZE_ACK_ID = "0"
+
+
+class PushUnauthorized(Exception):
+    pass
+
+
+def socket_url(url: str) -> str:
+    # Nightscout serves socket.io at <url>/socket.io/.
+    parts = urlsplit(url)
+    scheme = {"https": "wss", "http": "ws"}.get(parts.scheme, parts.scheme)
+    path = parts.path.rstrip("/") + "/socket.io/"
+    return urlunsplit((scheme, parts.netloc, path, "EIO=4&transport=websocket", ""))
+
+
+def data_update_columns(update: dict) -> tuple[tuple[array, array, array], list[Treatment]]:
+    # Columns (as in AnalyzerData) and treatments of a dataUpdate event. Its
+    # sgvs carry the value as mgdl and the date as mills.
+    sgvs = [s for s in update.get("sgvs") or () if s.get("mills") is not None and s.get("mgdl") is not None]
+    columns = sorted_unique_columns(
+        array("q", [s["mills"] for s in sgvs]),
+        array("l", [s["mgdl"] for s in sgvs]),
+        direction_codes([s.get("direction") for s in sgvs]),
+    )
+    treatments = [
+        Treatment(t["mills"], t.get("carbs"), t.get("insulin"))
+        for t in update.get("treatments") or ()
+        if t.get("mills") is not None and (t.get("carbs") is not None or t.get("insulin") is not None)
+    ]
+    return columns, treatments
+
+
+class NightscoutPush:
+
+    # Subscribes to the real-time socket of a Nightscout, on its own thread.
+    #
+    # After the socket authorizes (with the same secret as the REST api-secret
+    # header) on_connect is called, where the caller fills the gap since its
+    # newest reading through REST. Then every dataUpdate with readings or
+    # treatments is given to on_data as columns. Dropped or silent connections
+    # (no ping within the server's ping interval and timeout) are reconnected
+    # with full jitter exponential backoff.
+
+    def __init__(self, url: str, secret: str,
+                 on_data: Callable[[tuple, list], None], on_connect: Callable[[], None],
+                 name: str = "", history_hours: float = settings.PUSH_HISTORY_HOURS,
+                 connect_timeout: float = settings.NIGHTSCOUT_CONNECT_TIMEOUT,
+                 backoff: float = settings.PUSH_RECONNECT_BACKOFF,
+                 max_backoff: float = settings.PUSH_RECONNECT_MAX):
+        self.url = socket_url(url)
+        self.secret = secret
+        self.on_data = on_data
+        self.on_connect = on_connect
+        self.name = name
+        self.history_hours = history_hours
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.connected = False  # Authorized and receiving updates.
+        self.connections = 0
+        self.updates = 0
+        self.websocket: Optional[WebSocket] = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.__run, name=f"Push-{self.name}", daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        self.stopping.set()
+        websocket = self.websocket
+        if websocket is not None:
+            websocket.close()
+
+
+    def __run(self) -> None:
+        attempt = 0
+        while not self.stopping.is_set():
+            try:
+                self.__session()
+                attempt = 0
+            except PushUnauthorized as e:
+                LOGGER.error("NightscoutPush %s not authorized: %s", self.name, e)
+                UPSTREAM_ERRORS.inc(upstream="nightscout_push", reason="unauthorized")
+                attempt = max(attempt, 16)  # Retried at the maximum backoff.
+            except (OSError, WebSocketClosed, ValueError) as e:
+                if self.stopping.is_set():
+                    break
+                was_connected = self.connected
+                LOGGER.warning("NightscoutPush %s disconnected: %r", self.name, e)
+                UPSTREAM_ERRORS.inc(upstream="nightscout_push", reason=type(e).__name__)
+                # A session that got through reconnects right away once.
+                attempt = 0 if was_connected else attempt + 1
+            finally:
+                self.connected = False
+                if self.websocket is not None:
+                    self.websocket.close()
+                    self.websocket = None
+
+            if attempt:
+                self.stopping.wait(random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt))))
+
+
+    def __session(self) -> None:
+        self.websocket = websocket = WebSocket.connect(self.url, self.connect_timeout)
+
+        packet = websocket.recv()
+        if not packet.startswith(ENGINE_OPEN):
+            raise ValueError(f"expected the open packet, got {packet[:20]!r}")
+        handshake = json.loads(packet[1:])
+        # The server pings every pingInterval, silence beyond this is a dead connection.
+        websocket.settimeout((handshake["pingInterval"] + handshake["pingTimeout"]) / 1000)
+
+        websocket.send_text(ENGINE_MESSAGE + SOCKET_CONNECT)
+        authorize = {"client": "web", "secret": self.secret, "history": self.history_hours}
+        sent_authorize = False
+
+        while not self.stopping.is_set():
+            packet = websocket.recv()
+            kind, body = packet[:1], packet[1:]
+
+            if kind == ENGINE_PING:
+                websocket.send_text(ENGINE_PONG + body)
+            elif kind == ENGINE_CLOSE:
+                raise WebSocketClosed("engine closed by the server")
+            elif kind != ENGINE_MESSAGE or not body:
+                continue
+            elif body[0] == SOCKET_CONNECT and not sent_authorize:
+                sent_authorize = True
+                websocket.send_text(
+                    ENGINE_MESSAGE + SOCKET_EVENT + AUTHORIZE_ACK_ID + json.dumps(["authorize", authorize])
+                )
+            elif body[0] == SOCKET_ACK and body[1:].startswith(AUTHORIZE_ACK_ID):
+                result = json.loads(body[1 + len(AUTHORIZE_ACK_ID):])
+                if not result or not result[0].get("read"):
+                    raise PushUnauthorized("the secret has no read permission")
+                self.connected = True
+                self.connections += 1
+                LOGGER.info("NightscoutPush %s connected.", self.name)
+                self.__callback(self.on_connect)
+            elif body[0] == SOCKET_EVENT:
+                self.__event(json.loads(body[1:]))
+            elif body[0] in (SOCKET_DISCONNECT, SOCKET_ERROR):
+                raise WebSocketClosed(f"socket.io disconnect: {body[1:]!r}")
+
+
+    def __event(self, message: list) -> None:
+        if not self.connected or not message or message[0] != "dataUpdate" or len(message) < 2:
+            return
+
+        columns, treatments = data_update_columns(message[1])
+        if len(columns[0]) or treatments:
+            self.updates += 1
+            self.__callback(self.on_data, columns, treatments)
+
+
+    def __callback(self, function: Callable, *args) -> None:
+        # Failures of the caller do not drop the connection.
+        try:
+            function(*args)
+        except Exception as e:
+            LOGGER.exception("NightscoutPush %s callback %s failed: %s", self.name, function.__name__, e)
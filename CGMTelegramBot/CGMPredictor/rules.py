@@ -1,9 +1,14 @@
-from typing import Optional
+import time
+from typing import Optional, Callable
+from functools import wraps
 from dataclasses import dataclass
 
 
+from CGMTelegramBot import settings
+
 from .utils import date_seconds_diff_to_now
-from .analyzer_data import AnalyzerData
+from .analyzer_data import AnalyzerData, TreatmentIndex
+from .forecast import FORECASTER
 
 
 # All rules must be functions that receive a AnalyzerData as the only argument
@@ -17,24 +22,69 @@ class RuleResult:
 
 
 
+class RuleWindows:
+
+    # Windows shared by all rules during a single apply_rules call. Each window
+    # is built once per `newest` and its filter checks are memoized.
+
+    def __init__(self, data: AnalyzerData):
+        self.data = data
+        self.windows = {}
+        self.max_seconds_elapsed = {}
+        self.seconds_since_newest = None
+
+
+    def window(self, newest: Optional[int]) -> AnalyzerData:
+        if newest not in self.windows:
+            self.windows[newest] = self.data.latest(newest) if newest else self.data
+        return self.windows[newest]
+
+
+    def max_measures_seconds_elapsed(self, newest: Optional[int]) -> float:
+        if newest not in self.max_seconds_elapsed:
+            self.max_seconds_elapsed[newest] = max(self.window(newest).measures_seconds_elapsed, default=0)
+        return self.max_seconds_elapsed[newest]
+
+
+    def newest_measure_seconds_to_now(self) -> Optional[int]:
+        # Every window ends at the newest measure of the base data. None without measures.
+        if self.seconds_since_newest is None and len(self.data) > 0:
+            self.seconds_since_newest = date_seconds_diff_to_now(self.data.newest_measure_date)
+        return self.seconds_since_newest
+
+
+
+def treated_within_minutes(index: TreatmentIndex, minutes: int) -> bool:
+    # No treatment of the type in the data counts as not treated.
+    newest_date = index.newest_date
+    return newest_date is not None and date_seconds_diff_to_now(newest_date) < (60 * minutes)
+
+
+
 def rule_filter_wrap(newest=None, max_measures_minutes_elapsed=None, max_minutes_date_diff_to_now=None):
 
     def __true_decorator(rule_func):
 
-        def __inner_filter(orig_data: AnalyzerData):
+        @wraps(rule_func)
+        def __inner_filter(orig_data: AnalyzerData, windows: Optional[RuleWindows] = None):
 
-            if newest:
-                orig_data = orig_data.latest(newest)
+            if windows is None:
+                windows = RuleWindows(orig_data)
 
-            if max_measures_minutes_elapsed and max(orig_data.measures_seconds_elapsed) > (60 * max_measures_minutes_elapsed):
+            # Rule bodies index and average their window, shorter ones never match.
+            if len(windows.window(newest)) < (newest or 1):
                 return RuleResult(False)
 
-            diff = date_seconds_diff_to_now(orig_data.measures[-1].date)
+            if max_measures_minutes_elapsed and windows.max_measures_seconds_elapsed(newest) > (60 * max_measures_minutes_elapsed):
+                return RuleResult(False)
+
+            diff = windows.newest_measure_seconds_to_now()
             if max_minutes_date_diff_to_now and diff > (60 * max_minutes_date_diff_to_now):
                 return RuleResult(False)
 
-            return rule_func(orig_data)
+            return rule_func(windows.window(newest))
 
+        __inner_filter.newest = newest
         return __inner_filter
 
     return __true_decorator
@@ -43,11 +93,11 @@ def rule_filter_wrap(newest=None, max_measures_minutes_elapsed=None, max_minutes
 @rule_filter_wrap(newest=6, max_measures_minutes_elapsed=12, max_minutes_date_diff_to_now=10)
 def rule_imminent_hypoglycemia(data: AnalyzerData) -> RuleResult:
 
-    if data.measures[0].sgv > 106:
+    if data.sgvs[0] > 106:
         return RuleResult(False)
 
-    above_106 = sum(m.sgv >= 106 for m in data.measures[2:])
-    bellow_76 = sum(m.sgv <= 75 for m in data.measures)
+    above_106 = data.count_at_least(106, start=2)
+    bellow_76 = data.count_at_most(75)
 
     # If any <= 75, no need to trigger.
     if bellow_76 > 0:
@@ -58,7 +108,7 @@ def rule_imminent_hypoglycemia(data: AnalyzerData) -> RuleResult:
         return RuleResult(False)
 
     # Check if carbs in lasts 25 minutes.
-    if date_seconds_diff_to_now(data.newest_carb.date) < (60 * 25):
+    if treated_within_minutes(data.carbs_index, 25):
         return RuleResult(False)
 
     # Sort deltas and discard the largest.
@@ -76,11 +126,41 @@ def rule_imminent_hypoglycemia(data: AnalyzerData) -> RuleResult:
     )
 
 
+@rule_filter_wrap(max_minutes_date_diff_to_now=10)
+def rule_predicted_hypoglycemia(data: AnalyzerData) -> RuleResult:
+    # Off unless enabled, the default coefficients are not fitted to the patient.
+    if not settings.FORECAST_ALERTS:
+        return RuleResult(False)
+
+    # Readings already under LIMIT_LOW alert by themselves.
+    if data.sgvs[-1] <= settings.LIMIT_LOW:
+        return RuleResult(False)
+
+    forecast = FORECASTER.forecast(data)
+    if forecast is None:
+        return RuleResult(False)
+
+    below = forecast.first_below(settings.FORECAST_LOW, within=settings.FORECAST_LOW_WITHIN)
+    if below is None:
+        return RuleResult(False)
+
+    # Check if carbs in lasts 25 minutes.
+    if treated_within_minutes(data.carbs_index, 25):
+        return RuleResult(False)
+
+    minutes, sgv = below
+    return RuleResult(
+        True,
+        f"Glicose prevista em {max(sgv, 40):.0f} mg/dL em {minutes} minutos, último carboidrato há mais de 25 minutos. "
+        "Considerar comer algo."
+    )
+
+
 @rule_filter_wrap(newest=7, max_measures_minutes_elapsed=12, max_minutes_date_diff_to_now=10)
 def rule_fast_rising(data: AnalyzerData) -> RuleResult:
 
-    min_value = min(data.measures).sgv
-    max_value = max(data.measures).sgv
+    min_value = data.min_sgv
+    max_value = data.max_sgv
     if min_value < 135 or max_value >= 220:
         return RuleResult(False)
 
@@ -98,7 +178,7 @@ def rule_fast_rising(data: AnalyzerData) -> RuleResult:
         return RuleResult(False)
 
     # Check if insulin in lasts 30 minutes.
-    if date_seconds_diff_to_now(data.newest_insulin.date) < (60 * 30):
+    if treated_within_minutes(data.insulin_index, 30):
         return RuleResult(False)
 
     return RuleResult(
@@ -109,19 +189,19 @@ def rule_fast_rising(data: AnalyzerData) -> RuleResult:
 
 @rule_filter_wrap(newest=10, max_measures_minutes_elapsed=12, max_minutes_date_diff_to_now=10)
 def rule_stable_over_limit(data: AnalyzerData) -> RuleResult:
-    if data.measures[-1].sgv < 175:
+    if data.sgvs[-1] < 175:
         return RuleResult(False)
 
-    above_180 = sum(m.sgv > 180 for m in data.measures)
-    bellow_175 = sum(m.sgv <= 175 for m in data.measures)
-    above_220 = sum(m.sgv >= 220 for m in data.measures)
+    above_180 = data.count_above(180)
+    bellow_175 = data.count_at_most(175)
+    above_220 = data.count_at_least(220)
 
     # At least 5 readings over 180, less than 5 bellow 175 and zero above 220
     if not (above_180 >= 6 and bellow_175 < 5 and above_220 == 0):
         return RuleResult(False)
 
     # Check if insulin in lasts 40 minutes.
-    if date_seconds_diff_to_now(data.newest_insulin.date) < (60 * 40):
+    if treated_within_minutes(data.insulin_index, 40):
         return RuleResult(False)
 
     return RuleResult(
@@ -132,7 +212,7 @@ def rule_stable_over_limit(data: AnalyzerData) -> RuleResult:
 
 @rule_filter_wrap()
 def rule_no_new_data(data: AnalyzerData) -> RuleResult:
-    last_time = data.measures[-1].date
+    last_time = data.newest_measure_date
 
     if date_seconds_diff_to_now(last_time) < (60 * 25):
         return RuleResult(False)
@@ -146,17 +226,38 @@ def rule_no_new_data(data: AnalyzerData) -> RuleResult:
 
 RULES = (
     rule_imminent_hypoglycemia,
+    rule_predicted_hypoglycemia,
     rule_fast_rising,
     rule_stable_over_limit,
     rule_no_new_data,
 )
 
+# Readings needed for every rule to see a full window.
+RULES_MIN_READINGS = max(rule.newest or 1 for rule in RULES)
 
-def apply_rules(orig_data: AnalyzerData) -> Optional[str]:
+
+def first_matching_rule(orig_data: AnalyzerData,
+                        observe: Optional[Callable[[Callable, float], None]] = None
+                        ) -> Optional[tuple[Callable, RuleResult]]:
+    # observe, when given, is called with every evaluated rule and its duration in seconds.
+    windows = RuleWindows(orig_data)
     for rule in RULES:
-        result = rule(orig_data)
+        if observe is None:
+            result = rule(orig_data, windows)
+        else:
+            started = time.perf_counter()
+            result = rule(orig_data, windows)
+            observe(rule, time.perf_counter() - started)
         if result.matches:
-            return result.message
+            return rule, result
+
+    return None
+
+
+def apply_rules(orig_data: AnalyzerData) -> Optional[str]:
+    match = first_matching_rule(orig_data)
+    if match:
+        return match[1].message
 
     return None
 
@@ -0,0 +1,217 @@
+import math
+import time
+import threading
+from bisect import insort
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from CGMTelegramBot import settings
+
+
+DAY_IN_MILLISECONDS = 24 * 60 * 60 * 1000
+READING_INTERVAL = 5 * 60 * 1000  # Expected interval of the CGM readings, in milliseconds.
+
+
+@dataclass
+class WindowStatistics:
+    days: float
+    readings: int
+    coverage: float  # readings / expected readings, 0 to 1
+    mean: Optional[float] = None
+    sd: Optional[float] = None
+    cv: Optional[float] = None  # sd / mean, 0 to 1
+    gmi: Optional[float] = None  # Glucose Management Indicator, estimated A1c in %
+    below: float = 0  # fractions of the readings, 0 to 1
+    in_range: float = 0
+    above: float = 0
+    hypo_events: int = 0
+
+
+class WindowAggregate:
+
+    # Running sums of the readings of the last `days`. Readings are added in
+    # date order and expired from the front, so both are O(1) amortized. Sums
+    # are of integers, the results are exactly those of a full recomputation.
+    #
+    # A hypo event is a run of consecutive readings <= LIMIT_LOW. Every reading
+    # carries whether it starts a run, a run whose start already expired is
+    # counted through the first reading of the window.
+
+    __slots__ = ("days", "length", "low", "high", "readings", "count", "total", "total_squares",
+                 "count_below", "count_above", "event_starts")
+
+    def __init__(self, days: float, low: int, high: int):
+        self.days = days
+        self.length = days * DAY_IN_MILLISECONDS
+        self.low = low
+        self.high = high
+        self.readings = deque()  # (date, sgv, starts_event)
+        self.count = 0
+        self.total = 0
+        self.total_squares = 0
+        self.count_below = 0
+        self.count_above = 0
+        self.event_starts = 0
+
+
+    def __update(self, sgv: int, starts_event: bool, sign: int) -> None:
+        self.count += sign
+        self.total += sign * sgv
+        self.total_squares += sign * sgv * sgv
+        self.count_below += sign * (sgv <= self.low)
+        self.count_above += sign * (sgv >= self.high)
+        self.event_starts += sign * starts_event
+
+
+    def add(self, date: int, sgv: int, starts_event: bool) -> None:
+        self.readings.append((date, sgv, starts_event))
+        self.__update(sgv, starts_event, 1)
+
+
+    def expire(self, now: int) -> None:
+        # Keeps the readings with date > now - length.
+        oldest = now - self.length
+        while self.readings and self.readings[0][0] <= oldest:
+            _, sgv, starts_event = self.readings.popleft()
+            self.__update(sgv, starts_event, -1)
+
+
+    def statistics(self) -> WindowStatistics:
+        count = self.count
+        coverage = min(1.0, count * READING_INTERVAL / self.length)
+        if count == 0:
+            return WindowStatistics(self.days, 0, coverage)
+
+        mean = self.total / count
+        sd = None
+        if count > 1:
+            sd = math.sqrt((count * self.total_squares - self.total * self.total) / (count * (count - 1)))
+
+        first_sgv, first_starts_event = self.readings[0][1], self.readings[0][2]
+        hypo_events = self.event_starts + (first_sgv <= self.low and not first_starts_event)
+
+        return WindowStatistics(
+            self.days,
+            count,
+            coverage,
+            mean=mean,
+            sd=sd,
+            cv=sd / mean if sd is not None else None,
+            gmi=3.31 + 0.02392 * mean,
+            below=self.count_below / count,
+            in_range=(count - self.count_below - self.count_above) / count,
+            above=self.count_above / count,
+            hypo_events=hypo_events,
+        )
+
+
+
+class RollingStatistics:
+
+    # Aggregates of every window in STATISTICS_WINDOWS, updated per new reading.
+    # statistics() only expires what left the windows, it never rescans them.
+
+    def __init__(self, windows: tuple = settings.STATISTICS_WINDOWS,
+                 low: int = settings.LIMIT_LOW, high: int = settings.LIMIT_HIGH):
+        self.low = low
+        self.high = high
+        self.windows = [WindowAggregate(days, low, high) for days in sorted(windows)]
+        self.dates = set()  # of the readings in the longest window
+        self.newest = None  # (date, sgv) of the newest reading
+        self.lock = threading.Lock()
+
+
+    def __add(self, date: int, sgv: int) -> None:
+        starts_event = sgv <= self.low and (self.newest is None or self.newest[1] > self.low)
+        for window in self.windows:
+            window.add(date, sgv, starts_event)
+        self.dates.add(date)
+        self.newest = (date, sgv)
+
+
+    def __expire(self, now: int) -> None:
+        longest = self.windows[-1]
+        for date, _, _ in longest.readings:
+            if date > now - longest.length:
+                break
+            self.dates.discard(date)
+        for window in self.windows:
+            window.expire(now)
+
+
+    def add_columns(self, dates, sgvs, now: Optional[int] = None) -> None:
+        # Columns sorted by date. Known dates are skipped, a reading older than
+        # the newest one (a late upload) rebuilds the aggregates.
+        now = int(time.time() * 1000) if now is None else now
+        with self.lock:
+            self.__add_columns(dates, sgvs, now)
+
+
+    def rebuild(self, dates, sgvs, now: Optional[int] = None) -> None:
+        now = int(time.time() * 1000) if now is None else now
+        with self.lock:
+            self.__clear()
+            self.__add_columns(dates, sgvs, now)
+
+
+    def __add_columns(self, dates, sgvs, now: int) -> None:
+        readings = [(date, sgv) for date, sgv in zip(dates, sgvs) if date not in self.dates]
+        if readings and self.newest is not None and readings[0][0] < self.newest[0]:
+            held = [(date, sgv) for date, sgv, _ in self.windows[-1].readings]
+            for reading in readings:
+                insort(held, reading)
+            readings = held
+            self.__clear()
+
+        for date, sgv in readings:
+            self.__add(date, sgv)
+        self.__expire(now)
+
+
+    def __clear(self) -> None:
+        self.windows = [WindowAggregate(window.days, self.low, self.high) for window in self.windows]
+        self.dates = set()
+        self.newest = None
+
+
+    @property
+    def longest_days(self) -> float:
+        return self.windows[-1].days
+
+
+    def is_empty(self) -> bool:
+        return self.newest is None
+
+
+    def statistics(self, now: Optional[int] = None) -> [WindowStatistics]:
+        now = int(time.time() * 1000) if now is None else now
+        with self.lock:
+            self.__expire(now)
+            return [window.statistics() for window in self.windows]
+
+
+def window_name(days: float) -> str:
+    if days == 1:
+        return "24 horas"
+    return f"{days:g} dias"
+
+
+def statistics_message(statistics: [WindowStatistics]) -> str:
+    parts = ["Estatísticas"]
+    for s in statistics:
+        if s.readings == 0:
+            parts.append(f"{window_name(s.days)}: sem leituras.")
+            continue
+
+        lines = [
+            f"{window_name(s.days)} ({s.readings} leituras, {s.coverage:.0%} do período):",
+            f"No alvo: {s.in_range:.0%} | Abaixo: {s.below:.0%} | Acima: {s.above:.0%}",
+            f"Média: {s.mean:.0f} mg/dL | GMI: {s.gmi:.1f}%",
+        ]
+        if s.sd is not None:
+            lines.append(f"DP: {s.sd:.0f} mg/dL | CV: {s.cv:.1%}")
+        lines.append(f"Hipoglicemias: {s.hypo_events}")
+        parts.append("\n".join(lines))
+
+    return "\n\n".join(parts)
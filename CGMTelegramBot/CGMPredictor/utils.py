@@ -1,7 +1,16 @@
 import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# When set, replaces the wall clock for the current context (e.g. backtests).
+_FROZEN_NOW = ContextVar("frozen_now", default=None)
 
 
 def milliseconds_time_now() -> int:
+    frozen_now = _FROZEN_NOW.get()
+    if frozen_now is not None:
+        return frozen_now
     return int(time.time() * 1000)
 
 
@@ -9,3 +18,13 @@ def date_seconds_diff_to_now(date_in_milliseconds: int) -> int:
     # Diff in milliseconds, divide by 1000 to convert to seconds.
     return (milliseconds_time_now() - date_in_milliseconds) // 1000
 
+
+@contextmanager
+def frozen_time(date_in_milliseconds: int):
+    # Makes milliseconds_time_now return the given date inside the block.
+    # Context variables are per thread, other threads keep the wall clock.
+    token = _FROZEN_NOW.set(date_in_milliseconds)
+    try:
+        yield
+    finally:
+        _FROZEN_NOW.reset(token)
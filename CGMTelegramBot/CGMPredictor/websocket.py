@@ -0,0 +1,180 @@
+import os
+import ssl
+import base64
+import socket
+import struct
+import hashlib
+import threading
+from typing import BinaryIO, Optional
+from urllib.parse import urlsplit
+
+
+# Minimal WebSocket (RFC 6455) over the standard library, enough for the
+# Nightscout socket feed and its local stand-in: text messages, fragmentation,
+# ping/pong and close. Clients mask their frames, servers do not.
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+def accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+
+
+def encode_frame(opcode: int, payload: bytes, mask: bool) -> bytes:
+    length = len(payload)
+    header = bytes((0x80 | opcode,))
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header += bytes((mask_bit | length,))
+    elif length < 1 << 16:
+        header += bytes((mask_bit | 126,)) + struct.pack(">H", length)
+    else:
+        header += bytes((mask_bit | 127,)) + struct.pack(">Q", length)
+
+    if not mask:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + masked(payload, key)
+
+
+def masked(payload: bytes, key: bytes) -> bytes:
+    # XOR with the repeated key, as one big integer operation.
+    repeated = (key * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(payload), "big")
+
+
+def read_exactly(file: BinaryIO, size: int) -> bytes:
+    data = file.read(size)
+    if len(data) < size:
+        raise WebSocketClosed("connection closed")
+    return data
+
+
+def read_frame(file: BinaryIO) -> tuple[bool, int, bytes]:
+    # (fin, opcode, unmasked payload)
+    first, second = read_exactly(file, 2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack(">H", read_exactly(file, 2))[0]
+    elif length == 127:
+        length = struct.unpack(">Q", read_exactly(file, 8))[0]
+
+    key = read_exactly(file, 4) if second & 0x80 else None
+    payload = read_exactly(file, length)
+    if key:
+        payload = masked(payload, key)
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+class WebSocket:
+
+    def __init__(self, sock: socket.socket, file: BinaryIO, mask: bool):
+        self.sock = sock
+        self.file = file
+        self.mask = mask
+        self.send_lock = threading.Lock()  # Sends may come from other threads (e.g. pongs).
+        self.closed = False
+
+
+    @classmethod
+    def connect(cls, url: str, timeout: float, headers: Optional[dict] = None) -> "WebSocket":
+        # url with ws, wss, http or https scheme.
+        parts = urlsplit(url)
+        secure = parts.scheme in ("wss", "https")
+        port = parts.port or (443 if secure else 80)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+
+        sock = socket.create_connection((parts.hostname, port), timeout=timeout)
+        try:
+            if secure:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parts.hostname)
+
+            key = base64.b64encode(os.urandom(16)).decode()
+            lines = [
+                f"GET {path} HTTP/1.1",
+                f"Host: {parts.netloc}",
+                "Upgrade: websocket",
+                "Connection: Upgrade",
+                f"Sec-WebSocket-Key: {key}",
+                "Sec-WebSocket-Version: 13",
+            ] + [f"{name}: {value}" for name, value in (headers or {}).items()]
+            sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
+
+            file = sock.makefile("rb")
+            status = file.readline().decode("latin-1").split()
+            response_headers = {}
+            while True:
+                line = file.readline().decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+
+            if len(status) < 2 or status[1] != "101":
+                raise WebSocketClosed(f"handshake refused: {' '.join(status)}")
+            if response_headers.get("sec-websocket-accept") != accept_key(key):
+                raise WebSocketClosed("handshake with a wrong Sec-WebSocket-Accept")
+        except BaseException:
+            sock.close()
+            raise
+
+        return cls(sock, file, mask=True)
+
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        self.sock.settimeout(timeout)
+
+
+    def __send(self, opcode: int, payload: bytes) -> None:
+        frame = encode_frame(opcode, payload, self.mask)
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+
+    def send_text(self, text: str) -> None:
+        self.__send(OPCODE_TEXT, text.encode())
+
+
+    def recv(self) -> str:
+        # Next text message, answering pings on the way. Raises WebSocketClosed
+        # on close and socket.timeout (an OSError) after the socket timeout.
+        fragments = []
+        while True:
+            fin, opcode, payload = read_frame(self.file)
+            if opcode == OPCODE_PING:
+                self.__send(OPCODE_PONG, payload)
+            elif opcode == OPCODE_PONG:
+                continue
+            elif opcode == OPCODE_CLOSE:
+                self.close()
+                raise WebSocketClosed("closed by the peer")
+            else:
+                fragments.append(payload)
+                if fin:
+                    return b"".join(fragments).decode()
+
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.__send(OPCODE_CLOSE, struct.pack(">H", 1000))
+        except OSError:
+            pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -1,3 +1,3 @@
 
 from CGMTelegramBot.bot import CGMBot
-
+from CGMTelegramBot.patient import PatientConfig
@@ -0,0 +1,145 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable
+
+from telegram.error import TelegramError
+
+from . import settings
+from .logger import get_logger
+from .metrics import TICK_SECONDS
+from .patient import Patient
+
+
+LOGGER = get_logger("bot")
+
+
+class AsyncRuntime:
+
+    # Runs the whole bot on a single asyncio event loop: patient polling, rule
+    # evaluation, Telegram getUpdates (or the webhook) and command handlers. Bot state is only
+    # touched from the loop thread, so handlers and checks never race.
+    #
+    # The HTTP clients of this project (requests and python-telegram-bot 13) are
+    # blocking, their calls are awaited on a fixed size executor. Sends keep going
+    # through the MessageSender queue, so the thread count does not depend on the
+    # amount of patients or users.
+
+    def __init__(self, bot, io_threads: int = settings.ASYNC_IO_THREADS):
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="AsyncIO")
+        self.loop = None
+        self.poll_slots = None
+        self.checks = {}
+
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self.__main())
+        except KeyboardInterrupt:
+            LOGGER.info("AsyncRuntime stopped.")
+
+
+    async def __main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.executor)
+        self.poll_slots = asyncio.Semaphore(settings.POLL_WORKERS)
+
+        if settings.PUSH_ENABLED:
+            for patient in self.bot.patients:
+                self.bot.start_push(patient)
+
+        patients = self.bot.patients
+        step = settings.CHECK_DELAY / max(1, len(patients))
+
+        tasks = [
+            asyncio.create_task(self.__poll_patient(patient, i * step))
+            for i, patient in enumerate(patients)
+        ]
+        if settings.UPDATE_MODE == "webhook":
+            self.bot.start_webhook(self.process_update_threadsafe)
+        else:
+            tasks.append(asyncio.create_task(self.__poll_updates()))
+        await asyncio.gather(*tasks)
+
+
+    async def __poll_patient(self, patient: Patient, delay: float) -> None:
+        await asyncio.sleep(delay)
+        while True:
+            started = self.loop.time()
+            try:
+                await self.check(patient)
+            except Exception as e:
+                LOGGER.exception("AsyncRuntime check of %s failed: %s", patient.name, e)
+            if settings.ADAPTIVE_POLLING:
+                await asyncio.sleep(self.bot.next_poll_delay(patient))
+            else:
+                await asyncio.sleep(max(0.0, settings.CHECK_DELAY - (self.loop.time() - started)))
+
+
+    async def check(self, patient: Patient) -> None:
+        # Concurrent checks of the same patient share the running one.
+        running = self.checks.get(patient)
+        if running is not None:
+            return await asyncio.shield(running)
+
+        task = asyncio.create_task(self.__check(patient))
+        self.checks[patient] = task
+        task.add_done_callback(lambda _: self.checks.pop(patient, None))
+        await asyncio.shield(task)
+
+
+    async def __check(self, patient: Patient) -> None:
+        with TICK_SECONDS.time(patient=patient.name):
+            async with self.poll_slots:
+                polled = int(time.time() * 1000)
+                has_data = await self.loop.run_in_executor(None, patient.analyzer.get_new_data)
+            self.bot.observe_poll(patient, polled, has_data)
+            if has_data:
+                self.bot.process_new_data(patient)
+
+
+    def call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        # From other threads (e.g. the Nightscout push), runs callback on the loop.
+        self.loop.call_soon_threadsafe(callback)
+
+
+    def check_then(self, patient: Patient, callback: Callable[[], None]) -> None:
+        # Used by handlers, which run on the loop thread, to check and continue later.
+        task = asyncio.ensure_future(self.check(patient))
+        task.add_done_callback(lambda _: callback())
+
+
+    def process_update_threadsafe(self, data: dict) -> None:
+        # Called by the webhook worker, waits for the loop so its queue keeps
+        # applying backpressure.
+        future = asyncio.run_coroutine_threadsafe(self.__process_update(data), self.loop)
+        future.result()
+
+
+    async def __process_update(self, data: dict) -> None:
+        self.bot.process_update_json(data)
+
+
+    async def __poll_updates(self) -> None:
+        bot = self.bot.updater.bot
+        dispatcher = self.bot.updater.dispatcher
+        offset = None
+
+        await self.loop.run_in_executor(None, bot.delete_webhook)
+
+        while True:
+            try:
+                updates = await self.loop.run_in_executor(
+                    None, partial(bot.get_updates, offset=offset, timeout=settings.UPDATES_TIMEOUT)
+                )
+            except TelegramError as e:
+                LOGGER.warning("AsyncRuntime get_updates failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                # Handlers run here, on the loop thread.
+                dispatcher.process_update(update)
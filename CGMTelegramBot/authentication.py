@@ -1,35 +1,51 @@
-import os
-import json
+import threading
 from typing import Optional
 
 from telegram import User
 
 from . import utils
-from .logger import LOGGER
+from .logger import get_logger, chat_id as redacted_chat_id
+from .metrics import AUTH_REJECTIONS
+from .storage import Storage, open_storage
+
+
+LOGGER = get_logger("auth")
 
 
 class AuthManager:
 
-    def __init__(self, database_file: str, whitelisted_users: set[str]):
+    def __init__(self, database_file: str, whitelisted_users: set[str], storage: Optional[Storage] = None):
         LOGGER.info("AuthManager __init__")
 
         self.database_file = database_file
         self.whitelisted_users = whitelisted_users
+        self.storage = storage or open_storage(database_file)
+
+        # Loaded on first use and kept in sync with every write.
+        self._username_chat_id_pair = None
+        self.lock = threading.Lock()
 
-        self.username_chat_id_pair = self.load_database()
+
+    @property
+    def username_chat_id_pair(self) -> dict[str, int]:
+        if self._username_chat_id_pair is None:
+            with self.lock:
+                if self._username_chat_id_pair is None:
+                    self._username_chat_id_pair = self.load_database()
+        return self._username_chat_id_pair
 
 
     def is_user_authorized(self, user: Optional[User]) -> bool:
-        LOGGER.info(f"AuthManager is_user_authorized {user=}")
+        LOGGER.debug("AuthManager is_user_authorized username=%s", utils.username_from_user(user))
 
-        if user is None:
-            return False
-        username = utils.username_from_user(user)
-        return self.is_username_authorized(username)
+        authorized = user is not None and self.is_username_authorized(utils.username_from_user(user))
+        if not authorized:
+            AUTH_REJECTIONS.inc()
+        return authorized
 
 
     def is_username_authorized(self, username: Optional[str]) -> bool:
-        LOGGER.info(f"AuthManager is_username_authorized {username=}")
+        LOGGER.debug("AuthManager is_username_authorized username=%s", username)
 
         # Just to be safe, explicit refuse None
         if username is None:
@@ -38,18 +54,19 @@ class AuthManager:
 
 
     def set_user_chat_id(self, username: str, chat_id: int) -> None:
-        LOGGER.info(f"AuthManager set_user_chat_id {username=} {chat_id=}")
+        LOGGER.info("AuthManager set_user_chat_id username=%s chat_id=%s", username, redacted_chat_id(chat_id))
 
         if username in self.username_chat_id_pair or self.is_username_authorized(username):
+            # Only this subscriber is written, not the whole database.
+            self.storage.set_chat_id(username, chat_id)
             self.username_chat_id_pair[username] = chat_id
-            self.save_database()
         else:
             # TODO: log not authorized users trying to access.
             pass
 
 
     def chat_id_for_username(self, username: str) -> Optional[int]:
-        LOGGER.info(f"AuthManager chat_id_for_username {username=}")
+        LOGGER.debug("AuthManager chat_id_for_username username=%s", username)
 
         if username in self.username_chat_id_pair:
             return int(self.username_chat_id_pair[username])
@@ -57,30 +74,15 @@ class AuthManager:
 
 
     def load_database(self) -> dict[str, int]:
-        LOGGER.info(f"AuthManager load_database")
-
-        if os.path.isfile(self.database_file):
-            with open(self.database_file, "r") as file:
-                data = json.loads(file.read())
-
-                # Removes not auth users.
-                data = {
-                    username: chat_id for username, chat_id in data.items()
-                    if self.is_username_authorized(username)
-                }
-
-                return data
-        else:
-            return dict()
-
-
-    def save_database(self) -> None:
-        LOGGER.info(f"AuthManager save_database")
+        LOGGER.info("AuthManager load_database")
 
-        with open(self.database_file, "w") as file:
-            json.dump(self.username_chat_id_pair, file, indent=4)
+        # Removes not auth users.
+        return {
+            username: chat_id for username, chat_id in self.storage.items()
+            if self.is_username_authorized(username)
+        }
 
 
     def items(self):
-        LOGGER.info(f"AuthManager items")
+        LOGGER.debug("AuthManager items")
         return self.username_chat_id_pair.items()
@@ -1,29 +1,40 @@
+from concurrent.futures import Future
 from typing import Any
 
-from telegram import User
+from telegram import ParseMode, Update, User
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 
+from . import settings
 from .authentication import AuthManager
-from .logger import LOGGER
+from .logger import get_logger, chat_id as redacted_chat_id, message_text
+from .metrics import SEND_QUEUE_DEPTH
+from .sender import DeliveryResult, MessageSender, log_delivery
 from .userdata import UserDataManager
+from .webhook import WebhookServer
 
 
 
+LOGGER = get_logger("bot")
+
+
 class BaseBot:
 
     def __init__(self, token: str, database_file: str, whitelisted_users: set[str]):
-        LOGGER.info(f"BaseBot __init__")
+        LOGGER.info("BaseBot __init__")
 
         self.token = token
         self.auth_manager = AuthManager(database_file, whitelisted_users)
-        self.userDataManager = UserDataManager()
+        self.userDataManager = UserDataManager(self.auth_manager.storage)
 
         # Create the Updater and pass it your bot's token.
-        self.updater = Updater(self.token)
+        self.updater = Updater(self.token, base_url=settings.TELEGRAM_BASE_URL)
+        self.sender = MessageSender(self.updater.bot.send_message)
+        SEND_QUEUE_DEPTH.set_function(lambda: self.sender.pending)
+        self.webhook = None
 
 
     def authenticate_user(self, user: User, chat_id: int):
-        LOGGER.info(f"BaseBot authenticate_user {user=} {chat_id=}")
+        LOGGER.info("BaseBot authenticate_user username=%s chat_id=%s", user.username, redacted_chat_id(chat_id))
 
         username = user.username
 
@@ -35,31 +46,61 @@ class BaseBot:
 
 
     def is_user_authenticate(self, user: User):
-        LOGGER.info(f"BaseBot is_user_authenticate {user=}")
+        LOGGER.debug("BaseBot is_user_authenticate username=%s", user.username if user else None)
 
         self.auth_manager.is_user_authorized(user)
 
 
-    def send_message_to_chat_id(self, chat_id: int, message: str) -> None:
-        LOGGER.info(f"BaseBot send_message_to_chat_id {chat_id=} {message=}")
+    def send_message_to_chat_id(self, chat_id: int, message: str) -> "Future[DeliveryResult]":
+        LOGGER.info("BaseBot send_message_to_chat_id chat_id=%s message=%r", redacted_chat_id(chat_id), message_text(message))
+
+        future = self.sender.send(chat_id, message)
+        future.add_done_callback(log_delivery)
+        return future
+
+
+    def send_message_to_chat_ids(self, chat_ids: [int], message: str) -> ["Future[DeliveryResult]"]:
+        LOGGER.info("BaseBot send_message_to_chat_ids chats=%d message=%r", len(chat_ids), message_text(message))
+
+        futures = self.sender.send_many(chat_ids, message)
+        for future in futures:
+            future.add_done_callback(log_delivery)
+        return futures
+
 
-        self.updater.bot.send_message(chat_id, message)
+    def reply(self, update: Update, message: str, markdown: bool = False) -> "Future[DeliveryResult]":
+        # Replies go through the send queue as well, handlers never block on them.
+        LOGGER.info("BaseBot reply chat_id=%s message=%r", redacted_chat_id(update.effective_chat.id), message_text(message))
+
+        kwargs = {"parse_mode": ParseMode.MARKDOWN_V2} if markdown else {}
+        future = self.sender.send(update.effective_chat.id, message, **kwargs)
+        future.add_done_callback(log_delivery)
+        return future
+
+
+    def reply_photo(self, update: Update, photo: bytes, caption: str = "") -> "Future[DeliveryResult]":
+        LOGGER.info("BaseBot reply_photo chat_id=%s bytes=%d", redacted_chat_id(update.effective_chat.id), len(photo))
+
+        future = self.sender.send(
+            update.effective_chat.id, photo, send_function=self.updater.bot.send_photo, caption=caption
+        )
+        future.add_done_callback(log_delivery)
+        return future
 
 
     def send_message_to_username(self, username: str, message: str) -> None:
-        LOGGER.info(f"BaseBot send_message_to_username {username=} {message=}")
+        LOGGER.info("BaseBot send_message_to_username username=%s message=%r", username, message_text(message))
 
         chat_id = self.auth_manager.chat_id_for_username(username)
         if chat_id:
-            self.updater.bot.send_message(chat_id, message)
+            self.send_message_to_chat_id(chat_id, message)
         else:
-            LOGGER.warning(f"ChatId for username {username} not found.")
+            LOGGER.warning("ChatId for username %s not found.", username)
 
 
-    def base_run(self, handlers: [(str, Any)], text_handler: Any) -> None:
-        LOGGER.info(f"BaseBot base_run")
+    def register_handlers(self, handlers: [(str, Any)], text_handler: Any) -> None:
+        LOGGER.info("BaseBot register_handlers")
 
-        # Register handlers
         dispatcher = self.updater.dispatcher
 
         for command, func_handler in handlers:
@@ -69,6 +110,43 @@ class BaseBot:
         # on non command i.e message - echo the message on Telegram
         dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, text_handler))
 
+
+    def start_webhook(self, process_update) -> WebhookServer:
+        LOGGER.info("BaseBot start_webhook")
+
+        self.webhook = WebhookServer(process_update)
+
+        if settings.WEBHOOK_URL:
+            # secret_token is newer than this python-telegram-bot, sent as an extra argument.
+            api_kwargs = {"secret_token": settings.WEBHOOK_SECRET_TOKEN} if settings.WEBHOOK_SECRET_TOKEN else None
+            self.updater.bot.set_webhook(
+                settings.WEBHOOK_URL,
+                max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+                api_kwargs=api_kwargs,
+            )
+
+        self.webhook.start()
+        return self.webhook
+
+
+    def process_update_json(self, data: dict) -> None:
+        self.updater.dispatcher.process_update(Update.de_json(data, self.updater.bot))
+
+
+    def base_run(self, handlers: [(str, Any)], text_handler: Any) -> None:
+        LOGGER.info("BaseBot base_run")
+
+        # Register handlers
+        self.register_handlers(handlers, text_handler)
+
+        if settings.UPDATE_MODE == "webhook":
+            self.start_webhook(self.process_update_json)
+            try:
+                self.webhook.server_thread.join()
+            except KeyboardInterrupt:
+                self.webhook.stop()
+            return
+
         # Start the Bot
         self.updater.start_polling()
 
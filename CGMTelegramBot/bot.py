@@ -1,24 +1,38 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from telegram import Update
 from telegram.ext import CallbackContext
 
 from . import utils
 from . import settings
-from .timer import RepeatedTimer
+from . import metrics
+from .scheduler import PollScheduler
+from .async_runtime import AsyncRuntime
 from .basebot import BaseBot
-from .logger import LOGGER
+from .charts import ChartService
+from .CGMPredictor.history import ReadingStore
+from .CGMPredictor.push import NightscoutPush
+from .CGMPredictor.mongo_connection import MongoConnection, MongoWatch
+from .CGMPredictor.statistics import statistics_message
+from .logger import get_logger, glucose
+from .patient import Patient, PatientConfig
 
-from CGMTelegramBot.CGMPredictor import Analyzer
+
+LOGGER = get_logger("bot")
+POLL_LOGGER = get_logger("poll")
 
 
 def commands_helper_str(only_mute=False):
-    LOGGER.info(f"commands_helper_str {only_mute=}")
+    LOGGER.debug("commands_helper_str only_mute=%s", only_mute)
 
     other_helps = [
         "/start  -  Refaz a autenticação do usuário.",
         "/g  -  Mostra a glicose atual.",
         "/glicose  -  Mostra a glicose atual.",
+        "/estatisticas  -  Mostra tempo no alvo, média, GMI e variabilidade.",
+        "/grafico  -  Mostra o gráfico das últimas horas, ex: /grafico 12.",
     ]
 
     mute_help = [
@@ -40,23 +54,59 @@ def commands_helper_str(only_mute=False):
 
 class CGMBot(BaseBot):
 
-    def __init__(self, token: str, url: str, secret: str, database_file: str, whitelisted_users: set[str]):
-        LOGGER.info(f"CGMBot __init__")
+    def __init__(self, token: str, url: Optional[str] = None, secret: Optional[str] = None,
+                 database_file: str = "mgb_database.json", whitelisted_users: Optional[set[str]] = None,
+                 patients: Optional[list[PatientConfig]] = None):
+        LOGGER.info("CGMBot __init__")
+
+        # A single patient can still be given by url, secret and whitelisted_users.
+        if patients is None:
+            patients = [PatientConfig("", url, secret, whitelisted_users)]
+
+        all_users = set().union(*(config.whitelisted_users for config in patients))
+        super().__init__(token, database_file, all_users)
+
+        # Requests of all patients share one pool, instead of a pool per patient.
+        self.fetch_executor = ThreadPoolExecutor(
+            max_workers=settings.POLL_WORKERS * 2, thread_name_prefix="Fetch"
+        )
+        # Readings of all patients are kept in one store, by patient name.
+        self.history = ReadingStore(settings.HISTORY_FILE) if settings.HISTORY_FILE else None
+        self.patients = [Patient(config, self.fetch_executor, self.history) for config in patients]
+        self.charts = ChartService()
+        self.scheduler = None
+        self.runtime = None
+        self.metrics_server = None
+        metrics.READING_AGE.set_function(self.reading_ages)
+
+
+    def reading_ages(self) -> dict[tuple, float]:
+        now = time.time()
+        ages = {}
+        for patient in self.patients:
+            data = patient.analyzer.data
+            if data is not None and data.newest_measure_date is not None:
+                ages[(patient.name,)] = now - data.newest_measure_date / 1000
+        return ages
+
 
-        super().__init__(token, database_file, whitelisted_users)
+    def patients_followed_by(self, username: Optional[str]) -> list[Patient]:
+        return [patient for patient in self.patients if patient.is_followed_by(username)]
 
-        self.analyzer = Analyzer(url, secret)
-        self.repeating_check = None
-        self.previous_measure = None
 
-        self.rule_mute_until_time = 0
+    def patient_message(self, patient: Patient, message: str) -> str:
+        # With many patients, messages tell which patient they are about.
+        if len(self.patients) > 1:
+            return f"{patient.name}\n{message}"
+        return message
 
 
     def mute_for(self, update: Update, context: CallbackContext, minutes: int):
-        LOGGER.info(f"CGMBot mute_for username={update.effective_user.username} {minutes=}")
+        LOGGER.info("CGMBot mute_for username=%s minutes=%d", update.effective_user.username, minutes)
 
         if not self.auth_manager.is_user_authorized(update.effective_user):
-            update.message.reply_text(
+            self.reply(
+                update,
                 f"Lamentamos, não foi possível silenciar.\n{commands_helper_str(only_mute=True)}"
             )
             return
@@ -66,55 +116,143 @@ class CGMBot(BaseBot):
             self.userDataManager.init_username(username)
 
         self.userDataManager.silence_username_for_minutes(username, minutes)
-        update.message.reply_text(
+        metrics.MUTES.inc()
+        self.reply(
+            update,
             f"Voltaremos a avisar em {minutes} minutos.\n{commands_helper_str(only_mute=True)}"
         )
 
 
-    def periodic_check_function(self) -> None:
-        LOGGER.info(f"CGMBot periodic_check_function")
-        if self.analyzer.get_new_data():
-            self.check_last_reading()
-            self.check_rules()
+    def periodic_check_function(self, patient: Patient) -> None:
+        POLL_LOGGER.info("CGMBot periodic_check_function patient=%s", patient.name)
+        with patient.lock, metrics.TICK_SECONDS.time(patient=patient.name):
+            polled = int(time.time() * 1000)
+            has_data = patient.analyzer.get_new_data()
+            self.observe_poll(patient, polled, has_data)
+            if has_data:
+                self.process_new_data(patient)
+
+
+    def observe_poll(self, patient: Patient, polled: int, has_data: bool) -> None:
+        # Feeds the reading cadence, which plans the next poll of the patient.
+        detection = patient.cadence.observe(polled, patient.analyzer.data if has_data else None)
+        if detection is not None:
+            metrics.DETECTION_SECONDS.observe(detection, patient=patient.name)
+
+
+    def next_poll_delay(self, patient: Patient) -> float:
+        # While the socket pushes the readings, polls only back it up.
+        if patient.push is not None and patient.push.connected:
+            return settings.PUSH_POLL_INTERVAL
+        return patient.cadence.next_delay()
+
+
+    def start_push(self, patient: Patient) -> None:
+        connection = patient.analyzer.connection
+        on_data = lambda columns, treatments: self.on_push(patient, columns, treatments)
+        on_connect = lambda: self.on_push_connected(patient)
+        if isinstance(connection, MongoConnection):
+            patient.push = MongoWatch(connection, on_data, on_connect, name=patient.name)
+        else:
+            patient.push = NightscoutPush(
+                connection.url, connection.secret, on_data, on_connect, name=patient.name
+            )
+        patient.push.start()
+
+
+    def on_push_connected(self, patient: Patient) -> None:
+        # Fills the gap since the newest reading held through REST, the socket
+        # only sends what arrives from now on.
+        if self.runtime:
+            self.runtime.call_soon_threadsafe(lambda: self.runtime.check_then(patient, lambda: None))
+        else:
+            self.periodic_check_function(patient)
+
+
+    def on_push(self, patient: Patient, columns: tuple, treatments: list) -> None:
+        # Called on the push thread of the patient.
+        if self.runtime:
+            self.runtime.call_soon_threadsafe(lambda: self.process_push(patient, columns, treatments))
+        else:
+            with patient.lock:
+                self.process_push(patient, columns, treatments)
+
 
+    def process_push(self, patient: Patient, columns: tuple, treatments: list) -> None:
+        POLL_LOGGER.info("CGMBot process_push patient=%s readings=%d", patient.name, len(columns[0]))
+        received = int(time.time() * 1000)
+        if patient.analyzer.add_pushed(columns, treatments):
+            self.observe_poll(patient, received, True)
+            self.process_new_data(patient)
 
-    def check_last_reading(self) -> None:
-        LOGGER.info(f"CGMBot check_last_reading")
 
-        latest_measure = self.analyzer.latest_measure()
+    def process_new_data(self, patient: Patient) -> None:
+        self.check_last_reading(patient)
+        self.check_rules(patient)
 
-        if latest_measure != self.previous_measure:
-            self.previous_measure = latest_measure
+
+    def check_then(self, patient: Patient, callback) -> None:
+        # With the asyncio runtime the check is awaited on the loop instead.
+        if self.runtime:
+            self.runtime.check_then(patient, callback)
+        else:
+            self.periodic_check_function(patient)
+            callback()
+
+
+    def check_last_reading(self, patient: Patient) -> None:
+        POLL_LOGGER.info("CGMBot check_last_reading patient=%s", patient.name)
+
+        latest_measure = patient.analyzer.latest_measure()
+
+        if latest_measure != patient.previous_measure:
+            patient.previous_measure = latest_measure
+            POLL_LOGGER.info(
+                "CGMBot new reading patient=%s sgv=%s direction=%s",
+                patient.name, glucose(latest_measure.sgv), latest_measure.direction
+            )
 
             if latest_measure.triggers_alert():
                 # Message users
                 report_message = latest_measure.message()
                 message = f"{report_message}\n{commands_helper_str(only_mute=True)}"
-                self.alert_all_users(message)
+                metrics.ALERTS.inc(rule="reading")
+                self.alert_all_users(patient, message)
 
 
-    def check_rules(self) -> None:
-        LOGGER.info(f"CGMBot check_rules")
-        message = self.analyzer.rules_message()
+    def check_rules(self, patient: Patient) -> None:
+        POLL_LOGGER.info("CGMBot check_rules patient=%s", patient.name)
+        match = patient.analyzer.matching_rule()
         now = time.time()
-        if message and self.rule_mute_until_time < now:
-            self.alert_all_users(message, override_mute=True)
-            self.rule_mute_until_time = now + settings.MUTE_RULE_DURATION
+        if match and patient.rule_mute_until_time < now:
+            rule, result = match
+            LOGGER.info(
+                "CGMBot rule matched patient=%s rule=%s sgv=%s",
+                patient.name, rule.__name__, glucose(patient.analyzer.latest_measure().sgv)
+            )
+            metrics.ALERTS.inc(rule=rule.__name__)
+            self.alert_all_users(patient, result.message, override_mute=True)
+            patient.rule_mute_until_time = now + settings.MUTE_RULE_DURATION
 
 
-    def alert_all_users(self, message, override_mute=False):
-        LOGGER.info(f"CGMBot alert_all_users")
+    def alert_all_users(self, patient: Patient, message, override_mute=False):
+        LOGGER.info("CGMBot alert_all_users patient=%s", patient.name)
 
-        for username, chat_id in self.auth_manager.items():
-            if override_mute or not self.userDataManager.is_username_silenced(username):
-                self.send_message_to_chat_id(chat_id, message)
+        message = self.patient_message(patient, message)
+        chat_ids = [
+            chat_id for username, chat_id in self.auth_manager.items()
+            if patient.is_followed_by(username) and (override_mute or not self.userDataManager.is_muted(username))
+        ]
+
+        # Queued, not awaited, the results are logged per message.
+        return self.send_message_to_chat_ids(chat_ids, message)
 
 
     # Start commands handlers
 
 
     def cmd_start(self, update: Update, context: CallbackContext) -> None:
-        LOGGER.info(f"CGMBot cmd_start username={update.effective_user.username}")
+        LOGGER.info("CGMBot cmd_start username=%s", update.effective_user.username)
         # Send a message when the command /start is issued.
 
         user = update.effective_user
@@ -124,35 +262,95 @@ class CGMBot(BaseBot):
         if is_auth:
             self.authenticate_user(user, update.effective_message.chat_id)
 
-        update.message.reply_markdown_v2(message)
+        self.reply(update, message, markdown=True)
 
 
     def cmd_text(self, update: Update, context: CallbackContext) -> None:
-        LOGGER.info(f"CGMBot cmd_text username={update.effective_user.username}")
+        LOGGER.info("CGMBot cmd_text username=%s", update.effective_user.username)
         if not self.auth_manager.is_user_authorized(update.effective_user):
             return
 
-        update.message.reply_text(
+        self.reply(
+            update,
             f"Não há comandos com essas palavras.\n{commands_helper_str()}"
         )
 
 
     def cmd_glucose(self, update: Update, context: CallbackContext) -> None:
-        LOGGER.info(f"CGMBot cmd_glucose username={update.effective_user.username}")
+        LOGGER.info("CGMBot cmd_glucose username=%s", update.effective_user.username)
 
         if not self.auth_manager.is_user_authorized(update.effective_user):
             return
 
-        if not self.previous_measure:
-            self.periodic_check_function()
+        def reply_glucose(patient: Patient):
+            if patient.previous_measure:
+                message = patient.previous_measure.message()
+                self.reply(update, self.patient_message(patient, message))
+            else:
+                self.reply(update, self.patient_message(
+                    patient, f"Lamentamos, mas não encontramos a última aferição.\n{commands_helper_str()}"
+                ))
 
-        if self.previous_measure:
-            message = self.previous_measure.message()
-            update.message.reply_text(message)
-        else:
-            update.message.reply_text(
-                f"Lamentamos, mas não encontramos a última aferição.\n{commands_helper_str()}"
-            )
+        for patient in self.patients_followed_by(update.effective_user.username):
+            if patient.previous_measure:
+                reply_glucose(patient)
+            else:
+                self.check_then(patient, lambda patient=patient: reply_glucose(patient))
+
+
+    def cmd_statistics(self, update: Update, context: CallbackContext) -> None:
+        LOGGER.info("CGMBot cmd_statistics username=%s", update.effective_user.username)
+
+        if not self.auth_manager.is_user_authorized(update.effective_user):
+            return
+
+        # Aggregates are kept up to date by the checks, nothing is recomputed here.
+        for patient in self.patients_followed_by(update.effective_user.username):
+            message = statistics_message(patient.analyzer.statistics.statistics())
+            self.reply(update, self.patient_message(patient, message))
+
+
+    def cmd_chart(self, update: Update, context: CallbackContext) -> None:
+        LOGGER.info("CGMBot cmd_chart username=%s args=%s", update.effective_user.username, context.args)
+
+        if not self.auth_manager.is_user_authorized(update.effective_user):
+            return
+
+        hours = settings.CHART_DEFAULT_HOURS
+        if context.args:
+            try:
+                hours = min(max(int(context.args[0]), 1), settings.CHART_MAX_HOURS)
+            except ValueError:
+                self.reply(update, f"Use /grafico seguido das horas, de 1 a {settings.CHART_MAX_HOURS}.")
+                return
+
+        def reply_chart(patient: Patient):
+            future = self.charts.chart(patient, hours)
+            if future is None:
+                self.reply(update, self.patient_message(
+                    patient, f"Lamentamos, mas não encontramos aferições.\n{commands_helper_str()}"
+                ))
+                return
+
+            # Replied from the render callback, the handler does not wait on it.
+            caption = self.patient_message(patient, f"Últimas {hours} horas")
+            future.add_done_callback(lambda done: self.__reply_rendered(update, patient, done, caption))
+
+        for patient in self.patients_followed_by(update.effective_user.username):
+            if patient.analyzer.data is not None:
+                reply_chart(patient)
+            else:
+                self.check_then(patient, lambda patient=patient: reply_chart(patient))
+
+
+    def __reply_rendered(self, update: Update, patient: Patient, future, caption: str) -> None:
+        try:
+            photo = future.result()
+        except Exception as e:
+            LOGGER.warning("Chart of patient=%s failed: %r", patient.name, e)
+            self.reply(update, self.patient_message(patient, "Lamentamos, não foi possível gerar o gráfico."))
+            return
+        self.reply_photo(update, photo, caption)
 
 
     def wrapper_cmd_mute_for(self, time: int):
@@ -163,7 +361,7 @@ class CGMBot(BaseBot):
 
 
     def cmd_unmute(self, update: Update, context: CallbackContext) -> None:
-        LOGGER.info(f"CGMBot cmd_unmute username={update.effective_user.username}")
+        LOGGER.info("CGMBot cmd_unmute username=%s", update.effective_user.username)
 
         if not self.auth_manager.is_user_authorized(update.effective_user):
             return
@@ -171,11 +369,13 @@ class CGMBot(BaseBot):
         username = update.effective_user.username
         if self.userDataManager.is_username_silenced(username):
             self.userDataManager.unmute_username(username)
-            update.message.reply_text(
+            self.reply(
+                update,
                 f"Silenciado removido.\n{commands_helper_str(only_mute=True)}"
             )
         else:
-            update.message.reply_text(
+            self.reply(
+                update,
                 f"Você não aparenta estar silenciado.\n{commands_helper_str(only_mute=True)}"
             )
 
@@ -183,16 +383,13 @@ class CGMBot(BaseBot):
     # End command handlers
 
 
-    def run(self) -> None:
-        LOGGER.info(f"CGMBot run")
-
-        # Set it up to check every X seconds
-        self.repeating_check = RepeatedTimer(settings.CHECK_DELAY, self.periodic_check_function)
-
-        handlers = [
+    def handlers(self) -> [(str, object)]:
+        return [
             ("start", self.cmd_start),
             ("g", self.cmd_glucose),
             ("glicose", self.cmd_glucose),
+            ("estatisticas", self.cmd_statistics),
+            ("grafico", self.cmd_chart),
             ("silencia20", self.wrapper_cmd_mute_for(20 - 1)),
             ("silencia40", self.wrapper_cmd_mute_for(40 - 1)),
             ("silencia60", self.wrapper_cmd_mute_for(60 - 1)),
@@ -200,4 +397,43 @@ class CGMBot(BaseBot):
             ("remover_silenciar", self.cmd_unmute)
         ]
 
+
+    def run(self) -> None:
+        LOGGER.info("CGMBot run")
+
+        if settings.METRICS_PORT is not None:
+            self.metrics_server = metrics.MetricsServer()
+            self.metrics_server.start()
+
+        handlers = self.handlers()
+
+        if settings.RUNTIME == "asyncio":
+            self.register_handlers(handlers, self.cmd_text)
+            self.runtime = AsyncRuntime(self)
+            self.runtime.run()
+            return
+
+        # Set it up to check every X seconds, patients start spread over the delay.
+        # With adaptive polling every patient then follows its reading cadence.
+        self.scheduler = PollScheduler(settings.POLL_WORKERS)
+        if settings.ADAPTIVE_POLLING:
+            step = settings.CHECK_DELAY / max(1, len(self.patients))
+            for i, patient in enumerate(self.patients):
+                self.scheduler.add_adaptive(
+                    self.periodic_check_function, settings.CHECK_DELAY,
+                    lambda patient=patient: self.next_poll_delay(patient), patient,
+                    delay=i * step
+                )
+        else:
+            self.scheduler.add_staggered(
+                [(self.periodic_check_function, (patient,)) for patient in self.patients],
+                settings.CHECK_DELAY
+            )
+        self.scheduler.start()
+
+        # The asyncio runtime starts them once its loop runs.
+        if settings.PUSH_ENABLED:
+            for patient in self.patients:
+                self.start_push(patient)
+
         self.base_run(handlers, self.cmd_text)
@@ -0,0 +1,91 @@
+import time
+from collections import deque
+from typing import Optional
+
+from . import settings
+from .CGMPredictor.analyzer_data import AnalyzerData
+
+
+class ReadingCadence:
+
+    # Learns when the next reading of a patient becomes visible upstream, so
+    # the poll happens right after it instead of every CHECK_DELAY.
+    #
+    # The interval is the median spacing of the readings held. The upload lag
+    # (reading date to visible in Nightscout, in our clock so uploader clock
+    # skew is included) is estimated by every poll that finds a new reading:
+    # it became visible between the previous poll and this one. A low quantile
+    # of the recent lags is used, so most polls land just after the upload and
+    # the rest are caught by the short retries.
+    #
+    # When a reading is due and missing, polls retry every CADENCE_RETRY,
+    # backing off after CADENCE_FAST_RETRIES. Without readings for
+    # CADENCE_SIGNAL_LOSS (signal loss, see rule_no_new_data) polls slow down
+    # to CADENCE_LOST_INTERVAL.
+
+    def __init__(self):
+        self.interval = 5 * 60 * 1000  # in milliseconds, until learned
+        self.newest_date = None
+        self.last_poll = None  # in milliseconds
+        self.lags = deque(maxlen=settings.CADENCE_LAGS)  # in milliseconds
+        self.misses = 0  # Polls that found nothing since the next reading was due.
+
+
+    def observe(self, polled: int, data: Optional[AnalyzerData]) -> Optional[float]:
+        # After a poll started at `polled` (milliseconds), with the analyzer data
+        # if the fetch succeeded. Returns the seconds from the new reading date
+        # to its detection, None without a new reading.
+        last_poll, self.last_poll = self.last_poll, polled
+        if data is None or data.newest_measure_date is None:
+            return None
+
+        elapsed = sorted(data.measures_seconds_elapsed)
+        if elapsed:
+            median = elapsed[len(elapsed) // 2] * 1000
+            self.interval = min(max(median, 60 * 1000), 15 * 60 * 1000)
+
+        newest = data.newest_measure_date
+        if newest == self.newest_date:
+            if polled >= self.due():
+                self.misses += 1
+            return None
+
+        is_first = self.newest_date is None
+        self.newest_date = newest
+        self.misses = 0
+
+        # Only polls close enough to each other bound the lag well.
+        if not is_first and last_poll is not None and polled - last_poll <= settings.CHECK_DELAY * 1000:
+            visible_after = max(last_poll, newest)
+            self.lags.append(max(0, (visible_after + polled) // 2 - newest))
+
+        return (polled - newest) / 1000 if not is_first else None
+
+
+    def lag(self) -> int:
+        if not self.lags:
+            return 0
+        lags = sorted(self.lags)
+        return lags[int(settings.CADENCE_LAG_QUANTILE * (len(lags) - 1))]
+
+
+    def due(self) -> float:
+        # When the reading after the newest should be visible, in milliseconds.
+        return self.newest_date + self.interval + self.lag()
+
+
+    def next_delay(self, now: Optional[float] = None) -> float:
+        # Seconds until the next poll.
+        now = time.time() * 1000 if now is None else now
+        if self.newest_date is None:
+            return settings.CHECK_DELAY
+
+        if now - self.newest_date >= settings.CADENCE_SIGNAL_LOSS * 1000:
+            return settings.CADENCE_LOST_INTERVAL
+
+        due = self.due()
+        if due > now:
+            return min(due - now, self.interval) / 1000
+
+        backoff = 2 ** max(0, self.misses - settings.CADENCE_FAST_RETRIES)
+        return min(settings.CADENCE_RETRY * backoff, settings.CHECK_DELAY)
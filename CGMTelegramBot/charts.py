@@ -0,0 +1,154 @@
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Hashable, Optional
+
+from . import settings
+from .logger import get_logger
+from .metrics import CHART_CACHE_HITS, CHART_RENDERS
+from .patient import Patient
+from .CGMPredictor.chart import render_chart
+
+
+LOGGER = get_logger("bot")
+
+HOUR_IN_MILLISECONDS = 60 * 60 * 1000
+READING_INTERVAL = 5 * 60 * 1000  # in milliseconds
+
+
+class ChartCache:
+
+    # LRU of chart futures, bounded by the bytes of the rendered charts. A key
+    # requested while its chart is still rendering gets the same future, so a
+    # burst of requests costs a single render. Failed renders are not kept.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, Future]" = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+
+    def cached(self, key: Hashable) -> Optional[Future]:
+        with self.lock:
+            return self.__cached(key)
+
+
+    def get(self, key: Hashable, render: Callable[[], Future]) -> Future:
+        # render is called with the lock held, it should only submit the work.
+        with self.lock:
+            future = self.__cached(key)
+            if future is not None:
+                return future
+
+            future = render()
+            self.entries[key] = future
+
+        future.add_done_callback(lambda done: self.__rendered(key, done))
+        return future
+
+
+    def __cached(self, key: Hashable) -> Optional[Future]:
+        future = self.entries.get(key)
+        if future is not None:
+            self.entries.move_to_end(key)
+            CHART_CACHE_HITS.inc()
+        return future
+
+
+    def __rendered(self, key: Hashable, future: Future) -> None:
+        with self.lock:
+            if self.entries.get(key) is not future:
+                return
+
+            if future.cancelled() or future.exception() is not None:
+                del self.entries[key]
+                return
+
+            size = len(future.result())
+            self.sizes[key] = size
+            self.total_bytes += size
+
+            # Evicts the least recently used rendered charts.
+            for old_key in list(self.entries):
+                if self.total_bytes <= self.max_bytes or old_key == key:
+                    break
+                if old_key in self.sizes:
+                    del self.entries[old_key]
+                    self.total_bytes -= self.sizes.pop(old_key)
+
+
+
+class ChartService:
+
+    # Charts are rendered on a process pool, so the dispatcher threads (or the
+    # event loop) never run the CPU heavy part. The pool is started on first use,
+    # spawning its workers since forking would copy the state of the running
+    # threads (logging, sender, scheduler) into them.
+
+    def __init__(self, workers: int = settings.CHART_WORKERS, cache_bytes: int = settings.CHART_CACHE_BYTES):
+        self.workers = workers
+        self.cache = ChartCache(cache_bytes)
+        self.executor = None
+        self.executor_lock = threading.Lock()
+
+
+    def __executor(self) -> ProcessPoolExecutor:
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.executor
+
+
+    def chart(self, patient: Patient, hours: int) -> Optional["Future[bytes]"]:
+        # PNG of the `hours` before the newest reading, None without readings.
+        # The newest reading date is part of the key, so charts are rendered
+        # again only when there is a new reading.
+        data = patient.analyzer.data
+        if data is None or data.newest_measure_date is None:
+            return None
+
+        newest = data.newest_measure_date
+        key = (patient.name, hours, newest)
+        future = self.cache.cached(key)
+        if future is not None:
+            return future
+
+        # The history is read before taking the cache lock, concurrent requests
+        # may both read it but only the first submits a render.
+        arguments = self.__render_arguments(patient, hours, newest)
+        return self.cache.get(key, lambda: self.__render(arguments))
+
+
+    def __render_arguments(self, patient: Patient, hours: int, newest: int) -> tuple:
+        end = newest + READING_INTERVAL
+        start = end - hours * HOUR_IN_MILLISECONDS
+
+        # Longer than the analyzer window only with a history store.
+        data = patient.analyzer.history_window(start, end) or patient.analyzer.data
+        first = next((i for i, date in enumerate(data.dates) if date >= start), len(data.dates))
+
+        return (
+            list(data.dates[first:]),
+            list(data.sgvs[first:]),
+            [t.date for t in data.carbs if start <= t.date < end],
+            [t.date for t in data.insulin if start <= t.date < end],
+            start,
+            end,
+            settings.LIMIT_LOW,
+            settings.LIMIT_HIGH,
+        )
+
+
+    def __render(self, arguments: tuple) -> Future:
+        CHART_RENDERS.inc()
+        return self.__executor().submit(render_chart, *arguments)
+
+
+    def stop(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,11 +1,135 @@
 
+import sys
+import json
+import queue
+import atexit
 import logging
+import itertools
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
+from . import settings
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+
+# Records are put on a queue by the logging threads and written to stderr by a
+# listener thread, so polls and sends never wait on I/O. Call sites pass their
+# arguments unformatted (LOGGER.info("... %s", value)), they are only formatted
+# when the record is emitted.
+
+
+STANDARD_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class Redacted:
+
+    # Wraps a sensitive value, rendered as <kind> when LOG_REDACT is on.
+
+    __slots__ = ("value", "kind")
+
+    def __init__(self, value, kind: str):
+        self.value = value
+        self.kind = kind
+
+    def __str__(self) -> str:
+        return f"<{self.kind}>" if settings.LOG_REDACT else str(self.value)
+
+    def __repr__(self) -> str:
+        return f"<{self.kind}>" if settings.LOG_REDACT else repr(self.value)
+
+
+def chat_id(value) -> Redacted:
+    return Redacted(value, "chat_id")
+
+
+def glucose(value) -> Redacted:
+    return Redacted(value, "glucose")
+
+
+def message_text(value) -> Redacted:
+    return Redacted(value, "message")
+
+
+class AsyncQueueHandler(QueueHandler):
+
+    # The stock QueueHandler formats the message in the calling thread. Records
+    # stay in this process, so formatting is left to the listener thread.
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                data[key] = str(value)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+
+    # Lets 1 in `every` records of each call site through. Warnings and errors
+    # are never dropped.
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.pathname, record.lineno)
+        counter = self.counters.get(key)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(key, itertools.count())
+        return next(counter) % self.every == 0
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    return logging.getLogger(f"CGMTelegramBot.{subsystem}")
+
+
+def setup_logging() -> QueueListener:
+    # Called once by the entry point (main.py), importing the package has no side effects.
+    if settings.LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.setLevel(settings.LOG_LEVEL)
+    root.addHandler(AsyncQueueHandler(log_queue))
+
+    for subsystem, level in settings.LOG_LEVELS.items():
+        get_logger(subsystem).setLevel(level)
+
+    for subsystem, every in settings.LOG_SAMPLING.items():
+        if every > 1:
+            get_logger(subsystem).addFilter(SamplingFilter(every))
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 
 LOGGER = logging.getLogger(__name__)
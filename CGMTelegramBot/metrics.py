@@ -0,0 +1,280 @@
+import math
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Optional
+
+from . import settings
+from .logger import get_logger
+
+
+# Process wide metrics, rendered in the Prometheus text format by MetricsServer.
+# Labels are given as keyword arguments: FETCH_SECONDS.observe(0.2, endpoint="entries").
+
+
+LOGGER = get_logger("bot")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+RULE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+DETECTION_BUCKETS = (15, 30, 60, 90, 120, 180, 300, 600)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.children = {}
+        self.lock = threading.Lock()
+
+
+    def key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labels)
+
+
+    def render(self) -> [str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            children = list(self.children.items())
+        for key, value in children:
+            lines.extend(self.render_child(key, value))
+        return lines
+
+
+    def render_child(self, key: tuple, value) -> [str]:
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"]
+
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.children[key] = self.children.get(key, 0) + amount
+
+
+
+class Gauge(Metric):
+
+    # Either set directly, or computed at scrape time by set_function. The
+    # function returns the value, or a {label values tuple: value} dict when
+    # the gauge has labels.
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.function = None
+
+
+    def set(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.children[key] = value
+
+
+    def set_function(self, function: Optional[Callable]) -> None:
+        self.function = function
+
+
+    def render(self) -> [str]:
+        if self.function is not None:
+            values = self.function()
+            if not self.labels:
+                values = {(): values}
+            with self.lock:
+                self.children = dict(values)
+        return super().render()
+
+
+
+class Histogram(Metric):
+
+    # Every child is [bucket counts..., sum, count], buckets are not cumulative
+    # until rendered so observe is a single increment.
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self.children[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            child[index] += 1
+            child[-2] += value
+            child[-1] += 1
+
+
+    @contextmanager
+    def time(self, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+
+    def render_child(self, key: tuple, value) -> [str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value):
+            cumulative += count
+            labels = format_labels(self.labels, key, f'le="{format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+        labels = format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {format_value(value[-2])}")
+        lines.append(f"{self.name}_count{labels} {value[-1]}")
+        return lines
+
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.register(Histogram(
+    "cgm_nightscout_fetch_seconds", "Nightscout request latency, per attempt.", ("endpoint",)
+))
+TICK_SECONDS = REGISTRY.register(Histogram(
+    "cgm_tick_seconds", "Duration of a patient check, fetch and rules included.", ("patient",)
+))
+POLL_FAILURES = REGISTRY.register(Counter(
+    "cgm_poll_failures_total", "Checks where no new data could be fetched."
+))
+RULE_SECONDS = REGISTRY.register(Histogram(
+    "cgm_rule_seconds", "Evaluation time of each rule.", ("rule",), RULE_BUCKETS
+))
+SEND_SECONDS = REGISTRY.register(Histogram(
+    "cgm_send_seconds", "Telegram send latency, from enqueue to the last attempt.", ("result",)
+))
+ALERTS = REGISTRY.register(Counter(
+    "cgm_alerts_total", "Alerts fired, per rule (reading for the reading limits).", ("rule",)
+))
+MUTES = REGISTRY.register(Counter(
+    "cgm_mutes_total", "Mute commands accepted."
+))
+AUTH_REJECTIONS = REGISTRY.register(Counter(
+    "cgm_auth_rejections_total", "Commands from users not whitelisted."
+))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    "cgm_upstream_errors_total", "Failed requests to Nightscout and Telegram.", ("upstream", "reason")
+))
+READING_AGE = REGISTRY.register(Gauge(
+    "cgm_reading_age_seconds", "Age of the freshest reading held.", ("patient",)
+))
+SEND_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "cgm_send_queue_depth", "Messages waiting in the outbound send queue or being sent."
+))
+DETECTION_SECONDS = REGISTRY.register(Histogram(
+    "cgm_reading_detection_seconds", "From the date of a new reading to the poll that found it.", ("patient",),
+    DETECTION_BUCKETS
+))
+CHART_RENDERS = REGISTRY.register(Counter(
+    "cgm_chart_renders_total", "Charts rendered, cache misses of /grafico."
+))
+CHART_CACHE_HITS = REGISTRY.register(Counter(
+    "cgm_chart_cache_hits_total", "Charts served from the cache or joined to a render in progress."
+))
+
+
+class MetricsServer:
+
+    # Serves REGISTRY at GET /metrics. Meant to be reachable only locally or
+    # by the scraper, it listens on METRICS_LISTEN (localhost by default).
+
+    def __init__(self, listen: str = settings.METRICS_LISTEN, port: int = settings.METRICS_PORT,
+                 registry: Registry = REGISTRY):
+        self.registry = registry
+        self.httpd = ThreadingHTTPServer((listen, port), self.__handler_class())
+        self.httpd.daemon_threads = True
+        self.server_thread = None
+
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+
+    def __handler_class(self):
+        server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = server.registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+
+    def start(self) -> None:
+        LOGGER.info("MetricsServer listening on %s", self.httpd.server_address)
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="MetricsServer", daemon=True)
+        self.server_thread.start()
+
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,40 @@
+import threading
+from dataclasses import dataclass
+from concurrent.futures import Executor
+from typing import Optional
+
+from CGMTelegramBot.cadence import ReadingCadence
+from CGMTelegramBot.CGMPredictor import Analyzer
+from CGMTelegramBot.CGMPredictor.history import ReadingStore
+
+
+@dataclass
+class PatientConfig:
+    name: str
+    url: str
+    secret: str
+    whitelisted_users: set[str]
+
+
+class Patient:
+
+    # Nightscout source, followers and rule state of a single patient.
+    # The lock serializes the periodic check with the commands that trigger it.
+
+    def __init__(self, config: PatientConfig, executor: Optional[Executor] = None,
+                 history: Optional[ReadingStore] = None):
+        self.name = config.name
+        self.followers = config.whitelisted_users
+        self.analyzer = Analyzer(
+            config.url, config.secret, executor=executor, history=history, history_key=config.name
+        )
+
+        self.cadence = ReadingCadence()
+        self.push = None  # NightscoutPush (MongoWatch for mongodb:// urls), with settings.PUSH_ENABLED
+        self.previous_measure = None
+        self.rule_mute_until_time = 0
+        self.lock = threading.Lock()
+
+
+    def is_followed_by(self, username: Optional[str]) -> bool:
+        return username is not None and username in self.followers
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from .logger import get_logger
+
+
+LOGGER = get_logger("poll")
+
+
+class ScheduledJob:
+
+    __slots__ = ("function", "args", "interval", "next_delay", "running")
+
+    def __init__(self, function: Callable, args: tuple, interval: float,
+                 next_delay: Optional[Callable[[], float]] = None):
+        # With next_delay the job is rescheduled when a run ends, next_delay()
+        # seconds later. The interval is then only used if next_delay fails.
+        self.function = function
+        self.args = args
+        self.interval = interval
+        self.next_delay = next_delay
+        self.running = False
+
+
+class PollScheduler:
+
+    # Runs many periodic jobs on a bounded pool of worker threads. Jobs added
+    # together get staggered start times spread over the interval, and a job is
+    # never run again while its previous run is still going. Adaptive jobs
+    # choose their next run time when a run ends.
+
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Poll")
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.is_running = False
+
+
+    def add(self, function: Callable, interval: float, *args, delay: float = 0) -> ScheduledJob:
+        job = ScheduledJob(function, args, interval)
+        self.__push(time.monotonic() + delay, job)
+        return job
+
+
+    def add_adaptive(self, function: Callable, interval: float, next_delay: Callable[[], float], *args,
+                     delay: float = 0) -> ScheduledJob:
+        job = ScheduledJob(function, args, interval, next_delay)
+        self.__push(time.monotonic() + delay, job)
+        return job
+
+
+    def add_staggered(self, jobs: [(Callable, tuple)], interval: float) -> [ScheduledJob]:
+        step = interval / max(1, len(jobs))
+        return [
+            self.add(function, interval, *args, delay=i * step)
+            for i, (function, args) in enumerate(jobs)
+        ]
+
+
+    def __push(self, when: float, job: ScheduledJob) -> None:
+        with self.condition:
+            heapq.heappush(self.queue, (when, next(self.counter), job))
+            self.condition.notify()
+
+
+    def start(self) -> None:
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self.__loop, name="PollScheduler", daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        self.executor.shutdown(wait=False)
+
+
+    def __loop(self) -> None:
+        while True:
+            with self.condition:
+                if not self.is_running:
+                    return
+
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+
+                when, _, job = self.queue[0]
+                wait_time = when - time.monotonic()
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                    continue
+
+                heapq.heappop(self.queue)
+
+            if job.next_delay is not None:
+                job.running = True
+                self.executor.submit(self.__run, job)
+                continue
+
+            # Schedule from the planned time, so the stagger does not drift.
+            # Runs missed while the process was busy are skipped, not burst.
+            missed = int((time.monotonic() - when) // job.interval)
+            self.__push(when + job.interval * (missed + 1), job)
+
+            if job.running:
+                LOGGER.warning("PollScheduler skipping %s, previous run still going.", job.function.__name__)
+                continue
+
+            job.running = True
+            self.executor.submit(self.__run, job)
+
+
+    def __run(self, job: ScheduledJob) -> None:
+        try:
+            job.function(*job.args)
+        except Exception as e:
+            LOGGER.exception("PollScheduler job %s failed: %s", job.function.__name__, e)
+        finally:
+            job.running = False
+            if job.next_delay is not None:
+                self.__reschedule(job)
+
+
+    def __reschedule(self, job: ScheduledJob) -> None:
+        try:
+            delay = job.next_delay()
+        except Exception as e:
+            LOGGER.exception("PollScheduler next_delay of %s failed: %s", job.function.__name__, e)
+            delay = job.interval
+        self.__push(time.monotonic() + max(0.0, delay), job)
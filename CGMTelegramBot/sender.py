@@ -0,0 +1,182 @@
+import time
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, Unauthorized
+
+from . import settings
+from .logger import get_logger, chat_id as redacted_chat_id
+from .metrics import SEND_SECONDS, UPSTREAM_ERRORS
+
+
+LOGGER = get_logger("send")
+
+
+@dataclass
+class DeliveryResult:
+    chat_id: int
+    delivered: bool
+    attempts: int
+    latency: float  # in seconds, from enqueue to the end of the last attempt
+    error: Optional[str] = None
+
+
+class RateLimiter:
+
+    # Token bucket, `rate` sends per second with bursts up to `burst`.
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class ChatRateLimiter:
+
+    # Minimum interval between messages to the same chat.
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+
+    def acquire(self, chat_id: int) -> None:
+        with self.lock:
+            now = time.monotonic()
+            send_at = max(now, self.next_allowed.get(chat_id, 0))
+            self.next_allowed[chat_id] = send_at + self.interval
+
+            # Forget chats that can send right away, keeps the dict small.
+            if len(self.next_allowed) > 1024:
+                self.next_allowed = {
+                    chat: allowed for chat, allowed in self.next_allowed.items() if allowed > now
+                }
+
+        if send_at > now:
+            time.sleep(send_at - now)
+
+
+    def delay(self, chat_id: int, seconds: float) -> None:
+        with self.lock:
+            self.next_allowed[chat_id] = max(self.next_allowed.get(chat_id, 0), time.monotonic() + seconds)
+
+
+class MessageSender:
+
+    # Outbound queue for the Telegram sends. Messages are sent by a pool of
+    # workers respecting the global and per chat rate limits. Flood control
+    # (429) and network errors (including 5xx) are retried, every message has
+    # its own DeliveryResult so a failing chat does not affect the others.
+
+    def __init__(self, send_function: Callable[..., object],
+                 workers: int = settings.SEND_WORKERS,
+                 retries: int = settings.SEND_RETRIES,
+                 backoff: float = settings.SEND_BACKOFF):
+        self.send_function = send_function
+        self.retries = max(1, retries)
+        self.backoff = backoff
+        self.global_limiter = RateLimiter(settings.TELEGRAM_GLOBAL_RATE, settings.TELEGRAM_GLOBAL_RATE)
+        self.chat_limiter = ChatRateLimiter(settings.TELEGRAM_CHAT_INTERVAL)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Sender")
+        self.pending = 0  # Messages queued or being sent.
+        self.pending_lock = threading.Lock()
+
+
+    def send(self, chat_id: int, message, send_function: Optional[Callable[..., object]] = None,
+             **kwargs) -> "Future[DeliveryResult]":
+        # Extra kwargs (e.g. parse_mode) are given to the send function. Another
+        # send_function (e.g. bot.send_photo) shares the queue and rate limits.
+        with self.pending_lock:
+            self.pending += 1
+        return self.executor.submit(
+            self.__deliver_counted, chat_id, message, send_function or self.send_function, kwargs, time.monotonic()
+        )
+
+
+    def send_many(self, chat_ids: [int], message: str) -> ["Future[DeliveryResult]"]:
+        return [self.send(chat_id, message) for chat_id in chat_ids]
+
+
+    def __deliver_counted(self, chat_id: int, message, send_function: Callable[..., object],
+                          kwargs: dict, enqueued: float) -> DeliveryResult:
+        try:
+            result = self.__deliver(chat_id, message, send_function, kwargs, enqueued)
+        finally:
+            with self.pending_lock:
+                self.pending -= 1
+        SEND_SECONDS.observe(result.latency, result="delivered" if result.delivered else "failed")
+        return result
+
+
+    def __deliver(self, chat_id: int, message, send_function: Callable[..., object],
+                  kwargs: dict, enqueued: float) -> DeliveryResult:
+        error = None
+
+        for attempt in range(1, self.retries + 1):
+            self.chat_limiter.acquire(chat_id)
+            self.global_limiter.acquire()
+
+            try:
+                send_function(chat_id, message, **kwargs)
+                return DeliveryResult(chat_id, True, attempt, time.monotonic() - enqueued)
+
+            except RetryAfter as e:
+                # Flood control, Telegram tells how long to wait.
+                error = e
+                UPSTREAM_ERRORS.inc(upstream="telegram", reason="retry_after")
+                self.chat_limiter.delay(chat_id, e.retry_after)
+
+            except (BadRequest, Unauthorized, ChatMigrated) as e:
+                # Permanent for this chat (e.g. the user blocked the bot).
+                error = e
+                UPSTREAM_ERRORS.inc(upstream="telegram", reason=type(e).__name__)
+                break
+
+            except NetworkError as e:
+                error = e
+                UPSTREAM_ERRORS.inc(upstream="telegram", reason=type(e).__name__)
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+            except Exception as e:
+                error = e
+                UPSTREAM_ERRORS.inc(upstream="telegram", reason="other")
+                break
+
+        return DeliveryResult(chat_id, False, attempt, time.monotonic() - enqueued, repr(error))
+
+
+    def stop(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def log_delivery(future: "Future[DeliveryResult]") -> None:
+    result = future.result()
+    if result.delivered:
+        LOGGER.info(
+            "Delivered to %s in %.3fs after %d attempt(s).",
+            redacted_chat_id(result.chat_id), result.latency, result.attempts
+        )
+    else:
+        LOGGER.warning(
+            "Delivery to %s failed after %d attempt(s): %s",
+            redacted_chat_id(result.chat_id), result.attempts, result.error
+        )
@@ -4,4 +4,108 @@ LIMIT_LOW = 75
 
 CHECK_DELAY = 60 * 2  # in seconds
 
+ADAPTIVE_POLLING = True  # Polls right after the expected reading instead of every CHECK_DELAY, see cadence.py.
+CADENCE_RETRY = 15  # Seconds between polls once a reading is due and missing.
+CADENCE_FAST_RETRIES = 4  # Retries before backing off, up to CHECK_DELAY.
+CADENCE_SIGNAL_LOSS = 60 * 15  # Seconds without readings to consider the signal lost.
+CADENCE_LOST_INTERVAL = 60 * 3  # Seconds between polls while the signal is lost.
+CADENCE_LAGS = 24  # Upload lags kept per patient.
+CADENCE_LAG_QUANTILE = 0.2  # Of the upload lags, where the first poll for a reading aims.
+
+PUSH_ENABLED = False  # Also receive new readings from the Nightscout socket (or the database, for mongodb:// urls), see CGMPredictor/push.py.
+PUSH_POLL_INTERVAL = 60 * 5  # Seconds between REST polls while the socket is connected.
+PUSH_HISTORY_HOURS = 1  # Hours of readings the socket sends on connect.
+PUSH_RECONNECT_BACKOFF = 1  # Base of the exponential reconnect backoff, in seconds.
+PUSH_RECONNECT_MAX = 60  # in seconds
+
+# Patients with a mongodb:// or mongodb+srv:// url (with the database name) are
+# read straight from the Nightscout database, see CGMPredictor/mongo_connection.py.
+MONGO_ENTRIES_COLLECTION = "entries"
+MONGO_TREATMENTS_COLLECTION = "treatments"
+MONGO_TAIL_INTERVAL = 5  # Seconds between tail queries, on servers without change streams.
+
 MUTE_RULE_DURATION = 60 * 60  # in seconds
+
+MEASURES_WINDOW = 16  # Amount of measures and treatments kept by the Analyzer.
+
+FORECAST_ALERTS = False  # Enables rule_predicted_hypoglycemia, meant for fitted FORECAST_COEFFICIENTS.
+FORECAST_LOW = 70  # rule_predicted_hypoglycemia alerts on forecasts under it.
+FORECAST_LOW_WITHIN = 30  # Minutes ahead checked by rule_predicted_hypoglycemia.
+FORECAST_ISF = 50  # Insulin sensitivity, mg/dL per unit, of the default forecast coefficients.
+FORECAST_CARB_RATIO = 10  # Grams per unit, of the default forecast coefficients.
+FORECAST_INSULIN_DURATION = 300  # Insulin action, in minutes.
+FORECAST_INSULIN_PEAK = 75  # Peak insulin activity, in minutes.
+FORECAST_CARBS_DURATION = 180  # Carbs absorption, in minutes.
+FORECAST_COEFFICIENTS = None  # JSON file fitted by CGMPredictor/forecast_fit.py, None for the defaults.
+
+NIGHTSCOUT_CONNECT_TIMEOUT = 5  # in seconds
+NIGHTSCOUT_READ_TIMEOUT = 15  # in seconds
+NIGHTSCOUT_RETRIES = 3  # Attempts per request on transient errors.
+NIGHTSCOUT_BACKOFF = 0.5  # Base of the exponential backoff, in seconds.
+NIGHTSCOUT_BREAKER_THRESHOLD = 5  # Consecutive failed requests before opening the circuit.
+NIGHTSCOUT_BREAKER_COOLDOWN = 60 * 5  # in seconds
+# Combined deadline for a tick's requests, in seconds. Each request, with its
+# retries and backoff, also gives up by then: the connect and read timeouts are
+# cut to the time left, and a retry only starts with NIGHTSCOUT_CONNECT_TIMEOUT
+# left after its backoff. Without the cut, one request could take up to
+# NIGHTSCOUT_RETRIES * (CONNECT_TIMEOUT + READ_TIMEOUT) plus the backoff.
+NIGHTSCOUT_FETCH_DEADLINE = 20
+NIGHTSCOUT_PAGE_SIZE = 5000  # Entries per request of the bulk history pulls.
+
+POLL_WORKERS = 8  # Patients polled at the same time.
+
+SEND_WORKERS = 32  # Messages sent at the same time.
+SEND_RETRIES = 4  # Attempts per message on flood control and network errors.
+SEND_BACKOFF = 0.5  # Base of the exponential backoff, in seconds.
+TELEGRAM_GLOBAL_RATE = 30  # Messages per second for the whole bot.
+TELEGRAM_CHAT_INTERVAL = 1  # Seconds between messages to the same chat.
+TELEGRAM_BASE_URL = None  # Bot API base url (e.g. of tools.fake_telegram), None for api.telegram.org.
+
+RUNTIME = "threads"  # "threads" or "asyncio", see async_runtime.py.
+ASYNC_IO_THREADS = 8  # Threads for the blocking HTTP calls of the asyncio runtime.
+UPDATES_TIMEOUT = 30  # Long polling timeout of getUpdates, in seconds.
+
+UPDATE_MODE = "polling"  # "polling" or "webhook", how Telegram updates are received.
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = None  # Public URL Telegram posts to, None to not call setWebhook.
+WEBHOOK_SECRET_TOKEN = None  # Checked against the X-Telegram-Bot-Api-Secret-Token header.
+WEBHOOK_CERT = None  # Certificate and key files, None when TLS ends at a proxy.
+WEBHOOK_KEY = None
+WEBHOOK_MAX_CONNECTIONS = 40  # Connections Telegram opens to the webhook.
+WEBHOOK_QUEUE_SIZE = 256  # Updates waiting for the dispatcher.
+WEBHOOK_QUEUE_TIMEOUT = 1  # Seconds a request waits for room in the queue before a 503.
+WEBHOOK_MAX_BODY = 1024 * 1024  # Bytes, larger updates are answered with 413.
+
+# Backend of the subscribers database, "json" or "sqlite". With "sqlite" an existing
+# JSON database is imported once and renamed to .json.migrated, see storage.open_storage.
+STORAGE = "json"
+
+HISTORY_FILE = None  # SQLite file keeping every reading and treatment fetched (e.g. "mgb_history.sqlite3"), None to not keep them.
+HISTORY_RETENTION_DAYS = 365  # Older readings are deleted, None keeps everything.
+HISTORY_RETENTION_INTERVAL = 60 * 60 * 6  # Seconds between retention passes.
+
+STATISTICS_WINDOWS = (1, 7, 14)  # Days covered by /estatisticas.
+
+CHART_DEFAULT_HOURS = 6  # Hours shown by /grafico without an argument.
+CHART_MAX_HOURS = 48  # More than the analyzer window needs the history store.
+CHART_WORKERS = 2  # Processes rendering the charts.
+CHART_CACHE_BYTES = 8 * 1024 * 1024  # Rendered charts kept, least recently used are evicted.
+
+LOG_LEVEL = "INFO"
+LOG_LEVELS = {  # Per subsystem, see logger.get_logger.
+    "auth": "INFO",
+    "bot": "INFO",
+    "poll": "INFO",
+    "send": "INFO",
+    "predictor": "INFO",
+}
+LOG_SAMPLING = {  # Subsystem: log 1 in N records of each call site.
+    "poll": 1,
+}
+LOG_FORMAT = "text"  # "text" or "json"
+LOG_REDACT = False  # Hides chat ids, glucose values and message bodies.
+
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9464  # Prometheus text endpoint at /metrics, None to disable it.
@@ -0,0 +1,263 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from . import settings
+from .logger import get_logger
+
+
+LOGGER = get_logger("auth")
+
+
+class Storage(ABC):
+
+    # Persistence of the subscribers, username -> chat_id, and of their mutes,
+    # username -> mute_until (a time.time() timestamp).
+
+    @abstractmethod
+    def chat_id_for_username(self, username: str) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def set_chat_id(self, username: str, chat_id: int) -> None:
+        pass
+
+    @abstractmethod
+    def remove_username(self, username: str) -> None:
+        pass
+
+    @abstractmethod
+    def items(self) -> list[tuple[str, int]]:
+        pass
+
+    @abstractmethod
+    def set_mute_until(self, username: str, mute_until: float) -> None:
+        # A mute_until of 0 removes the mute.
+        pass
+
+    @abstractmethod
+    def mutes(self) -> list[tuple[str, float]]:
+        pass
+
+    @abstractmethod
+    def remove_mutes_until(self, now: float) -> None:
+        # Removes, in a single batch, every mute that expired by `now`.
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class JsonStorage(Storage):
+
+    # The original format, a JSON object. Every change rewrites the file, but
+    # through a temporary file and a rename so a crash never leaves it half written.
+    # Mutes go to a second file next to it, so the original format is unchanged.
+
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        self.mutes_file = json_mutes_file(database_file)
+        self.lock = threading.Lock()
+        self.data = read_json_database(database_file)
+        self.mutes_data = read_json_database(self.mutes_file)
+
+
+    def chat_id_for_username(self, username: str) -> Optional[int]:
+        chat_id = self.data.get(username)
+        return int(chat_id) if chat_id is not None else None
+
+
+    def set_chat_id(self, username: str, chat_id: int) -> None:
+        with self.lock:
+            self.data[username] = chat_id
+            self.__save()
+
+
+    def remove_username(self, username: str) -> None:
+        with self.lock:
+            if self.data.pop(username, None) is not None:
+                self.__save()
+
+
+    def items(self) -> list[tuple[str, int]]:
+        return [(username, int(chat_id)) for username, chat_id in self.data.items()]
+
+
+    def set_mute_until(self, username: str, mute_until: float) -> None:
+        with self.lock:
+            if mute_until > 0:
+                self.mutes_data[username] = mute_until
+            elif self.mutes_data.pop(username, None) is None:
+                return
+            write_json_atomically(self.mutes_file, self.mutes_data)
+
+
+    def mutes(self) -> list[tuple[str, float]]:
+        return list(self.mutes_data.items())
+
+
+    def remove_mutes_until(self, now: float) -> None:
+        with self.lock:
+            expired = [username for username, mute_until in self.mutes_data.items() if mute_until <= now]
+            if expired:
+                for username in expired:
+                    del self.mutes_data[username]
+                write_json_atomically(self.mutes_file, self.mutes_data)
+
+
+    def __save(self) -> None:
+        write_json_atomically(self.database_file, self.data)
+
+
+class SqliteStorage(Storage):
+
+    # SQLite in WAL mode. Every change is a single row upsert committed on its
+    # own, lookups by username and by chat_id use indexes.
+
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database_file, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS subscribers (username TEXT PRIMARY KEY, chat_id INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS mutes (username TEXT PRIMARY KEY, mute_until REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mutes_mute_until ON mutes (mute_until)")
+
+
+    def __fetch_one(self, query: str, parameters: tuple):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchone()
+
+
+    def chat_id_for_username(self, username: str) -> Optional[int]:
+        row = self.__fetch_one("SELECT chat_id FROM subscribers WHERE username = ?", (username,))
+        return row[0] if row else None
+
+
+    def set_chat_id(self, username: str, chat_id: int) -> None:
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO subscribers (username, chat_id) VALUES (?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET chat_id = excluded.chat_id",
+                (username, chat_id)
+            )
+
+
+    def remove_username(self, username: str) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM subscribers WHERE username = ?", (username,))
+
+
+    def items(self) -> list[tuple[str, int]]:
+        with self.lock:
+            return self.connection.execute("SELECT username, chat_id FROM subscribers").fetchall()
+
+
+    def set_mute_until(self, username: str, mute_until: float) -> None:
+        with self.lock:
+            if mute_until > 0:
+                self.connection.execute(
+                    "INSERT INTO mutes (username, mute_until) VALUES (?, ?) "
+                    "ON CONFLICT (username) DO UPDATE SET mute_until = excluded.mute_until",
+                    (username, mute_until)
+                )
+            else:
+                self.connection.execute("DELETE FROM mutes WHERE username = ?", (username,))
+
+
+    def mutes(self) -> list[tuple[str, float]]:
+        with self.lock:
+            return self.connection.execute("SELECT username, mute_until FROM mutes").fetchall()
+
+
+    def remove_mutes_until(self, now: float) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM mutes WHERE mute_until <= ?", (now,))
+
+
+    def is_empty(self) -> bool:
+        return self.__fetch_one("SELECT 1 FROM subscribers LIMIT 1", ()) is None
+
+
+    def import_items(self, items: list[tuple[str, int]]) -> None:
+        # All or nothing, in a single transaction.
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO subscribers (username, chat_id) VALUES (?, ?)", items
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def read_json_database(database_file: str) -> dict:
+    if os.path.isfile(database_file):
+        with open(database_file, "r") as file:
+            return json.loads(file.read())
+    return dict()
+
+
+def json_mutes_file(database_file: str) -> str:
+    root, extension = os.path.splitext(database_file)
+    return f"{root}_mutes{extension or '.json'}"
+
+
+def write_json_atomically(path: str, data: dict) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_file = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as file:
+            json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_file, path)
+    except BaseException:
+        os.unlink(temporary_file)
+        raise
+
+
+def migrate_json_to_sqlite(json_file: str, storage: SqliteStorage) -> None:
+    # Imports the old JSON database once, it is renamed afterwards so the
+    # migration does not run again.
+    if not os.path.isfile(json_file) or not storage.is_empty():
+        return
+
+    data = read_json_database(json_file)
+    storage.import_items([(username, int(chat_id)) for username, chat_id in data.items()])
+    os.replace(json_file, json_file + ".migrated")
+    LOGGER.warning(
+        "Migrated %d subscribers from %s to %s, the JSON database was renamed to %s.migrated",
+        len(data), json_file, storage.database_file, json_file
+    )
+
+
+def open_storage(database_file: str, backend: str = settings.STORAGE) -> Storage:
+    if backend == "json":
+        return JsonStorage(database_file)
+
+    # A .json database file name is kept for compatibility, the SQLite file goes
+    # next to it and the JSON contents are migrated.
+    if database_file.endswith(".json"):
+        sqlite_file = database_file[:-len(".json")] + ".sqlite3"
+        storage = SqliteStorage(sqlite_file)
+        migrate_json_to_sqlite(database_file, storage)
+        return storage
+
+    return SqliteStorage(database_file)
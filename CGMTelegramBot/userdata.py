@@ -1,4 +1,9 @@
 import time
+import heapq
+import threading
+from typing import Optional
+
+from .storage import Storage
 
 
 class NonPersistentUserData:
@@ -11,24 +16,75 @@ class NonPersistentUserData:
 
 class UserDataManager:
 
-    def __init__(self):
+    # Mutes are persisted in the storage (when given) and indexed by expiry in
+    # a heap, so the set of muted usernames is kept up to date by popping only
+    # the mutes that expired, in batches, instead of checking every user.
+
+    def __init__(self, storage: Optional[Storage] = None):
         self.user_data: {str: NonPersistentUserData} = {}
+        self.storage = storage
+        self.expirations = []  # heap of (mute_until, username), may hold stale entries
+        self.muted = set()
+        self.lock = threading.RLock()
+
+        if self.storage is not None:
+            self.load_mutes()
+
+    def load_mutes(self):
+        now = time.time()
+        self.storage.remove_mutes_until(now)
+        for username, mute_until in self.storage.mutes():
+            self.init_username(username)
+            self.__set_mute_until(username, mute_until, persist=False)
 
     def init_username(self, username):
         if username not in self.user_data:
             self.user_data[username] = NonPersistentUserData()
 
+    def expire_mutes(self):
+        now = time.time()
+        expired = False
+
+        with self.lock:
+            while self.expirations and self.expirations[0][0] <= now:
+                mute_until, username = heapq.heappop(self.expirations)
+                # Skip entries replaced by a later silence or an unmute.
+                if self.user_data[username].mute_until == mute_until:
+                    self.muted.discard(username)
+                    expired = True
+
+        if expired and self.storage is not None:
+            self.storage.remove_mutes_until(now)
+
+    def is_muted(self, username) -> bool:
+        # O(1) when no mute expired, called for every follower of an alert.
+        self.expire_mutes()
+        with self.lock:
+            return username in self.muted
+
     def is_username_silenced(self, username):
         if not self.contains_username(username):
             return False
 
-        return self.user_data[username].mute_until > time.time()
+        return self.is_muted(username)
+
+    def __set_mute_until(self, username, mute_until, persist=True):
+        with self.lock:
+            self.user_data[username].mute_until = mute_until
+            if mute_until > time.time():
+                heapq.heappush(self.expirations, (mute_until, username))
+                self.muted.add(username)
+            else:
+                self.muted.discard(username)
+
+        if persist and self.storage is not None:
+            self.storage.set_mute_until(username, mute_until)
 
     def silence_username_for_seconds(self, username, time_in_seconds):
         if not self.contains_username(username):
             return
 
-        self.user_data[username].mute_until = time.time() + time_in_seconds
+        self.__set_mute_until(username, time.time() + time_in_seconds)
 
     def silence_username_for_minutes(self, username, time_in_minutes):
         if not self.contains_username(username):
@@ -40,7 +96,7 @@ class UserDataManager:
         if not self.contains_username(username):
             return
 
-        self.user_data[username].mute_until = 0
+        self.__set_mute_until(username, 0)
 
     def contains_username(self, username):
         if username is None or len(username) < 1:
@@ -0,0 +1,181 @@
+import hmac
+import json
+import queue
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from . import settings
+from .logger import get_logger
+
+
+LOGGER = get_logger("bot")
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_STOP = object()  # Put on the updates queue by stop(), never a decoded body.
+
+
+def content_length(value: Optional[str]) -> Optional[int]:
+    # None when the header is missing or not a plain decimal number.
+    if value is None:
+        return None
+    value = value.strip()
+    if not (value.isascii() and value.isdigit()):
+        return None
+    return int(value)
+
+
+class WebhookStats:
+
+    __slots__ = ("accepted", "rejected", "dropped", "processed", "failed")
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = 0  # Wrong path, secret token, length or body.
+        self.dropped = 0  # Queue full, answered 503 so Telegram retries later.
+        self.processed = 0
+        self.failed = 0
+
+
+class WebhookServer:
+
+    # Embedded HTTP listener for Telegram webhooks. Requests only validate and
+    # enqueue the update JSON, a single worker decodes and processes updates in
+    # arrival order. The queue is bounded, when it is full requests wait up to
+    # WEBHOOK_QUEUE_TIMEOUT and are then answered with 503 (backpressure).
+
+    def __init__(self, process_update: Callable[[dict], None],
+                 listen: str = settings.WEBHOOK_LISTEN,
+                 port: int = settings.WEBHOOK_PORT,
+                 path: str = settings.WEBHOOK_PATH,
+                 secret_token: Optional[str] = settings.WEBHOOK_SECRET_TOKEN,
+                 queue_size: int = settings.WEBHOOK_QUEUE_SIZE,
+                 queue_timeout: float = settings.WEBHOOK_QUEUE_TIMEOUT,
+                 max_body: int = settings.WEBHOOK_MAX_BODY,
+                 cert: Optional[str] = settings.WEBHOOK_CERT,
+                 key: Optional[str] = settings.WEBHOOK_KEY):
+        self.process_update = process_update
+        self.path = path
+        self.secret_token = secret_token
+        self.queue_timeout = queue_timeout
+        self.max_body = max_body
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.stats = WebhookStats()
+        self.stats_lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((listen, port), self.__handler_class())
+        self.httpd.daemon_threads = True
+        if cert and key:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+
+        self.server_thread = None
+        self.worker_thread = None
+
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+
+    def __handler_class(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = content_length(self.headers.get("Content-Length"))
+                status = server.check_length(length)
+                if status is None:
+                    status = server.enqueue(self.path, self.headers, self.rfile.read(length))
+                else:
+                    # The body is left unread, the connection can not be reused.
+                    self.close_connection = True
+
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return WebhookHandler
+
+
+    def __count(self, name: str) -> None:
+        with self.stats_lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+
+    def check_length(self, length: Optional[int]) -> Optional[int]:
+        # Status to answer before reading the body, None when it can be read.
+        if length is None:
+            self.__count("rejected")
+            return 400
+        if length > self.max_body:
+            self.__count("rejected")
+            return 413
+        return None
+
+
+    def enqueue(self, path: str, headers, body: bytes) -> int:
+        if path != self.path:
+            self.__count("rejected")
+            return 404
+
+        if self.secret_token is not None:
+            received = headers.get(SECRET_TOKEN_HEADER) or ""
+            if not hmac.compare_digest(received.encode(), self.secret_token.encode()):
+                self.__count("rejected")
+                return 403
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+
+        # Telegram updates are objects, anything else is rejected.
+        if not isinstance(data, dict):
+            self.__count("rejected")
+            return 400
+
+        try:
+            self.updates.put(data, timeout=self.queue_timeout)
+        except queue.Full:
+            self.__count("dropped")
+            return 503
+
+        self.__count("accepted")
+        return 200
+
+
+    def __work(self) -> None:
+        while True:
+            data = self.updates.get()
+            if data is _STOP:
+                return
+            try:
+                self.process_update(data)
+                self.__count("processed")
+            except Exception as e:
+                self.__count("failed")
+                LOGGER.exception("WebhookServer failed processing update: %s", e)
+
+
+    def start(self) -> None:
+        LOGGER.info("WebhookServer listening on %s %s", self.httpd.server_address, self.path)
+        self.worker_thread = threading.Thread(target=self.__work, name="WebhookWorker", daemon=True)
+        self.worker_thread.start()
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="WebhookServer", daemon=True)
+        self.server_thread.start()
+
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.updates.put(_STOP)
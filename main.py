@@ -1,8 +1,8 @@
 import requests
 import time
-from CGMTelegramBot.logger import LOGGER
+from CGMTelegramBot.logger import LOGGER, setup_logging
 from private import BOT_TOKEN, NIGHTSCOUT_URL, SECRET
-from CGMTelegramBot import CGMBot
+from CGMTelegramBot import CGMBot, PatientConfig
 
 
 def get_username_whitelist(file: str = "username_whitelist.txt") -> set[str]:
@@ -17,6 +17,20 @@ def get_username_whitelist(file: str = "username_whitelist.txt") -> set[str]:
     return usernames
 
 
+def get_patients() -> list[PatientConfig]:
+    # Optional PATIENTS in private.py, a list of dicts with name, url, secret
+    # and whitelist (file). Defaults to a single patient.
+    try:
+        from private import PATIENTS
+    except ImportError:
+        return [PatientConfig("", NIGHTSCOUT_URL, SECRET, get_username_whitelist())]
+
+    return [
+        PatientConfig(p["name"], p["url"], p["secret"], get_username_whitelist(p["whitelist"]))
+        for p in PATIENTS
+    ]
+
+
 def wait_internet_connection():
     def connected_to_internet(url='http://www.google.com/', timeout=5):
         try:
@@ -31,16 +45,13 @@ def wait_internet_connection():
 
 
 if __name__ == '__main__':
+    setup_logging()
     wait_internet_connection()
 
-    username_whitelist = get_username_whitelist()
-
     bot = CGMBot(
-        url=NIGHTSCOUT_URL,
-        secret=SECRET,
         token=BOT_TOKEN,
         database_file="mgb_database.json",
-        whitelisted_users=username_whitelist
+        patients=get_patients()
     )
 
     bot.run()
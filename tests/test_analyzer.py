@@ -0,0 +1,93 @@
+import time
+from concurrent.futures import wait
+from unittest.mock import Mock
+
+from CGMTelegramBot.CGMPredictor.analyzer import Analyzer
+from CGMTelegramBot.CGMPredictor.analyzer_data import AnalyzerData
+from CGMTelegramBot.CGMPredictor.data import Measure, Treatment
+from CGMTelegramBot.CGMPredictor.push import data_update_columns
+
+from tools.fake_nightscout import FakeNightscout, FakePatient
+from tools.synthetic import generate_trace
+
+
+READING_INTERVAL = 5 * 60 * 1000
+
+
+def synced_analyzer() -> Analyzer:
+    analyzer = Analyzer("http://127.0.0.1:1", "secret")
+    measures = [Measure(i * READING_INTERVAL, 120, "Flat") for i in range(4)]
+    analyzer.data = AnalyzerData(measures, [Treatment(3 * READING_INTERVAL, None, 2)])
+    return analyzer
+
+
+def test_treatment_pushed_twice():
+    analyzer = synced_analyzer()
+    update = {"treatments": [{"mills": 3 * READING_INTERVAL, "carbs": 30}]}
+
+    assert analyzer.add_pushed(*data_update_columns(update))
+    # A reconnect delivers the recent treatments again.
+    assert not analyzer.add_pushed(*data_update_columns(update))
+
+    data = analyzer.data
+    assert len(data.treatments) == 2
+    assert data.carbs_between(0, 3 * READING_INTERVAL) == 30
+    assert data.insulin_between(0, 3 * READING_INTERVAL) == 2
+
+
+def test_push_before_the_first_sync():
+    analyzer = Analyzer("http://127.0.0.1:1", "secret")
+    update = {"sgvs": [{"mills": READING_INTERVAL, "mgdl": 120, "direction": "Flat"}]}
+    assert not analyzer.add_pushed(*data_update_columns(update))
+    assert analyzer.matching_rule() is None
+
+
+def tick_after_the_statistics_pull(analyzer: Analyzer) -> bool:
+    # The statistics readings are pulled in the background, a tick adds them once done.
+    if analyzer.statistics_future is not None:
+        wait([analyzer.statistics_future], timeout=10)
+    return analyzer.get_new_data()
+
+
+def test_first_sync_pulls_the_statistics_readings():
+    # A day of readings, far more than the window, and no history store.
+    entries, treatments = generate_trace(288, end=int(time.time() * 1000), gap_probability=0)
+    nightscout = FakeNightscout({"": FakePatient(entries, treatments)})
+    nightscout.start()
+    try:
+        analyzer = Analyzer(nightscout.url, "secret", window_size=16)
+        assert analyzer.get_new_data()
+        assert tick_after_the_statistics_pull(analyzer)
+    finally:
+        nightscout.stop()
+
+    assert len(analyzer.data) == 16
+    assert analyzer.statistics_loaded
+    day = analyzer.statistics.statistics()[0]
+    assert day.days == 1
+    assert day.readings >= 280
+
+
+def test_failed_statistics_pull_is_retried(monkeypatch):
+    entries, treatments = generate_trace(288, end=int(time.time() * 1000), gap_probability=0)
+    nightscout = FakeNightscout({"": FakePatient(entries, treatments)})
+    nightscout.start()
+    try:
+        analyzer = Analyzer(nightscout.url, "secret", window_size=16)
+        pull = analyzer.connection.get_measure_columns_between
+        failing_pull = Mock(side_effect=ConnectionError)
+        monkeypatch.setattr(analyzer.connection, "get_measure_columns_between", failing_pull)
+        for _ in range(3):
+            assert tick_after_the_statistics_pull(analyzer)
+        assert not analyzer.statistics_loaded
+        assert failing_pull.call_count >= 2
+
+        monkeypatch.setattr(analyzer.connection, "get_measure_columns_between", pull)
+        for _ in range(3):
+            assert tick_after_the_statistics_pull(analyzer)
+    finally:
+        nightscout.stop()
+
+    assert analyzer.statistics_loaded
+    assert analyzer.statistics_future is None
+    assert analyzer.statistics.statistics()[0].readings >= 280
@@ -0,0 +1,80 @@
+import random
+from array import array
+
+from CGMTelegramBot.CGMPredictor.analyzer_data import AnalyzerData
+from CGMTelegramBot.CGMPredictor.data import Measure, Treatment, direction_code
+
+from tools.synthetic import generate_trace
+
+
+READING_INTERVAL = 5 * 60 * 1000
+
+
+def readings(count: int, start: int = 0) -> list[Measure]:
+    return [Measure(start + i * READING_INTERVAL, 100 + i, "Flat") for i in range(count)]
+
+
+def test_remerged_treatment_sharing_its_date():
+    # Sorted by date only, the re-merged copy ends up after the insulin.
+    carbs = Treatment(READING_INTERVAL, 30, None)
+    insulin = Treatment(READING_INTERVAL, None, 3)
+    data = AnalyzerData(readings(4), [carbs, insulin])
+
+    merged = data.merged([], [Treatment(READING_INTERVAL, 30, None)], 16)
+
+    assert len(merged.treatments) == 2
+    assert merged.carbs_between(0, READING_INTERVAL) == 30
+    assert merged.insulin_between(0, READING_INTERVAL) == 3
+
+
+def test_duplicates_in_a_single_batch():
+    treatments = [Treatment(0, 15, None), Treatment(0, None, 1), Treatment(0, 15, None), Treatment(0, None, 1)]
+    data = AnalyzerData.from_columns(array("q"), array("l"), array("H"), treatments)
+    assert len(data.treatments) == 2
+    assert data.carbs_between(0, 0) == 15
+
+
+def columns(data: AnalyzerData) -> tuple:
+    return (
+        list(data.dates), list(data.sgvs), list(data.directions),
+        list(data.measures_seconds_elapsed), list(data.measures_deltas),
+        list(data.treatments),
+    )
+
+
+def test_merged_columns_matches_a_full_rebuild():
+    rng = random.Random(0)
+    entries, treatments = generate_trace(400, end=1_600_000_000_000, seed=1)
+    measures = sorted(Measure.from_json(e) for e in entries)
+    treatments = sorted(Treatment.from_json(t) for t in treatments)
+
+    size = 16
+    data = AnalyzerData([], [])
+    merged_measures = []
+    merged_treatments = []
+    held_back = []
+    position = 0
+    while position < len(measures):
+        batch = measures[position:position + rng.randint(1, 4)]
+        position += len(batch)
+        # Late uploads of older readings and readings sent again.
+        batch, held_back = batch + held_back, []
+        if len(batch) > 1 and rng.random() < 0.2:
+            held_back.append(batch.pop(0))
+        if merged_measures and rng.random() < 0.3:
+            batch.append(rng.choice(merged_measures[-size:]))
+        batch = sorted({m.date: m for m in batch}.values())
+        batch_treatments = [t for t in treatments if batch[0].date <= t.date <= batch[-1].date]
+
+        data = data.merged_columns(
+            array("q", [m.date for m in batch]),
+            array("l", [m.sgv for m in batch]),
+            array("H", [direction_code(m.direction) for m in batch]),
+            batch_treatments,
+            size,
+        )
+        merged_measures += batch
+        merged_treatments += batch_treatments
+
+        expected = AnalyzerData(merged_measures, merged_treatments).trimmed(size)
+        assert columns(data) == columns(expected)
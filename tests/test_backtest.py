@@ -0,0 +1,34 @@
+import io
+import json
+
+from CGMTelegramBot.CGMPredictor.backtest import run_backtest
+from CGMTelegramBot.CGMPredictor.rules import RULES_MIN_READINGS
+
+
+READING_INTERVAL = 5 * 60 * 1000
+START = 1_600_000_000_000
+
+
+def export(sgvs: list[int]) -> io.StringIO:
+    entries = [
+        {"date": START + i * READING_INTERVAL, "sgv": sgv, "direction": "FortyFiveDown"}
+        for i, sgv in enumerate(sgvs)
+    ]
+    return io.StringIO(json.dumps(entries))
+
+
+def test_export_starting_between_75_and_106():
+    # Used to reach rule_imminent_hypoglycemia with 1 or 2 readings, dividing by zero.
+    alerts = run_backtest(export([100, 95, 90, 86, 83, 80, 78]), processes=1, mute_seconds=None)
+    assert all(alert.rule != "rule_imminent_hypoglycemia" for alert in alerts)
+
+
+def test_export_shorter_than_the_warmup():
+    sgvs = [100 - i for i in range(RULES_MIN_READINGS - 1)]
+    assert run_backtest(export(sgvs), processes=1, mute_seconds=None) == []
+
+
+def test_imminent_hypoglycemia_once_the_window_is_full():
+    sgvs = [105, 104, 100, 96, 92, 88, 84, 80, 77, 76, 76, 76]
+    alerts = run_backtest(export(sgvs), processes=1, mute_seconds=None)
+    assert any(alert.rule == "rule_imminent_hypoglycemia" for alert in alerts)
@@ -0,0 +1,87 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from CGMTelegramBot.CGMPredictor.connection import Connection
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+    # Answers every request with the server's status, after its delay.
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        body = b"[]"
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    server.status = 200
+    server.delay = 0
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def connection_to(server) -> Connection:
+    return Connection(f"http://127.0.0.1:{server.server_address[1]}", "secret", retries=1, backoff=0)
+
+
+def test_server_errors_open_the_circuit(server):
+    server.status = 501
+    connection = connection_to(server)
+    for _ in range(connection.breaker.failure_threshold):
+        with pytest.raises(requests.HTTPError):
+            connection.get_treatments(1)
+    assert not connection.breaker.allow()
+
+
+def test_client_errors_do_not_reset_the_circuit(server):
+    connection = connection_to(server)
+    connection.breaker.record_failure()
+
+    server.status = 404
+    with pytest.raises(requests.HTTPError):
+        connection.get_treatments(1)
+    assert connection.breaker.failures == 1
+
+    server.status = 200
+    assert connection.get_treatments(1) == []
+    assert connection.breaker.failures == 0
+
+
+def test_retries_stop_at_the_deadline(server):
+    server.status = 503
+    connection = Connection(f"http://127.0.0.1:{server.server_address[1]}", "secret",
+                            connect_timeout=0.2, retries=20, backoff=0.05, deadline=1)
+    started = time.monotonic()
+    with pytest.raises(requests.HTTPError):
+        connection.get_treatments(1)
+    assert time.monotonic() - started < 1.5
+    assert 1 < server.requests < 20
+
+
+def test_read_timeout_is_cut_to_the_deadline(server):
+    server.delay = 2
+    connection = Connection(f"http://127.0.0.1:{server.server_address[1]}", "secret",
+                            read_timeout=15, retries=3, backoff=0, deadline=0.5)
+    started = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        connection.get_treatments(1)
+    assert time.monotonic() - started < 1.5
+    assert server.requests == 1
@@ -0,0 +1,143 @@
+import math
+import random
+
+import pytest
+
+from CGMTelegramBot import settings
+from CGMTelegramBot.CGMPredictor.analyzer_data import AnalyzerData
+from CGMTelegramBot.CGMPredictor.data import Measure, Treatment
+from CGMTelegramBot.CGMPredictor.forecast import (
+    CARBS_ON_BOARD, HORIZONS, INSULIN_ON_BOARD, LAGS, LAG_WEIGHTS, TREND_DAMPING, Forecaster, on_board
+)
+from CGMTelegramBot.CGMPredictor.forecast_fit import least_squares
+
+from tools.synthetic import generate_trace
+
+
+MINUTE = 60 * 1000
+READING_INTERVAL = 5 * MINUTE
+END = 1_600_000_000_000
+
+
+def line(slope: float, last: int = 150, readings: int = 16) -> AnalyzerData:
+    # Readings every 5 minutes ending at END with `last`, changing `slope` per reading.
+    return AnalyzerData(
+        [Measure(END - i * READING_INTERVAL, round(last - i * slope), "Flat") for i in range(readings)], []
+    )
+
+
+def test_straight_line_is_extrapolated():
+    # Only the newest delta, repeated over every 5 minutes of the horizon.
+    coefficients = {h: [h / 5] + [0.0] * (LAGS - 1) + [0.0, 0.0] for h in HORIZONS}
+    forecast = Forecaster(coefficients).forecast(line(4))
+    assert forecast.sgv == 150
+    assert forecast.sgvs == pytest.approx((162, 174, 186))
+
+
+def test_default_trend_is_damped():
+    # Every lag is the same delta, the lag weights add up to 1.
+    forecast = Forecaster().forecast(line(-3))
+    for horizon, sgv in zip(HORIZONS, forecast.sgvs):
+        gain = sum(TREND_DAMPING ** step for step in range(1, horizon // 5 + 1))
+        assert sgv == pytest.approx(150 - 3 * gain * sum(LAG_WEIGHTS))
+    assert forecast.sgvs[0] > forecast.sgvs[1] > forecast.sgvs[2]
+
+
+def test_gap_between_readings_has_no_forecast():
+    measures = line(0).measures
+    measures[-3] = Measure(measures[-3].date - 5 * MINUTE, 150, "Flat")
+    del measures[-4]
+    assert Forecaster().forecast(AnalyzerData(measures, [])) is None
+    assert Forecaster().forecast(line(0, readings=LAGS)) is None
+
+
+def carbs_fraction(minutes: int, duration: int = settings.FORECAST_CARBS_DURATION) -> float:
+    # Triangular absorption, by hand.
+    if minutes >= duration:
+        return 0.0
+    if minutes < duration / 2:
+        return 1 - 2 * minutes ** 2 / duration ** 2
+    return 2 * (duration - minutes) ** 2 / duration ** 2
+
+
+def insulin_fraction(minutes: int, duration: int = settings.FORECAST_INSULIN_DURATION,
+                     peak: int = settings.FORECAST_INSULIN_PEAK) -> float:
+    # oref0 exponential insulin on board, by hand.
+    if minutes >= duration:
+        return 0.0
+    tau = peak * (1 - peak / duration) / (1 - 2 * peak / duration)
+    a = 2 * tau / duration
+    s = 1 / (1 - a + (1 + a) * math.exp(-duration / tau))
+    activity_integral = (minutes ** 2 / (tau * duration * (1 - a)) - minutes / tau - 1) * math.exp(-minutes / tau) + 1
+    return 1 - s * (1 - a) * activity_integral
+
+
+def test_curves():
+    assert CARBS_ON_BOARD[0] == INSULIN_ON_BOARD[0] == pytest.approx(1)
+    assert CARBS_ON_BOARD[60] == pytest.approx(7 / 9)
+    assert CARBS_ON_BOARD[settings.FORECAST_CARBS_DURATION] == 0
+    assert INSULIN_ON_BOARD[settings.FORECAST_INSULIN_DURATION] == 0
+    assert INSULIN_ON_BOARD[-1] == 0
+    for minutes in (1, 30, 75, 90, 150, 179):
+        assert CARBS_ON_BOARD[minutes] == pytest.approx(carbs_fraction(minutes))
+    for minutes in (1, 30, 75, 150, 299):
+        assert INSULIN_ON_BOARD[minutes] == pytest.approx(insulin_fraction(minutes))
+    # Insulin on board only decreases.
+    assert all(later <= earlier for earlier, later in zip(INSULIN_ON_BOARD, INSULIN_ON_BOARD[1:]))
+
+
+def test_treatments_on_board():
+    data = AnalyzerData([], [
+        Treatment(END - 60 * MINUTE, 30, None),
+        Treatment(END - 200 * MINUTE, 20, None),  # Absorbed already.
+        Treatment(END - 45 * MINUTE, None, 2),
+        Treatment(END + 5 * MINUTE, 50, None),  # Not known yet at END.
+    ])
+
+    carbs, carbs_excess = on_board(data.carbs_index, CARBS_ON_BOARD, END, HORIZONS)
+    assert carbs == pytest.approx(30 * carbs_fraction(60))
+    rate = carbs_fraction(60) - carbs_fraction(61)
+    for horizon, excess in zip(HORIZONS, carbs_excess):
+        expected = 30 * (carbs_fraction(60) - carbs_fraction(60 + horizon) - rate * horizon)
+        assert excess == pytest.approx(expected)
+
+    insulin, insulin_excess = on_board(data.insulin_index, INSULIN_ON_BOARD, END, HORIZONS)
+    assert insulin == pytest.approx(2 * insulin_fraction(45))
+    rate = insulin_fraction(45) - insulin_fraction(46)
+    for horizon, excess in zip(HORIZONS, insulin_excess):
+        expected = 2 * (insulin_fraction(45) - insulin_fraction(45 + horizon) - rate * horizon)
+        assert excess == pytest.approx(expected)
+
+
+def test_treatments_move_the_default_forecast():
+    flat = line(0)
+    treated = AnalyzerData(flat.measures, [Treatment(END - 10 * MINUTE, None, 3)])
+    forecast = Forecaster().forecast(treated)
+    assert forecast.insulin_on_board == pytest.approx(3 * insulin_fraction(10))
+    # A bolus still ramping up lowers the forecast of a flat line.
+    assert all(sgv < 150 for sgv in forecast.sgvs)
+
+
+def test_forecast_many_matches_forecast():
+    datas = []
+    for seed in range(6):
+        entries, treatments = generate_trace(40, end=END, seed=seed, meals_per_day=12)
+        datas.append(AnalyzerData([Measure.from_json(e) for e in entries], [Treatment.from_json(t) for t in treatments]))
+    datas += [None, line(2, readings=3), AnalyzerData([], [])]
+
+    forecaster = Forecaster()
+    expected = [forecaster.forecast(d) if d is not None else None for d in datas]
+    assert forecaster.forecast_many(datas) == expected
+    assert sum(f is not None for f in expected) >= 6
+
+
+def test_least_squares_recovers_known_coefficients():
+    rng = random.Random(0)
+    coefficients = [1.5, -0.4, 0.2, 0.0, 3.0, -2.0, -50.0, 5.0]
+    rows = [[rng.uniform(-5, 5) for _ in coefficients] for _ in range(500)]
+    targets = [sum(c * x for c, x in zip(coefficients, row)) for row in rows]
+    assert least_squares(rows, targets) == pytest.approx(coefficients, abs=1e-6)
+
+    # With noise, close to the coefficients.
+    noisy = [target + rng.gauss(0, 0.5) for target in targets]
+    assert least_squares(rows, noisy) == pytest.approx(coefficients, abs=0.1)
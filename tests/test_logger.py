@@ -0,0 +1,15 @@
+import logging
+
+from CGMTelegramBot import logger, settings
+
+
+def test_import_sets_up_no_logging():
+    # The queue and its listener thread are only set up by main.py, see setup_logging.
+    assert not any(isinstance(handler, logger.AsyncQueueHandler) for handler in logging.getLogger().handlers)
+
+
+def test_glucose_redaction(monkeypatch):
+    monkeypatch.setattr(settings, "LOG_REDACT", True)
+    assert "%s" % logger.glucose(123) == "<glucose>"
+    monkeypatch.setattr(settings, "LOG_REDACT", False)
+    assert "%s" % logger.glucose(123) == "123"
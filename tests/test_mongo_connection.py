@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+from CGMTelegramBot.CGMPredictor import mongo_connection
+from CGMTelegramBot.CGMPredictor.data import Measure, Treatment, columns_from_json
+from CGMTelegramBot.CGMPredictor.mongo_connection import MongoConnection
+
+from tools.mongo_seed import seed_database
+from tools.synthetic import generate_trace
+
+
+END = 1_600_000_000_000
+
+# Set to run against a local mongod (e.g. mongodb://localhost:27017/), its
+# cgm_test database is dropped. Otherwise mongomock stands in for the server.
+MONGO_TEST_URL = os.environ.get("MONGO_TEST_URL")
+
+
+@pytest.fixture
+def trace():
+    entries, treatments = generate_trace(600, end=END, seed=2, meals_per_day=8)
+    entries.append({"date": END - 1000, "mbg": 120, "type": "mbg"})  # A meter reading, no sgv.
+    return entries, treatments
+
+
+@pytest.fixture
+def connection(trace, monkeypatch):
+    if MONGO_TEST_URL:
+        url = MONGO_TEST_URL.rstrip("/") + "/cgm_test"
+    else:
+        mongomock = pytest.importorskip("mongomock")
+        monkeypatch.setattr(mongo_connection.pymongo, "MongoClient", mongomock.MongoClient)
+        url = "mongodb://localhost:27017/cgm_test"
+
+    connection = MongoConnection(url)
+    seed_database(connection.database, *trace, until=2 * END)
+    yield connection
+    connection.database.entries.drop()
+    connection.database.treatments.drop()
+    connection.close()
+
+
+def expected_columns(entries: list[dict], keep=lambda date: True) -> tuple:
+    sgv_entries = [e for e in entries if e.get("type") == "sgv" and keep(e["date"])]
+    return columns_from_json(sorted(sgv_entries, key=lambda e: e["date"], reverse=True))
+
+
+def expected_treatments(treatments: list[dict], keep=lambda date: True) -> list[Treatment]:
+    return sorted((Treatment.from_json(t) for t in treatments if keep(t["mills"])), key=lambda t: -t.date)
+
+
+def test_measure_columns(connection, trace):
+    entries, _ = trace
+    newest = sorted(e["date"] for e in entries if e.get("type") == "sgv")[-16:]
+    assert connection.get_measure_columns(16) == expected_columns(entries, lambda date: date >= newest[0])
+
+
+def test_measure_columns_since(connection, trace):
+    entries, _ = trace
+    since = entries[10]["date"]
+    assert connection.get_measure_columns_since(since, 100) == expected_columns(entries, lambda date: date > since)
+
+
+def test_measure_columns_between(connection, trace):
+    entries, _ = trace
+    dates = sorted(e["date"] for e in entries if e.get("type") == "sgv")
+    start, end = dates[100], dates[180]
+    columns = connection.get_measure_columns_between(start, end, page_size=7)
+    assert columns == expected_columns(entries, lambda date: start <= date < end)
+    assert len(columns[0]) == 80
+
+
+def test_treatments(connection, trace):
+    _, treatments = trace
+    assert len(treatments) > 2
+
+    assert connection.get_treatments(5) == expected_treatments(treatments)[:5]
+
+    since = treatments[-1]["mills"]
+    assert connection.get_treatments_since(since, 100) == expected_treatments(treatments, lambda date: date > since)
+
+    start, end = treatments[-1]["mills"], treatments[1]["mills"]
+    assert connection.get_treatments_between(start, end, 100) == expected_treatments(
+        treatments, lambda date: start <= date < end
+    )
+
+
+def test_latest_measure(connection, trace):
+    entries, _ = trace
+    newest = max((e for e in entries if e.get("type") == "sgv"), key=lambda e: e["date"])
+    assert connection.latest_measure() == Measure.from_json(newest)
@@ -0,0 +1,118 @@
+import itertools
+
+from CGMTelegramBot import settings
+from CGMTelegramBot.CGMPredictor.analyzer_data import AnalyzerData
+from CGMTelegramBot.CGMPredictor.data import Measure, Treatment
+from CGMTelegramBot.CGMPredictor.rules import RULES, RuleWindows, first_matching_rule, rule_predicted_hypoglycemia
+from CGMTelegramBot.CGMPredictor.utils import date_seconds_diff_to_now, frozen_time
+
+from tools.synthetic import generate_trace
+
+
+def trace_data(readings: int, seed: int) -> tuple[list[Measure], list[Treatment]]:
+    entries, treatments = generate_trace(readings, end=1_600_000_000_000, seed=seed)
+    return [Measure.from_json(e) for e in entries], [Treatment.from_json(t) for t in treatments]
+
+
+# Filters of every rule, as given to rule_filter_wrap:
+# (newest, max_measures_minutes_elapsed, max_minutes_date_diff_to_now).
+RULE_FILTERS = {
+    "rule_imminent_hypoglycemia": (6, 12, 10),
+    "rule_predicted_hypoglycemia": (None, None, 10),
+    "rule_fast_rising": (7, 12, 10),
+    "rule_stable_over_limit": (10, 12, 10),
+    "rule_no_new_data": (None, None, None),
+}
+
+
+def baseline_apply_rules(measures: list[Measure], treatments: list[Treatment]):
+    # The apply_rules before RuleWindows: every rule filters its own copy of
+    # the newest measures, then its body runs on that copy.
+    for rule in RULES:
+        newest, max_elapsed, max_diff = RULE_FILTERS[rule.__name__]
+        data = AnalyzerData(measures[-newest:] if newest else measures, treatments)
+
+        if max_elapsed and max(data.measures_seconds_elapsed) > (60 * max_elapsed):
+            continue
+        if max_diff and date_seconds_diff_to_now(data.measures[-1].date) > (60 * max_diff):
+            continue
+
+        result = rule.__wrapped__(data)
+        if result.matches:
+            return rule, result
+    return None
+
+
+def test_rule_filters_are_up_to_date():
+    assert set(RULE_FILTERS) == {rule.__name__ for rule in RULES}
+    assert all(RULE_FILTERS[rule.__name__][0] == rule.newest for rule in RULES)
+
+
+def falling_and_rising_windows():
+    # Straight lines ending around the hypoglycemia and fast rising thresholds,
+    # with and without a recent carb or insulin treatment.
+    interval = 5 * 60 * 1000
+    end = 1_600_000_000_000
+    for last in range(70, 200, 6):
+        for rate in (-8, -5, -3, -2, 0, 3, 6, 9):
+            measures = [Measure(end - i * interval, last - i * rate, "Flat") for i in reversed(range(16))]
+            yield measures, []
+            yield measures, [Treatment(end - 10 * 60 * 1000, 20, None)]
+            yield measures, [Treatment(end - 60 * 60 * 1000, None, 2), Treatment(end - 60 * 60 * 1000, 15, None)]
+
+
+def synthetic_windows():
+    for seed in range(4):
+        measures, treatments = trace_data(600, seed)
+        measures.reverse()
+        for end in range(16, len(measures)):
+            yield measures[end - 16:end], treatments
+
+
+def test_first_matching_rule_matches_the_baseline_apply_rules(monkeypatch):
+    monkeypatch.setattr(settings, "FORECAST_ALERTS", True)
+    matched = set()
+    for window, treatments in itertools.chain(synthetic_windows(), falling_and_rising_windows()):
+        data = AnalyzerData(window, treatments)
+        for minutes in (1, 8, 30):
+            with frozen_time(window[-1].date + minutes * 60 * 1000):
+                expected = baseline_apply_rules(window, treatments)
+                match = first_matching_rule(data)
+            assert (match and (match[0], match[1].message)) == (expected and (expected[0], expected[1].message))
+            if match:
+                matched.add(match[0])
+    assert matched == set(RULES)
+
+
+def test_short_windows_never_reach_the_rule_bodies():
+    measures, treatments = trace_data(16, 0)
+    measures.reverse()
+    for size in range(len(measures)):
+        data = AnalyzerData(measures[len(measures) - size:], treatments)
+        with frozen_time(measures[-1].date + 60 * 1000):
+            match = first_matching_rule(data)
+        assert match is None or (match[0].newest or 1) <= size
+
+
+def test_falling_readings_in_a_short_window():
+    # Two readings: the time filters pass, but rule_imminent_hypoglycemia needs 6.
+    data = AnalyzerData([Measure(0, 100, "FortyFiveDown"), Measure(300_000, 95, "FortyFiveDown")], [])
+    with frozen_time(360_000):
+        assert first_matching_rule(data) is None
+
+
+def test_no_measures():
+    data = AnalyzerData([], [])
+    assert RuleWindows(data).newest_measure_seconds_to_now() is None
+    assert first_matching_rule(data) is None
+
+
+def test_predicted_hypoglycemia_is_off_by_default(monkeypatch):
+    assert not settings.FORECAST_ALERTS
+    # Falling 10 mg/dL per reading, forecast well under FORECAST_LOW.
+    end = 1_600_000_000_000
+    data = AnalyzerData([Measure(end - i * 300_000, 90 + i * 10, "DoubleDown") for i in range(16)], [])
+    with frozen_time(end + 60 * 1000):
+        assert not rule_predicted_hypoglycemia(data).matches
+        monkeypatch.setattr(settings, "FORECAST_ALERTS", True)
+        assert rule_predicted_hypoglycemia(data).matches
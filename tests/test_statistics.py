@@ -0,0 +1,77 @@
+import math
+import random
+from array import array
+
+import pytest
+
+from CGMTelegramBot.CGMPredictor.statistics import DAY_IN_MILLISECONDS, READING_INTERVAL, RollingStatistics
+
+from tools.synthetic import generate_trace
+
+
+LOW = 75
+HIGH = 220
+WINDOWS = (1, 7, 14)
+
+
+def full_recomputation(readings: list[tuple[int, int]], days: float, now: int) -> dict:
+    length = days * DAY_IN_MILLISECONDS
+    sgvs = [sgv for date, sgv in sorted(readings) if date > now - length]
+    count = len(sgvs)
+    result = {"readings": count, "coverage": min(1.0, count * READING_INTERVAL / length)}
+    if count == 0:
+        return result
+
+    mean = sum(sgvs) / count
+    sd = math.sqrt(sum((sgv - mean) ** 2 for sgv in sgvs) / (count - 1)) if count > 1 else None
+    below = sum(sgv <= LOW for sgv in sgvs)
+    above = sum(sgv >= HIGH for sgv in sgvs)
+    events = sum(sgv <= LOW and (i == 0 or sgvs[i - 1] > LOW) for i, sgv in enumerate(sgvs))
+    result.update(
+        mean=mean, sd=sd, gmi=3.31 + 0.02392 * mean,
+        below=below / count, in_range=(count - below - above) / count, above=above / count,
+        hypo_events=events,
+    )
+    return result
+
+
+def assert_matches(statistics: RollingStatistics, readings: list[tuple[int, int]], now: int) -> None:
+    for window in statistics.statistics(now):
+        expected = full_recomputation(readings, window.days, now)
+        for name, value in expected.items():
+            if value is None:
+                assert getattr(window, name) is None
+            else:
+                assert getattr(window, name) == pytest.approx(value), (window.days, name)
+
+
+def test_incremental_statistics_match_a_full_recomputation():
+    rng = random.Random(0)
+    # Wide swings, so there are lows, highs and hypo events.
+    entries, _ = generate_trace(20 * 288, end=1_600_000_000_000, seed=3, meals_per_day=8)
+    trace = sorted((e["date"], e["sgv"]) for e in entries)
+
+    statistics = RollingStatistics(WINDOWS, LOW, HIGH)
+    received = []
+    held_back = []
+    position = 0
+    while position < len(trace):
+        batch = trace[position:position + rng.randint(1, 12)]
+        position += len(batch)
+        # Late uploads, older than readings already added, and readings sent again.
+        batch, held_back = sorted(batch + held_back), []
+        if len(batch) > 1 and rng.random() < 0.05:
+            held_back.append(batch.pop(rng.randrange(len(batch) - 1)))
+        if received and rng.random() < 0.1:
+            batch = sorted(set(batch + [rng.choice(received)]))
+
+        now = batch[-1][0]
+        statistics.add_columns(array("q", [d for d, _ in batch]), array("l", [s for _, s in batch]), now=now)
+        received = sorted(set(received + batch))
+
+        if rng.random() < 0.1:
+            assert_matches(statistics, received, now)
+
+    # Readings expire from every window as time goes on.
+    for days in (0, 1, 7, 14, 15):
+        assert_matches(statistics, received, received[-1][0] + days * DAY_IN_MILLISECONDS)
@@ -0,0 +1,34 @@
+from CGMTelegramBot import userdata
+from CGMTelegramBot.userdata import UserDataManager
+
+
+def test_is_muted_until_the_mute_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(userdata.time, "time", lambda: now[0])
+
+    manager = UserDataManager()
+    manager.init_username("alice")
+    manager.init_username("bob")
+    manager.silence_username_for_minutes("alice", 20)
+
+    assert manager.is_muted("alice")
+    assert not manager.is_muted("bob")
+    assert not manager.is_muted("unknown")
+
+    now[0] += 20 * 60
+    assert not manager.is_muted("alice")
+
+
+def test_unmute_replaces_the_pending_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(userdata.time, "time", lambda: now[0])
+
+    manager = UserDataManager()
+    manager.init_username("alice")
+    manager.silence_username_for_minutes("alice", 20)
+    manager.unmute_username("alice")
+    assert not manager.is_muted("alice")
+
+    manager.silence_username_for_minutes("alice", 40)
+    now[0] += 30 * 60
+    assert manager.is_muted("alice")
@@ -0,0 +1,95 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from CGMTelegramBot.webhook import SECRET_TOKEN_HEADER, WebhookServer, content_length
+
+
+UPDATE = json.dumps({"update_id": 1, "message": {"text": "/g"}}).encode()
+
+
+@pytest.fixture
+def webhook():
+    processed = []
+    done = threading.Event()
+
+    def process_update(data):
+        processed.append(data)
+        done.set()
+
+    server = WebhookServer(
+        process_update, listen="127.0.0.1", port=0, path="/telegram", secret_token="token",
+        max_body=1024, cert=None, key=None,
+    )
+    server.processed = processed
+    server.done = done
+    server.start()
+    yield server
+    server.stop()
+
+
+def post(server: WebhookServer, headers: dict, body: bytes = b"", path: str = "/telegram") -> int:
+    # Raw request, so malformed headers are sent as they are.
+    request = f"POST {path} HTTP/1.1\r\nHost: localhost\r\n"
+    request += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as connection:
+        connection.sendall(request.encode() + b"\r\n" + body)
+        status_line = connection.makefile("rb").readline()
+    return int(status_line.split()[1])
+
+
+def valid_headers(body: bytes) -> dict:
+    return {"Content-Length": len(body), SECRET_TOKEN_HEADER: "token"}
+
+
+def test_content_length():
+    assert content_length("12") == 12
+    assert content_length(" 0 ") == 0
+    assert content_length(None) is None
+    assert content_length("") is None
+    assert content_length("-1") is None
+    assert content_length("1e3") is None
+    assert content_length("١٢") is None
+
+
+def test_update_is_processed(webhook):
+    assert post(webhook, valid_headers(UPDATE), UPDATE) == 200
+    assert webhook.done.wait(5)
+    assert webhook.processed == [json.loads(UPDATE)]
+
+
+def test_missing_content_length(webhook):
+    assert post(webhook, {SECRET_TOKEN_HEADER: "token"}, UPDATE) == 400
+
+
+def test_non_numeric_content_length(webhook):
+    assert post(webhook, {"Content-Length": "abc", SECRET_TOKEN_HEADER: "token"}, UPDATE) == 400
+
+
+def test_oversized_body(webhook):
+    body = b"[" + b"0," * 1024 + b"0]"
+    assert post(webhook, valid_headers(body), body) == 413
+
+
+def test_invalid_json(webhook):
+    assert post(webhook, valid_headers(b"{"), b"{") == 400
+
+
+def test_body_that_is_not_an_object(webhook):
+    # null used to be queued as the worker's stop signal, ending the processing.
+    for body in (b"null", b"[]", b"1"):
+        assert post(webhook, valid_headers(body), body) == 400
+
+    assert post(webhook, valid_headers(UPDATE), UPDATE) == 200
+    assert webhook.done.wait(5)
+    assert webhook.processed == [json.loads(UPDATE)]
+    assert webhook.stats.accepted == 1
+
+
+def test_wrong_secret_token_and_path(webhook):
+    assert post(webhook, {"Content-Length": len(UPDATE), SECRET_TOKEN_HEADER: "wrong"}, UPDATE) == 403
+    assert post(webhook, valid_headers(UPDATE), UPDATE, path="/other") == 404
+    assert webhook.stats.rejected == 2
+    assert webhook.processed == []
@@ -0,0 +1,212 @@
+# Benchmarks the CGMPredictor hot path on synthetic traces.
+#
+#   python -m tools.benchmark --output bench.json
+#   python -m tools.benchmark --compare bench.json
+#
+# Stages: Measure.from_json, decoding a response body into columns (as Connection
+# does), AnalyzerData.__init__, AnalyzerData.merged (one new reading), apply_rules,
+# Measure.message, the forecast, a full tick and a batched forecast for N patients.
+# Results are JSON so runs of different commits can be compared, --compare exits
+# with 1 when a stage got slower than the tolerance.
+
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from typing import Callable
+
+from CGMTelegramBot.CGMPredictor.analyzer_data import AnalyzerData
+from CGMTelegramBot.CGMPredictor.connection import loads
+from CGMTelegramBot.CGMPredictor.data import Measure, Treatment, columns_from_json
+from CGMTelegramBot.CGMPredictor.forecast import FORECASTER
+from CGMTelegramBot.CGMPredictor.rules import apply_rules
+from CGMTelegramBot.CGMPredictor.utils import frozen_time
+
+from .synthetic import generate_trace, READING_INTERVAL
+
+
+WINDOW_SIZES = (16, 100, 1000, 10000)
+PATIENTS = (1, 10, 100)
+
+
+def time_per_call(function: Callable, min_time: float = 0.2, repeats: int = 5) -> tuple[float, int]:
+    # Calibrates the loops to take at least min_time, returns the best of the repeats.
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        best = min(best, time.perf_counter() - start)
+
+    return best / loops, loops
+
+
+def patient_data(window_size: int, seed: int) -> tuple[AnalyzerData, Measure]:
+    # Window data plus the next reading, to be merged in a tick.
+    entries, treatments = generate_trace(window_size + 1, seed=seed)
+    measures = [Measure.from_json(d) for d in entries]
+    next_measure = measures[0]
+    data = AnalyzerData(measures[1:], [Treatment.from_json(t) for t in treatments[:window_size]])
+    return data, next_measure
+
+
+def stage_results(window_size: int, min_time: float) -> list[dict]:
+    entries, treatments = generate_trace(window_size + 1)
+    entries_json = entries[1:]
+    treatments_json = treatments[:window_size]
+
+    measures = [Measure.from_json(d) for d in entries_json]
+    treatment_list = [Treatment.from_json(t) for t in treatments_json]
+    data = AnalyzerData(measures, treatment_list)
+    next_measure = Measure.from_json(entries[0])
+    newest = data.latest_measure()
+    # Response body with the fields Connection requests.
+    entries_body = json.dumps([{"date": d["date"], "sgv": d["sgv"], "direction": d["direction"]} for d in entries_json]).encode()
+
+    def parse():
+        [Measure.from_json(d) for d in entries_json]
+        [Treatment.from_json(t) for t in treatments_json]
+
+    def decode():
+        columns_from_json(loads(entries_body))
+
+    def build():
+        AnalyzerData(measures, treatment_list)
+
+    def merge():
+        data.merged([next_measure], [], window_size)
+
+    def rules():
+        with frozen_time(data.newest_measure_date + READING_INTERVAL // 2):
+            apply_rules(data)
+
+    def message():
+        newest.message()
+
+    def forecast():
+        FORECASTER.forecast(data)
+
+    stages = (
+        ("parse", parse), ("decode", decode), ("build", build), ("merge", merge), ("rules", rules),
+        ("message", message), ("forecast", forecast),
+    )
+
+    results = []
+    for name, function in stages:
+        seconds, loops = time_per_call(function, min_time)
+        results.append({"stage": name, "window": window_size, "patients": 1, "seconds": seconds, "loops": loops})
+    return results
+
+
+def tick_results(window_size: int, patients: int, min_time: float) -> dict:
+    # One poll for every patient: merge the new reading, apply the rules and
+    # build the reading message, as CGMBot.periodic_check_function does.
+    patients_data = [patient_data(window_size, seed) for seed in range(patients)]
+
+    def tick():
+        for data, next_measure in patients_data:
+            merged = data.merged([next_measure], [], window_size)
+            with frozen_time(next_measure.date):
+                apply_rules(merged)
+            merged.latest_measure().message()
+
+    seconds, loops = time_per_call(tick, min_time)
+    return {"stage": "tick", "window": window_size, "patients": patients, "seconds": seconds, "loops": loops}
+
+
+def forecast_batch_results(window_size: int, patients: int, min_time: float) -> dict:
+    datas = [patient_data(window_size, seed)[0] for seed in range(patients)]
+    seconds, loops = time_per_call(lambda: FORECASTER.forecast_many(datas), min_time)
+    return {"stage": "forecast_batch", "window": window_size, "patients": patients, "seconds": seconds, "loops": loops}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(window_sizes, patients, min_time: float) -> dict:
+    results = []
+    for window_size in window_sizes:
+        results.extend(stage_results(window_size, min_time))
+        for amount in patients:
+            results.append(tick_results(window_size, amount, min_time))
+            results.append(forecast_batch_results(window_size, amount, min_time))
+
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def result_key(result: dict) -> tuple:
+    return result["stage"], result["window"], result["patients"]
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> bool:
+    # Prints the ratio current / baseline of every stage, False on regressions.
+    baseline_results = {result_key(r): r for r in baseline["results"]}
+    passed = True
+
+    print(f"{'stage':<14} {'window':>7} {'patients':>8} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for result in current["results"]:
+        key = result_key(result)
+        if key not in baseline_results:
+            continue
+        before = baseline_results[key]["seconds"]
+        ratio = result["seconds"] / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            passed = False
+        print(f"{key[0]:<14} {key[1]:>7} {key[2]:>8} {before * 1e6:>10.2f}us {result['seconds'] * 1e6:>10.2f}us {ratio:>7.2f}{flag}")
+
+    return passed
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks parsing, window building and rule evaluation.")
+    parser.add_argument("--windows", type=int, nargs="+", default=WINDOW_SIZES, help="Window sizes, in readings.")
+    parser.add_argument("--patients", type=int, nargs="+", default=PATIENTS, help="Patients per tick.")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds timed per repeat.")
+    parser.add_argument("--output", help="Writes the results to this JSON file.")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown ratio, 0.2 is 20%%.")
+    args = parser.parse_args(argv)
+
+    current = run(args.windows, args.patients, args.min_time)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(current, file, indent=4)
+    elif not args.compare:
+        json.dump(current, sys.stdout, indent=4)
+        print()
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        if not compare(baseline, current, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+# Local stand-in for the Nightscout API, serving synthetic or recorded traces.
+#
+#   python -m tools.fake_nightscout --patients 10 --port 1337
+#   python -m tools.fake_nightscout --entries entries.json --treatments treatments.json
+#
+# Every patient is served under its own prefix, /<patient>/api/v1/entries and
+# /<patient>/api/v1/treatments, so a Connection url is http://host:port/<patient>.
+# Only readings dated up to the server clock are served, so new readings show
+# up as time passes (--speed replays faster than real time). Latency, transient
+# errors and payload sizes can be configured to exercise the retry paths. The
+# fields parameter projects the documents, as a Nightscout with projection would.
+#
+# /<patient>/socket.io/ is a socket.io (Engine.IO 4, websocket transport)
+# endpoint as Nightscout's: after authorize it sends the last history hours
+# as a dataUpdate, then a delta dataUpdate as soon as new readings show up.
+# drop_push_connections() closes every socket, to exercise the reconnects.
+
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from CGMTelegramBot.CGMPredictor.backtest import iter_json_array, treatment_from_export
+from CGMTelegramBot.CGMPredictor.websocket import WebSocket, WebSocketClosed, accept_key
+
+from .synthetic import generate_trace, iso_date, READING_INTERVAL
+
+
+API_PREFIX = "/api/v1/"
+SOCKET_PATH = "/socket.io/"
+HOUR_IN_MILLISECONDS = 60 * 60 * 1000
+
+
+def milliseconds_now() -> int:
+    return int(time.time() * 1000)
+
+
+class FakePatient:
+
+    # Entries and treatments sorted by date, oldest first, for bisect lookups.
+
+    def __init__(self, entries: list[dict], treatments: list[dict]):
+        self.entries = sorted(entries, key=lambda e: e["date"])
+        self.entry_dates = [e["date"] for e in self.entries]
+        for treatment in treatments:
+            treatment.setdefault("mills", treatment_from_export(treatment).date)
+            treatment.setdefault("created_at", iso_date(treatment["mills"]))
+        self.treatments = sorted(treatments, key=lambda t: t["mills"])
+        self.treatment_dates = [t["mills"] for t in self.treatments]
+
+
+class FakeNightscoutStats:
+
+    __slots__ = ("requests", "errors", "not_found", "unauthorized", "push_connections", "push_updates")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.not_found = 0
+        self.unauthorized = 0
+        self.push_connections = 0  # Authorized sockets.
+        self.push_updates = 0  # dataUpdate events sent.
+
+
+def socket_entry(entry: dict) -> dict:
+    # Entries in the socket are shaped as Nightscout's ddata sgvs.
+    return {
+        "_id": entry.get("_id"), "mgdl": entry["sgv"], "mills": entry["date"],
+        "direction": entry.get("direction"), "device": entry.get("device"), "type": "sgv",
+    }
+
+
+class FakePushSession:
+
+    # One socket.io connection. Client packets are read on the HTTP handler
+    # thread, pings and updates are sent from a second thread.
+
+    def __init__(self, server: "FakeNightscout", patient: FakePatient, websocket: WebSocket):
+        self.server = server
+        self.patient = patient
+        self.websocket = websocket
+        self.sent_until = None  # Date up to which readings were sent, in milliseconds.
+        self.stopping = threading.Event()
+
+
+    def send(self, packet: str) -> None:
+        self.websocket.send_text(packet)
+
+
+    def run(self) -> None:
+        server = self.server
+        self.send("0" + json.dumps({
+            "sid": uuid.uuid4().hex, "upgrades": [], "maxPayload": 1000000,
+            "pingInterval": int(server.ping_interval * 1000), "pingTimeout": int(server.ping_timeout * 1000),
+        }))
+        try:
+            while True:
+                packet = self.websocket.recv()
+                if packet == "40":
+                    self.send("40" + json.dumps({"sid": uuid.uuid4().hex}))
+                elif packet.startswith("42"):
+                    self.__event(packet[2:])
+        except (OSError, WebSocketClosed):
+            pass
+        finally:
+            self.stopping.set()
+            self.websocket.close()
+
+
+    def __event(self, body: str) -> None:
+        ack_id, _, message = body.partition("[")
+        event, *args = json.loads("[" + message)
+        if event != "authorize":
+            return
+
+        secret = (args[0] if args else {}).get("secret")
+        authorized = self.server.api_secret is None or secret == self.server.api_secret
+        self.send(f"43{ack_id}" + json.dumps([{"read": authorized, "write": False, "write_treatment": False}]))
+        if not authorized:
+            return
+
+        self.server.count_push("push_connections", self)
+        history = (args[0] if args else {}).get("history", 48)
+        self.sent_until = self.server.clock() - int(history * HOUR_IN_MILLISECONDS)
+        self.__send_update(delta=False)
+        threading.Thread(target=self.__push, name="FakePush", daemon=True).start()
+
+
+    def __send_update(self, delta: bool) -> None:
+        now = self.server.clock()
+        patient = self.patient
+        entries = patient.entries[
+            bisect_right(patient.entry_dates, self.sent_until):bisect_right(patient.entry_dates, now)
+        ]
+        treatments = patient.treatments[
+            bisect_right(patient.treatment_dates, self.sent_until):bisect_right(patient.treatment_dates, now)
+        ]
+        self.sent_until = now
+        if delta and not entries and not treatments:
+            return
+
+        self.server.count_push("push_updates")
+        self.send("42" + json.dumps(["dataUpdate", {
+            "lastUpdate": now, "delta": delta,
+            "sgvs": [socket_entry(e) for e in entries], "treatments": treatments,
+        }]))
+
+
+    def __push(self) -> None:
+        next_ping = time.monotonic() + self.server.ping_interval
+        try:
+            while not self.stopping.wait(self.server.push_check_interval):
+                self.__send_update(delta=True)
+                if time.monotonic() >= next_ping:
+                    self.send("2")
+                    next_ping += self.server.ping_interval
+        except OSError:
+            self.websocket.close()
+
+
+class FakeNightscout:
+
+    def __init__(self, patients: dict[str, FakePatient], listen: str = "127.0.0.1", port: int = 0,
+                 api_secret: Optional[str] = None, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 503, padding: int = 0,
+                 clock: Callable[[], int] = milliseconds_now, seed: int = 0,
+                 ping_interval: float = 25, ping_timeout: float = 20, push_check_interval: float = 0.05):
+        # latency and jitter in seconds, padding in bytes added to every document.
+        # ping_interval, ping_timeout and push_check_interval (how often the
+        # sockets look for new readings) in seconds.
+        self.patients = patients
+        self.api_secret = api_secret
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.padding = "x" * padding
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.push_check_interval = push_check_interval
+        self.stats = FakeNightscoutStats()
+        self.push_sessions = set()
+        self.lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((listen, port), self.__handler_class())
+        self.httpd.daemon_threads = True
+        self.server_thread = None
+
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+    def patient_url(self, name: str) -> str:
+        return f"{self.url}/{name}" if name else self.url
+
+
+    def __handler_class(self):
+        server = self
+
+        class FakeNightscoutHandler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if SOCKET_PATH in self.path and self.headers.get("Upgrade", "").lower() == "websocket":
+                    server.serve_socket(self)
+                    return
+
+                status, body = server.respond(self.path, self.headers)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeNightscoutHandler
+
+
+    def __count(self, name: str) -> None:
+        with self.lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+
+    def count_push(self, name: str, session: Optional[FakePushSession] = None) -> None:
+        self.__count(name)
+        if session is not None:
+            with self.lock:
+                self.push_sessions.add(session)
+
+
+    def serve_socket(self, handler: BaseHTTPRequestHandler) -> None:
+        prefix = urlsplit(handler.path).path.partition(SOCKET_PATH)[0]
+        patient = self.patients.get(prefix.strip("/"))
+        key = handler.headers.get("Sec-WebSocket-Key")
+        if patient is None or key is None:
+            self.__count("not_found")
+            handler.send_error(404)
+            return
+
+        handler.send_response(101, "Switching Protocols")
+        handler.send_header("Upgrade", "websocket")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Sec-WebSocket-Accept", accept_key(key))
+        handler.end_headers()
+        handler.close_connection = True
+
+        session = FakePushSession(self, patient, WebSocket(handler.connection, handler.rfile, mask=False))
+        try:
+            session.run()
+        finally:
+            with self.lock:
+                self.push_sessions.discard(session)
+
+
+    def drop_push_connections(self) -> None:
+        with self.lock:
+            sessions = list(self.push_sessions)
+        for session in sessions:
+            session.websocket.close()
+
+
+    def __draw(self) -> tuple[float, bool]:
+        with self.lock:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            fail = self.rng.random() < self.error_rate
+        return delay, fail
+
+
+    def respond(self, path: str, headers) -> tuple[int, bytes]:
+        self.__count("requests")
+        delay, fail = self.__draw()
+        if delay > 0:
+            time.sleep(delay)
+
+        url = urlsplit(path)
+        prefix, found, collection = url.path.partition(API_PREFIX)
+        patient = self.patients.get(prefix.strip("/"))
+        if not found or patient is None or collection not in ("entries", "entries.json", "treatments", "treatments.json"):
+            self.__count("not_found")
+            return 404, b'{"status": 404}'
+
+        if self.api_secret is not None and headers.get("api-secret") != self.api_secret:
+            self.__count("unauthorized")
+            return 401, b'{"status": 401}'
+
+        if fail:
+            self.__count("errors")
+            return self.error_status, json.dumps({"status": self.error_status}).encode()
+
+        query = dict(parse_qsl(url.query))
+        count = int(query.get("count", 10))
+        if collection.startswith("entries"):
+            documents = self.entries(patient, query, count)
+        else:
+            documents = self.treatments(patient, query, count)
+
+        if self.padding:
+            documents = [dict(document, padding=self.padding) for document in documents]
+        if "fields" in query:
+            fields = query["fields"].split(",")
+            documents = [{field: d[field] for field in fields if field in d} for d in documents]
+        return 200, json.dumps(documents).encode()
+
+
+    def entries(self, patient: FakePatient, query: dict, count: int) -> list[dict]:
+        # Newest first, as Nightscout. Supports find[date][$gt|$gte|$lt|$lte].
+        first = 0
+        last = bisect_right(patient.entry_dates, self.clock())
+        if "find[date][$gt]" in query:
+            first = max(first, bisect_right(patient.entry_dates, int(query["find[date][$gt]"])))
+        if "find[date][$gte]" in query:
+            first = max(first, bisect_left(patient.entry_dates, int(query["find[date][$gte]"])))
+        if "find[date][$lt]" in query:
+            last = min(last, bisect_left(patient.entry_dates, int(query["find[date][$lt]"])))
+        if "find[date][$lte]" in query:
+            last = min(last, bisect_right(patient.entry_dates, int(query["find[date][$lte]"])))
+
+        return patient.entries[max(first, last - count):last][::-1]
+
+
+    def treatments(self, patient: FakePatient, query: dict, count: int) -> list[dict]:
+        # Newest first. Supports find[created_at][$gt|$lt], ISO dates as sent by Connection.
+        first = 0
+        last = bisect_right(patient.treatment_dates, self.clock())
+        if "find[created_at][$gt]" in query:
+            date = treatment_from_export({"created_at": query["find[created_at][$gt]"]}).date
+            first = bisect_right(patient.treatment_dates, date)
+        if "find[created_at][$lt]" in query:
+            date = treatment_from_export({"created_at": query["find[created_at][$lt]"]}).date
+            last = min(last, bisect_left(patient.treatment_dates, date))
+
+        return patient.treatments[max(first, last - count):last][::-1]
+
+
+    def start(self) -> None:
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="FakeNightscout", daemon=True)
+        self.server_thread.start()
+
+
+    def stop(self) -> None:
+        self.drop_push_connections()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def synthetic_patients(amount: int, readings: int, end: Optional[int] = None) -> dict[str, FakePatient]:
+    # Patients named patient0, patient1, ... with a different trace each.
+    patients = {}
+    for i in range(amount):
+        entries, treatments = generate_trace(readings, end=end, seed=i)
+        patients[f"patient{i}"] = FakePatient(entries, treatments)
+    return patients
+
+
+def speed_clock(speed: float, start: Optional[int] = None) -> Callable[[], int]:
+    # Trace time running `speed` times faster than real time from `start`.
+    started = milliseconds_now()
+    start = started if start is None else start
+    return lambda: start + int((milliseconds_now() - started) * speed)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Serves fake Nightscout entries and treatments.")
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1337)
+    parser.add_argument("--patients", type=int, default=1, help="Synthetic patients, patient0 to patientN-1.")
+    parser.add_argument("--days", type=float, default=1, help="Days of synthetic readings before now.")
+    parser.add_argument("--entries", help="Recorded JSON array of entries, served as the only patient.")
+    parser.add_argument("--treatments", help="Recorded JSON array of treatments.")
+    parser.add_argument("--api-secret", help="Expected api-secret header.")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with --error-status.")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--padding", type=int, default=0, help="Bytes added to every document.")
+    parser.add_argument("--speed", type=float, default=1, help="Trace time speedup, from the start of the recording.")
+    args = parser.parse_args(argv)
+
+    if args.entries:
+        with open(args.entries, "r") as file:
+            entries = [e for e in iter_json_array(file) if e.get("sgv") is not None and e.get("date") is not None]
+        treatments = []
+        if args.treatments:
+            with open(args.treatments, "r") as file:
+                treatments = list(iter_json_array(file))
+        patients = {"": FakePatient(entries, treatments)}
+        start = min(e["date"] for e in entries) if args.speed != 1 else None
+    else:
+        readings = int(args.days * 24 * 60 * 60 * 1000 / READING_INTERVAL)
+        patients = synthetic_patients(args.patients, readings)
+        start = None
+
+    server = FakeNightscout(
+        patients, args.listen, args.port, args.api_secret,
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate, error_status=args.error_status, padding=args.padding,
+        clock=speed_clock(args.speed, start),
+    )
+    server.start()
+    print(f"Serving {len(patients)} patient(s) at {server.url}")
+    try:
+        server.server_thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# Local stand-in for the Telegram Bot API, recording every sent message.
+#
+#   python -m tools.fake_telegram --port 8081
+#
+# Point the bot at it with settings.TELEGRAM_BASE_URL = "http://127.0.0.1:8081/bot".
+# Sends over the Telegram limits (TELEGRAM_GLOBAL_RATE per second, one message
+# per TELEGRAM_CHAT_INTERVAL per chat) are answered with 429 and retry_after, as
+# the real API does. --flood-probability answers random sends with 429 as well.
+# sendPhoto is accepted as multipart, the photo is recorded with its caption.
+
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from dataclasses import dataclass
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from CGMTelegramBot import settings
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeCGMBot", "username": "fake_cgm_bot"}
+
+
+@dataclass
+class SentMessage:
+    chat_id: int
+    text: str
+    received: float  # time.monotonic() at the server
+    photo: Optional[bytes] = None  # of sendPhoto, text is the caption
+
+
+def multipart_params(content_type: str, body: bytes) -> dict:
+    # Form fields as str, files as bytes.
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    params = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        content = part.get_payload(decode=True)
+        params[name] = content if part.get_filename() else content.decode()
+    return params
+
+
+class FakeTelegram:
+
+    def __init__(self, listen: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 global_rate: Optional[float] = settings.TELEGRAM_GLOBAL_RATE,
+                 chat_interval: Optional[float] = settings.TELEGRAM_CHAT_INTERVAL,
+                 retry_after: int = 1, flood_probability: float = 0.0, seed: int = 0):
+        # global_rate or chat_interval None disables that limit.
+        self.latency = latency
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.retry_after = retry_after
+        self.flood_probability = flood_probability
+        self.rng = random.Random(seed)
+
+        self.sent: list[SentMessage] = []
+        self.rejected = 0  # Sends answered with 429.
+        self.recent_sends = deque()  # monotonic times of the sends in the last second
+        self.last_chat_send = {}
+        self.lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((listen, port), self.__handler_class())
+        self.httpd.daemon_threads = True
+        self.server_thread = None
+
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+
+    def __handler_class(self):
+        server = self
+
+        class FakeTelegramHandler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.__answer({})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                elif content_type.startswith("multipart/form-data"):
+                    params = multipart_params(content_type, body)
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                self.__answer(params)
+
+            def __answer(self, params: dict):
+                url = urlsplit(self.path)
+                params.update(parse_qsl(url.query))
+                status, answer = server.call(url.path.rsplit("/", 1)[-1], params)
+                body = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeTelegramHandler
+
+
+    def call(self, method: str, params: dict) -> tuple[int, dict]:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": []}
+        if method in ("setWebhook", "deleteWebhook"):
+            return 200, {"ok": True, "result": True}
+        if method == "sendMessage":
+            return self.send_message(int(params["chat_id"]), params.get("text", ""))
+        if method == "sendPhoto":
+            return self.send_message(int(params["chat_id"]), params.get("caption", ""), params.get("photo"))
+        return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+
+    def __flood_limited(self, chat_id: int, now: float) -> bool:
+        if self.rng.random() < self.flood_probability:
+            return True
+
+        if self.global_rate is not None:
+            while self.recent_sends and self.recent_sends[0] <= now - 1:
+                self.recent_sends.popleft()
+            if len(self.recent_sends) >= self.global_rate:
+                return True
+
+        if self.chat_interval is not None:
+            last = self.last_chat_send.get(chat_id)
+            if last is not None and now - last < self.chat_interval:
+                return True
+
+        return False
+
+
+    def send_message(self, chat_id: int, text: str, photo: Optional[bytes] = None) -> tuple[int, dict]:
+        with self.lock:
+            now = time.monotonic()
+            if self.__flood_limited(chat_id, now):
+                self.rejected += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+
+            self.recent_sends.append(now)
+            self.last_chat_send[chat_id] = now
+            self.sent.append(SentMessage(chat_id, text, now, photo))
+            message_id = len(self.sent)
+
+        return 200, {"ok": True, "result": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }}
+
+
+    def start(self) -> None:
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="FakeTelegram", daemon=True)
+        self.server_thread.start()
+
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Serves a fake Telegram Bot API recording the sends.")
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--flood-probability", type=float, default=0)
+    parser.add_argument("--no-limits", action="store_true", help="Never answer 429 for the rate limits.")
+    args = parser.parse_args(argv)
+
+    server = FakeTelegram(
+        args.listen, args.port, latency=args.latency_ms / 1000,
+        global_rate=None if args.no_limits else settings.TELEGRAM_GLOBAL_RATE,
+        chat_interval=None if args.no_limits else settings.TELEGRAM_CHAT_INTERVAL,
+        retry_after=args.retry_after, flood_probability=args.flood_probability,
+    )
+    server.start()
+    print(f"Fake Telegram Bot API at {server.base_url}<token>/")
+    try:
+        server.server_thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# Load test of the whole bot against the fake Nightscout and Telegram servers.
+#
+#   python -m tools.load_test --patients 100 --users 2000 --rounds 5
+#   python -m tools.load_test --patients 10 --users 500 --commands 2000 --always-alert
+#
+# A CGMBot is built with the real Connection, Analyzer, rules, storage and
+# MessageSender, pointed at a tools.fake_nightscout and a tools.fake_telegram
+# server. Every round advances the Nightscout clock by one reading and checks
+# all patients on POLL_WORKERS threads, as the PollScheduler does. Commands are
+# fed through the dispatcher as webhook updates. Reports the tick, command and
+# send throughput and their tail latencies as JSON.
+
+import json
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from CGMTelegramBot import settings
+from CGMTelegramBot.bot import CGMBot
+from CGMTelegramBot.patient import PatientConfig
+
+from .fake_nightscout import FakeNightscout, synthetic_patients
+from .fake_telegram import FakeTelegram
+from .synthetic import READING_INTERVAL
+from .webhook_benchmark import percentile
+
+
+SECRET = "load-test-secret"
+TOKEN = "123456:load-test"
+
+
+def command_update(update_id: int, user: int, command: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 10000 + user, "type": "private"},
+            "from": {"id": 10000 + user, "is_bot": False, "first_name": "Load", "username": f"user{user}"},
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def latency_summary(values: list) -> dict:
+    return {
+        "p50_ms": percentile(values, 0.5) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": max(values, default=0) * 1000,
+    }
+
+
+class SendCollector:
+
+    # Collects the delivery futures of every send, the bot does not wait on them.
+
+    def __init__(self, bot: CGMBot):
+        self.futures = []
+        self.lock = threading.Lock()
+        send = bot.sender.send
+
+        def collecting_send(*args, **kwargs):
+            future = send(*args, **kwargs)
+            with self.lock:
+                self.futures.append(future)
+            return future
+
+        bot.sender.send = collecting_send
+
+
+    def results(self, timeout: float) -> list:
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures, timeout=timeout)
+        return [future.result() for future in futures if future.done()]
+
+
+def build_bot(nightscout: FakeNightscout, patients: int, users: int, database_file: str) -> CGMBot:
+    # user j follows patient j % patients.
+    followers = [set() for _ in range(patients)]
+    for user in range(users):
+        followers[user % patients].add(f"user{user}")
+
+    configs = [
+        PatientConfig(f"patient{i}", nightscout.patient_url(f"patient{i}"), SECRET, followers[i])
+        for i in range(patients)
+    ]
+    bot = CGMBot(TOKEN, database_file=database_file, patients=configs)
+
+    for user in range(users):
+        bot.auth_manager.set_user_chat_id(f"user{user}", 10000 + user)
+        bot.userDataManager.init_username(f"user{user}")
+    return bot
+
+
+def run_rounds(bot: CGMBot, clock: list, rounds: int) -> tuple[list, float]:
+    tick_latencies = []
+    lock = threading.Lock()
+
+    def tick(patient):
+        started = time.perf_counter()
+        bot.periodic_check_function(patient)
+        elapsed = time.perf_counter() - started
+        with lock:
+            tick_latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=settings.POLL_WORKERS, thread_name_prefix="LoadTick") as executor:
+        for _ in range(rounds):
+            clock[0] += READING_INTERVAL
+            list(executor.map(tick, bot.patients))
+    return tick_latencies, time.perf_counter() - started
+
+
+def run_commands(bot: CGMBot, users: int, amount: int, clients: int) -> tuple[list, float]:
+    # Handlers run synchronously on the client threads, as the webhook worker would.
+    bot.register_handlers(bot.handlers(), bot.cmd_text)
+    commands = ("/glicose", "/g", "/silencia20", "/remover_silenciar")
+    latencies = []
+    lock = threading.Lock()
+
+    def handle(i):
+        update = command_update(i, i % users, commands[i % len(commands)])
+        started = time.perf_counter()
+        bot.process_update_json(update)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients, thread_name_prefix="LoadCommand") as executor:
+        list(executor.map(handle, range(amount)))
+    return latencies, time.perf_counter() - started
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Pushes simulated patients and users through the bot.")
+    parser.add_argument("--patients", type=int, default=10)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3, help="Polls of every patient, one new reading each.")
+    parser.add_argument("--commands", type=int, default=0, help="Commands sent by the users.")
+    parser.add_argument("--clients", type=int, default=8, help="Threads sending the commands.")
+    parser.add_argument("--always-alert", action="store_true", help="Every new reading alerts its followers.")
+    parser.add_argument("--nightscout-latency-ms", type=float, default=20)
+    parser.add_argument("--nightscout-jitter-ms", type=float, default=20)
+    parser.add_argument("--nightscout-error-rate", type=float, default=0)
+    parser.add_argument("--padding", type=int, default=0, help="Bytes added to every Nightscout document.")
+    parser.add_argument("--telegram-latency-ms", type=float, default=10)
+    parser.add_argument("--flood-probability", type=float, default=0)
+    parser.add_argument("--drain-timeout", type=float, default=120, help="Seconds to wait for the pending sends.")
+    args = parser.parse_args(argv)
+
+    if args.always_alert:
+        settings.LIMIT_HIGH = 0
+
+    # The traces go on for `rounds` readings after now, revealed one per round.
+    clock = [int(time.time() * 1000)]
+    readings = settings.MEASURES_WINDOW * 2 + args.rounds
+    patients = synthetic_patients(args.patients, readings, end=clock[0] + args.rounds * READING_INTERVAL)
+
+    nightscout = FakeNightscout(
+        patients, api_secret=SECRET,
+        latency=args.nightscout_latency_ms / 1000, jitter=args.nightscout_jitter_ms / 1000,
+        error_rate=args.nightscout_error_rate, padding=args.padding, clock=lambda: clock[0],
+    )
+    telegram = FakeTelegram(latency=args.telegram_latency_ms / 1000, flood_probability=args.flood_probability)
+    nightscout.start()
+    telegram.start()
+    settings.TELEGRAM_BASE_URL = telegram.base_url
+
+    with tempfile.TemporaryDirectory() as directory:
+        settings.HISTORY_FILE = f"{directory}/load_history.sqlite3"
+        bot = build_bot(nightscout, args.patients, args.users, f"{directory}/load_database.json")
+        collector = SendCollector(bot)
+
+        tick_latencies, ticks_seconds = run_rounds(bot, clock, args.rounds)
+        result = {
+            "patients": args.patients,
+            "users": args.users,
+            "rounds": args.rounds,
+            "ticks": len(tick_latencies),
+            "ticks_per_second": len(tick_latencies) / ticks_seconds,
+            "tick_latency": latency_summary(tick_latencies),
+        }
+
+        if args.commands:
+            command_latencies, commands_seconds = run_commands(bot, args.users, args.commands, args.clients)
+            result["commands"] = len(command_latencies)
+            result["commands_per_second"] = len(command_latencies) / commands_seconds
+            result["command_latency"] = latency_summary(command_latencies)
+
+        started = time.perf_counter()
+        deliveries = collector.results(args.drain_timeout)
+        drain_seconds = time.perf_counter() - started
+        delivered = [r for r in deliveries if r.delivered]
+
+        result["sends"] = len(collector.futures)
+        result["delivered"] = len(delivered)
+        result["failed"] = len(deliveries) - len(delivered)
+        result["undrained"] = len(collector.futures) - len(deliveries)
+        result["drain_seconds"] = drain_seconds
+        result["send_latency"] = latency_summary([r.latency for r in delivered])
+        result["send_attempts_max"] = max((r.attempts for r in deliveries), default=0)
+        result["telegram_received"] = len(telegram.sent)
+        result["telegram_429"] = telegram.rejected
+        result["nightscout_requests"] = nightscout.stats.requests
+        result["nightscout_errors"] = nightscout.stats.errors
+
+        bot.sender.stop()
+        bot.fetch_executor.shutdown(wait=False)
+        bot.auth_manager.storage.close()
+        bot.history.close()
+        bot.charts.stop()
+
+    telegram.stop()
+    nightscout.stop()
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
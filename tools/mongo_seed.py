@@ -0,0 +1,119 @@
+# Loads synthetic or recorded traces into a local mongod, in the layout of a
+# Nightscout database, to exercise CGMPredictor/mongo_connection.py.
+#
+#   mongod --replSet rs0 --dbpath /tmp/mongo & mongosh --eval "rs.initiate()"
+#   python -m tools.mongo_seed --url mongodb://localhost:27017/ --patients 3 --live
+#
+# Every patient is a database (patient0, patient1, ...) with entries and
+# treatments collections and Nightscout's indexes on them, so the patient url
+# is mongodb://localhost:27017/patient0. With --live the readings after now
+# are inserted as their date passes (--speed replays faster than real time),
+# which the change stream (or, on a standalone mongod, the tail queries) picks
+# up. Change streams need a replica set, a single node one is enough.
+
+import time
+import argparse
+from typing import Optional
+
+import pymongo
+
+from CGMTelegramBot.CGMPredictor.backtest import iter_json_array, treatment_from_export
+
+from .fake_nightscout import milliseconds_now, speed_clock
+from .synthetic import generate_trace, iso_date, READING_INTERVAL
+
+
+# As Nightscout creates them (lib/server/entries.js and treatments.js).
+ENTRY_INDEXES = ["date", "type", "sgv", "sysTime", "dateString", [("type", 1), ("date", -1), ("dateString", 1)]]
+TREATMENT_INDEXES = ["created_at", "eventType", "insulin", "carbs"]
+
+
+def create_indexes(collection, indexes: list) -> None:
+    for index in indexes:
+        collection.create_index(index if isinstance(index, list) else [(index, pymongo.ASCENDING)])
+
+
+def seed_database(database, entries: list[dict], treatments: list[dict], until: int) -> tuple[list, list]:
+    # Inserts the documents dated up to `until`, returns the rest sorted by date.
+    database.entries.drop()
+    database.treatments.drop()
+    create_indexes(database.entries, ENTRY_INDEXES)
+    create_indexes(database.treatments, TREATMENT_INDEXES)
+
+    entries = sorted(({k: v for k, v in e.items() if k != "_id"} for e in entries), key=lambda e: e["date"])
+    treatments = sorted((
+        # Nightscout stores no mills.
+        {k: v for k, v in t.items() if k not in ("_id", "mills")} for t in treatments
+    ), key=lambda t: t["created_at"])
+
+    until_created_at = iso_date(until)
+    past_entries = [e for e in entries if e["date"] <= until]
+    past_treatments = [t for t in treatments if t["created_at"] <= until_created_at]
+    if past_entries:
+        database.entries.insert_many(past_entries, ordered=False)
+    if past_treatments:
+        database.treatments.insert_many(past_treatments, ordered=False)
+    return entries[len(past_entries):], treatments[len(past_treatments):]
+
+
+def replay(databases: dict, pending: dict, clock, interval: float = 1) -> None:
+    # Inserts every pending document once the clock passes its date.
+    while any(entries or treatments for entries, treatments in pending.values()):
+        now = clock()
+        for name, (entries, treatments) in pending.items():
+            while entries and entries[0]["date"] <= now:
+                databases[name].entries.insert_one(entries.pop(0))
+            while treatments and treatment_from_export(treatments[0]).date <= now:
+                databases[name].treatments.insert_one(treatments.pop(0))
+        time.sleep(interval)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Seeds a mongod with Nightscout entries and treatments.")
+    parser.add_argument("--url", default="mongodb://localhost:27017/")
+    parser.add_argument("--patients", type=int, default=1, help="Synthetic patients, databases patient0 to patientN-1.")
+    parser.add_argument("--days", type=float, default=1, help="Days of synthetic readings before now.")
+    parser.add_argument("--entries", help="Recorded JSON array of entries, seeded as the database patient0.")
+    parser.add_argument("--treatments", help="Recorded JSON array of treatments.")
+    parser.add_argument("--live", action="store_true", help="Keep inserting the readings after now as they are due.")
+    parser.add_argument("--live-hours", type=float, default=24, help="Hours of synthetic readings after now.")
+    parser.add_argument("--speed", type=float, default=1, help="Trace time speedup of --live.")
+    args = parser.parse_args(argv)
+
+    now = milliseconds_now()
+    start: Optional[int] = None
+    if args.entries:
+        with open(args.entries, "r") as file:
+            entries = [e for e in iter_json_array(file) if e.get("sgv") is not None and e.get("date") is not None]
+        treatments = []
+        if args.treatments:
+            with open(args.treatments, "r") as file:
+                treatments = list(iter_json_array(file))
+        for treatment in treatments:
+            treatment.setdefault("created_at", iso_date(treatment_from_export(treatment).date))
+        for entry in entries:
+            entry.setdefault("type", "sgv")
+        traces = {"patient0": (entries, treatments)}
+        # Replayed from the start of the recording.
+        start = now = min(e["date"] for e in entries) if args.live else max(e["date"] for e in entries)
+    else:
+        readings = int((args.days * 24 + (args.live_hours if args.live else 0)) * 60 * 60 * 1000 / READING_INTERVAL)
+        end = now + int(args.live_hours * 60 * 60 * 1000) if args.live else now
+        traces = {f"patient{i}": generate_trace(readings, end=end, seed=i) for i in range(args.patients)}
+
+    client = pymongo.MongoClient(args.url)
+    databases = {name: client[name] for name in traces}
+    pending = {name: seed_database(databases[name], *traces[name], until=now) for name in traces}
+    for name in traces:
+        print(f"Seeded {args.url.rstrip('/')}/{name}: {databases[name].entries.estimated_document_count()} entries")
+
+    if args.live:
+        try:
+            replay(databases, pending, speed_clock(args.speed, start))
+        except KeyboardInterrupt:
+            pass
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Synthetic CGM traces shaped like the Nightscout API responses.
+#
+# Readings come every 5 minutes with some jitter, follow meals and boluses with
+# noise, and have occasional signal losses. Entries are returned newest first,
+# as /api/v1/entries does, treatments too.
+
+import math
+import random
+from datetime import datetime, timezone
+from typing import Optional
+
+
+READING_INTERVAL = 5 * 60 * 1000  # in milliseconds
+
+
+def direction_for_delta(delta: float) -> str:
+    # Nightscout directions by the mg/dL per minute rate.
+    rate = delta / 5
+    if rate <= -3:
+        return "DoubleDown"
+    if rate <= -2:
+        return "SingleDown"
+    if rate <= -1:
+        return "FortyFiveDown"
+    if rate < 1:
+        return "Flat"
+    if rate < 2:
+        return "FortyFiveUp"
+    if rate < 3:
+        return "SingleUp"
+    return "DoubleUp"
+
+
+def iso_date(date: int) -> str:
+    created_at = datetime.fromtimestamp(date / 1000, tz=timezone.utc)
+    return created_at.strftime("%Y-%m-%dT%H:%M:%S.") + f"{date % 1000:03d}Z"
+
+
+def generate_trace(readings: int, end: Optional[int] = None, seed: int = 0,
+                   gap_probability: float = 0.002, meals_per_day: int = 3) -> tuple[list[dict], list[dict]]:
+    rng = random.Random(seed)
+    if end is None:
+        end = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+
+    date = end - readings * READING_INTERVAL
+    sgv = 120.0
+    effect = 0.0  # mg/dL per reading, from carbs (positive) and insulin (negative)
+    meal_probability = meals_per_day / (24 * 12)
+
+    entries = []
+    treatments = []
+
+    for i in range(readings):
+        date += READING_INTERVAL + rng.randint(-3000, 3000)
+
+        # Signal loss, between 15 minutes and 2 hours without readings.
+        if rng.random() < gap_probability:
+            date += rng.randint(3, 24) * READING_INTERVAL
+
+        if rng.random() < meal_probability:
+            carbs = rng.choice((15, 30, 45, 60))
+            treatments.append({"created_at": iso_date(date), "mills": date, "carbs": carbs, "insulin": None})
+            effect += carbs / 10
+            if rng.random() < 0.8:
+                insulin_date = date + rng.randint(-2, 4) * 60 * 1000
+                insulin = round(carbs / rng.choice((10, 12, 15)), 1)
+                treatments.append({"created_at": iso_date(insulin_date), "mills": insulin_date, "carbs": None, "insulin": insulin})
+                effect -= insulin * 1.2
+
+        # Effects fade, glucose drifts back to the target.
+        effect *= 0.93
+        drift = (120 - sgv) * 0.01 + 4 * math.sin(i / 40)
+        previous = sgv
+        sgv = min(400.0, max(40.0, sgv + effect + drift + rng.gauss(0, 2.5)))
+
+        entries.append({
+            "_id": f"{i:024x}",
+            "device": "synthetic",
+            "date": date,
+            "dateString": iso_date(date),
+            "sgv": int(sgv),
+            "delta": round(sgv - previous, 3),
+            "direction": direction_for_delta(sgv - previous),
+            "type": "sgv",
+            "filtered": int(sgv * 1000),
+            "unfiltered": int(sgv * 1000),
+            "rssi": 100,
+            "noise": 1,
+            "sysTime": iso_date(date),
+            "utcOffset": 0,
+        })
+
+    entries.reverse()
+    treatments.sort(key=lambda t: t["mills"], reverse=True)
+    return entries, treatments
@@ -0,0 +1,139 @@
+# Posts Telegram updates to the webhook listener and reports updates per second.
+#
+#   python -m tools.webhook_benchmark --updates 20000 --clients 8
+#   python -m tools.webhook_benchmark --recorded updates.json --url http://127.0.0.1:8443/telegram
+#
+# Without --url a local WebhookServer is started, processing updates with a
+# no-op (or --process-ms of busy work, to see the backpressure). --recorded is
+# a JSON array of update objects as received from Telegram, they are replayed
+# in a loop with new update ids.
+
+import json
+import time
+import argparse
+import threading
+import http.client
+from urllib.parse import urlparse
+
+from CGMTelegramBot.webhook import SECRET_TOKEN_HEADER, WebhookServer
+
+
+def synthetic_update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 1000 + update_id % 50, "type": "private"},
+            "from": {"id": 1000 + update_id % 50, "is_bot": False, "first_name": "Bench", "username": f"user{update_id % 50}"},
+            "text": "/glicose",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 8}],
+        },
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def post_updates(url: str, secret_token: str, bodies: list, statuses: dict, latencies: list, lock: threading.Lock):
+    parsed = urlparse(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port)
+    headers = {"Content-Type": "application/json"}
+    if secret_token:
+        headers[SECRET_TOKEN_HEADER] = secret_token
+
+    local_latencies = []
+    local_statuses = {}
+    for body in bodies:
+        start = time.perf_counter()
+        connection.request("POST", parsed.path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        local_latencies.append(time.perf_counter() - start)
+        local_statuses[response.status] = local_statuses.get(response.status, 0) + 1
+    connection.close()
+
+    with lock:
+        latencies.extend(local_latencies)
+        for status, amount in local_statuses.items():
+            statuses[status] = statuses.get(status, 0) + amount
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the webhook listener.")
+    parser.add_argument("--url", help="Webhook URL, defaults to a local listener.")
+    parser.add_argument("--secret-token", default="benchmark-secret")
+    parser.add_argument("--recorded", help="JSON array of recorded updates.")
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--process-ms", type=float, default=0, help="Busy work per update of the local listener.")
+    parser.add_argument("--queue-size", type=int, default=256)
+    args = parser.parse_args(argv)
+
+    server = None
+    processed = []
+    if args.url is None:
+        def process_update(data: dict) -> None:
+            if args.process_ms:
+                end = time.perf_counter() + args.process_ms / 1000
+                while time.perf_counter() < end:
+                    pass
+            processed.append(data["update_id"])
+
+        server = WebhookServer(process_update, listen="127.0.0.1", port=0, path="/telegram",
+                               secret_token=args.secret_token, queue_size=args.queue_size, cert=None, key=None)
+        server.start()
+        args.url = f"http://127.0.0.1:{server.port}/telegram"
+
+    if args.recorded:
+        with open(args.recorded, "r") as file:
+            recorded = json.load(file)
+        updates = [dict(recorded[i % len(recorded)], update_id=i) for i in range(args.updates)]
+    else:
+        updates = [synthetic_update(i) for i in range(args.updates)]
+    bodies = [json.dumps(update).encode() for update in updates]
+
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=post_updates, args=(args.url, args.secret_token, bodies[i::args.clients], statuses, latencies, lock))
+        for i in range(args.clients)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if server:
+        # Wait for the worker to drain the queue.
+        while not server.updates.empty():
+            time.sleep(0.01)
+        drained = time.perf_counter() - start
+        server.stop()
+
+    result = {
+        "updates": args.updates,
+        "clients": args.clients,
+        "seconds": elapsed,
+        "requests_per_second": args.updates / elapsed,
+        "statuses": statuses,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+    if server:
+        result["processed_per_second"] = len(processed) / drained
+        result["dropped"] = server.stats.dropped
+
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()